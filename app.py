@@ -1,30 +1,107 @@
 from __future__ import annotations
 import os
+import queue
+import random
+import shutil
+import sqlite3
+import stat
 import subprocess
+import tempfile
+import wave
+import threading
+import time
+import copy
+import atexit
+import bisect
+import hashlib
+import heapq
+import mimetypes
+import multiprocessing
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import asdict, dataclass, field
 from datetime import datetime
+from functools import lru_cache
+from multiprocessing import shared_memory
+import importlib
 
-import note_seq
-from Scripts.rst2odt import output
-from flask import Flask, request, jsonify, send_from_directory, render_template
+import numpy as np
+from flask import Flask, request, jsonify, render_template, Response, redirect, stream_with_context, g, has_request_context
+from werkzeug.utils import secure_filename
 import json
-import magenta
-from magenta.models import melody_rnn
-from magenta.models.melody_rnn import melody_rnn_sequence_generator
-from magenta.models.shared import sequence_generator_bundle
-from note_seq import midi_io
-from note_seq.protobuf import music_pb2
-from note_seq.protobuf import generator_pb2
-from note_seq import sequences_lib
-import midi2audio
-from midi2audio import FluidSynth as Synth
 import re
+import io
+import soundfile
+from pydub import AudioSegment
+
+try:
+    import fluidsynth
+except ImportError:  # pyfluidsynth chybí nebo nenašel knihovnu libfluidsynth
+    fluidsynth = None
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:  # boto3 je potřeba jen pro STORAGE_BACKEND=s3
+    boto3 = None
+    ClientError = Exception
+
+# --- líné importy ML knihoven -----------------------------------------------
+class LazyModule:
+    """
+    Zástupce modulu, který se skutečně naimportuje až při prvním přístupu
+    k atributu. Magenta a note_seq táhnou TensorFlow, jehož import trvá
+    desítky sekund – lehké routy (historie, stahování, stav úloh) tak
+    naběhnou hned a ML knihovny se načtou na pozadí nebo až při použití.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            # import_module drží importní zámek, souběžná vlákna počkají na jeden import
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def __repr__(self):
+        state = "načten" if self._module is not None else "nenačten"
+        return f"<LazyModule {self._name} ({state})>"
+
+
+note_seq = LazyModule("note_seq")
+music_pb2 = LazyModule("note_seq.protobuf.music_pb2")
+generator_pb2 = LazyModule("note_seq.protobuf.generator_pb2")
+state_util = LazyModule("magenta.common.state_util")
+sequence_generator_bundle = LazyModule("magenta.models.shared.sequence_generator_bundle")
+events_rnn_model = LazyModule("magenta.models.shared.events_rnn_model")
+melody_pipelines = LazyModule("magenta.pipelines.melody_pipelines")
+melody_rnn_sequence_generator = LazyModule("magenta.models.melody_rnn.melody_rnn_sequence_generator")
+NOTE_SEQ_MODULES = [note_seq, music_pb2, generator_pb2]
+MAGENTA_MODULES = [state_util, sequence_generator_bundle, events_rnn_model, melody_pipelines,
+                   melody_rnn_sequence_generator]
+ML_MODULES = NOTE_SEQ_MODULES + MAGENTA_MODULES
+# --- konec líných importů ---------------------------------------------------
 
 app = Flask(__name__)
 
 OUTPUT_DIR = "generated_music_files"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-HISTORY_FILE = "history.json"
+# Kam se ukládají výstupy: "local" = OUTPUT_DIR rozdělený podle data a hashe,
+# "s3" = bucket kompatibilní s S3 (S3_ENDPOINT_URL např. pro lokální MinIO)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local")
+S3_BUCKET = os.environ.get("S3_BUCKET", "")
+S3_PREFIX = os.environ.get("S3_PREFIX", "generated_music_files")
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL") or None
+
+HISTORY_FILE = "history.json"  # původní úložiště, převádí se do HISTORY_DB
+HISTORY_DB = os.environ.get("HISTORY_DB", "history.db")
 
 BUNDLE_PATHS = {
     "basic_rnn": "bundles/basic_rnn.mag",
@@ -32,9 +109,92 @@ BUNDLE_PATHS = {
     "lookback_rnn": "bundles/lookback_rnn.mag"
 }
 
-# Upravit cestu k SoundFontu - ZKONTROLUJTE TUTO CESTU!
-soundfont_path = r"C:\Users\renek\Downloads\Timbres Of Heaven GM_GS_XG_SFX V 3.4 Final\Timbres Of Heaven GM_GS_XG_SFX V 3.4 Final.sf2"
-fluidsynth_executable_path = r"C:\Users\renek\Downloads\fluidsynth-2.3.3-win10-x64\bin\fluidsynth.exe"
+# Kolik inicializovaných modelů smí zůstat v paměti (LRU) a které se mají načíst hned při startu
+MODEL_CACHE_SIZE = int(os.environ.get("MODEL_CACHE_SIZE", len(BUNDLE_PATHS)))
+PRELOAD_MODELS = [m.strip() for m in os.environ.get("PRELOAD_MODELS", "").split(",") if m.strip()]
+# Jak se při startu načítá TensorFlow/Magenta: "background" = lehké routy běží hned
+# a ML knihovny, PRELOAD_MODELS i syntezátor se zahřejí ve vlákně na pozadí,
+# "lazy" = vše až při prvním požadavku, "eager" = před spuštěním serveru
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "background")
+
+# Inferenční procesy: kolik samostatných procesů se zahřátým modelem běží pro každý
+# model, např. "basic_rnn:2,attention_rnn:1"; samotné číslo platí pro všechny modely.
+# Prázdné = melodie se generují přímo v procesu serveru (modely bez procesu také).
+INFERENCE_WORKERS = os.environ.get("INFERENCE_WORKERS", "")
+INFERENCE_PROCESS_PREFIX = "inference-"
+# Inferenční proces naimportuje tento modul znovu (spawn); podle jména procesu,
+# které multiprocessing nastaví ještě před importem, pozná, že nemá spouštět server
+IS_INFERENCE_WORKER = multiprocessing.current_process().name.startswith(INFERENCE_PROCESS_PREFIX)
+# Jak dlouho (s) smí inferenční proces mlčet, než úloha skončí chybou; 0 = bez limitu.
+# Stav procesu se kontroluje každých INFERENCE_POLL_SECONDS.
+INFERENCE_TIMEOUT = float(os.environ.get("INFERENCE_TIMEOUT", 600))
+INFERENCE_POLL_SECONDS = 5
+
+# Fronta generovacích úloh: vlákna generování (fáze generate), kolik úloh smí čekat a kolik hotových si pamatujeme
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_QUEUE_LIMIT = int(os.environ.get("JOB_QUEUE_LIMIT", 16))
+JOB_RETENTION = int(os.environ.get("JOB_RETENTION", 200))
+
+# Úloha prochází fázemi generate (prompt + melodie), arrange (doprovod + MIDI)
+# a render (zvuk + uložení), každá má vlastní vlákna – např. "generate:2,render:3";
+# neuvedené fáze mají JOB_WORKERS (generate), 1 (arrange) a RENDER_POOL_SIZE (render)
+# vláken. Generování se seedem od klienta se v procesu serveru střídá pod zámkem
+# (seeded_random), bez seedu běží vlákna generate souběžně. Mezi fázemi je fronta
+# o PIPELINE_QUEUE_SIZE místech.
+PIPELINE_WORKERS = os.environ.get("PIPELINE_WORKERS", "")
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 2))
+
+# Dávkové generování (/batch_generate, batch.py): manifesty dávek, kolik skladeb
+# jedné dávky je rozpracovaných najednou (0 = tolik, kolik pojmou fáze úloh)
+# a kolik položek smí dávka mít
+BATCH_DIR = os.environ.get("BATCH_DIR", os.path.join(OUTPUT_DIR, "batches"))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 0))
+MAX_BATCH_ITEMS = int(os.environ.get("MAX_BATCH_ITEMS", 10000))
+
+# Kolik variant jedné skladby lze vyžádat najednou (parametr candidates)
+MAX_CANDIDATES = int(os.environ.get("MAX_CANDIDATES", 8))
+
+# Long-form režim pro dlouhé (ambientní) skladby: od LONG_FORM_SECONDS se skladba
+# generuje, doprovází, zapisuje do MIDI a renderuje po oknech LONG_FORM_WINDOW_SECONDS,
+# takže paměť nezávisí na délce. LONG_FORM_CONTEXT_BARS je kontext melodie pro enkodér.
+LONG_FORM_SECONDS = int(os.environ.get("LONG_FORM_SECONDS", 300))
+MAX_LONG_FORM_SECONDS = int(os.environ.get("MAX_LONG_FORM_SECONDS", 3600))
+LONG_FORM_WINDOW_SECONDS = int(os.environ.get("LONG_FORM_WINDOW_SECONDS", 32))
+LONG_FORM_CONTEXT_BARS = int(os.environ.get("LONG_FORM_CONTEXT_BARS", 4))
+
+# Paměť vygenerovaných melodií pro opakované požadavky se stejným seedem
+# (počet záznamů) a zakódovaných primerů pro dávkové generování variant
+MELODY_CACHE_SIZE = int(os.environ.get("MELODY_CACHE_SIZE", 64))
+PRIMER_CACHE_SIZE = int(os.environ.get("PRIMER_CACHE_SIZE", 32))
+
+# Cesty k SoundFontu a FluidSynthu se berou z prostředí, např. na Windows:
+#   set SOUNDFONT_PATH=C:\...\Timbres Of Heaven GM_GS_XG_SFX V 3.4 Final.sf2
+#   set FLUIDSYNTH_PATH=C:\...\fluidsynth-2.3.3-win10-x64\bin\fluidsynth.exe
+soundfont_path = os.environ.get("SOUNDFONT_PATH", os.path.join("soundfonts", "default.sf2"))
+fluidsynth_executable_path = os.environ.get("FLUIDSYNTH_PATH", "fluidsynth")
+
+# Renderování zvuku: "synth" = SoundFont trvale načtený v pyfluidsynth,
+# "subprocess" = původní spouštění fluidsynth pro každý požadavek
+RENDER_BACKEND = os.environ.get("RENDER_BACKEND", "synth")
+RENDER_POOL_SIZE = int(os.environ.get("RENDER_POOL_SIZE", 1))
+SAMPLE_RATE = int(os.environ.get("SAMPLE_RATE", 44100))
+RENDER_TAIL_SECONDS = 1.5  # dozvuk po poslední notě
+# Výstupní zvukové formáty: FLAC jako bezeztrátový archiv, MP3/Opus jako malý náhled
+# pro přehrávač. WAV se ukládá jen na vyžádání (parametr formats nebo AUDIO_FORMATS).
+AUDIO_FORMATS = [f.strip() for f in os.environ.get("AUDIO_FORMATS", "flac,mp3").split(",") if f.strip()]
+PREVIEW_FORMAT = os.environ.get("PREVIEW_FORMAT", "mp3")
+MP3_BITRATE = os.environ.get("MP3_BITRATE", "128k")
+OPUS_BITRATE = os.environ.get("OPUS_BITRATE", "64k")
+# Formát sekcí při streamovaném generování – bezeztrátový a bez ticha na začátku,
+# které přidávají kodéry MP3/Opus, aby na sebe sekce v přehrávači navazovaly
+STREAM_CHUNK_FORMAT = os.environ.get("STREAM_CHUNK_FORMAT", "flac")
+# Ukládat výstupy na disk (a do historie)? Požadavek to může změnit parametrem
+# persist – bez uložení zůstane MIDI i zvuk jen v paměti úlohy.
+PERSIST_OUTPUTS = os.environ.get("PERSIST_OUTPUTS", "1").lower() not in ("0", "false", "no")
+# Limit indexu cache vyrenderovaných skladeb: součet velikostí MIDI + zvuku (v MB),
+# na které se index odkazuje. Omezuje jen index – vyřazené soubory v úložišti
+# zůstávají, patří k záznamům historie. Starší název RENDER_CACHE_MB platí dál.
+RENDER_CACHE_INDEX_MB = int(os.environ.get("RENDER_CACHE_INDEX_MB", os.environ.get("RENDER_CACHE_MB", 2048)))
 
 INSTRUMENT_MIDI_MAP = {
     "piano": 0, "acoustic piano": 0, "grand piano": 0,
@@ -131,32 +291,106 @@ GENRE_MAP = {
     "solo": {"solo_mode": True},
 }
 
-# Definuj nástroje
-pad_instrument = 89            # Pad 1 (new age)
-chord_instrument = 1           # Acoustic Grand Piano
-bass_instrument = 33           # Electric Bass (finger)
-
-def generate_pad(notes, chord, start, end, pad_instrument):
-    for pitch in chord[:3]:  # použijeme první tři tóny akordu
-        n = notes.add()
-        n.pitch = pitch - 12  # o oktávu níže
-        n.start_time = start
-        n.end_time = end
-        n.velocity = 60
-        n.instrument = 3
-        n.program = pad_instrument
-        n.is_drum = False
-
-def generate_chords(notes, chord, start, chord_instrument):
-    for pitch in chord:
-        n = notes.add()
-        n.pitch = pitch
-        n.start_time = start
-        n.end_time = start + 1.5
-        n.velocity = 70
-        n.instrument = 2
-        n.program = chord_instrument
-        n.is_drum = False
+# --- doprovodné vrstvy ------------------------------------------------------
+# Každá vrstva se skládá jako pole not (NOTE_DTYPE): jeden takt vzoru se
+# zopakuje přes celou délku skladby a do NoteSequence se zapíše najednou.
+
+NOTE_DTYPE = np.dtype([
+    ("pitch", np.int16),
+    ("start", np.float64),
+    ("end", np.float64),
+    ("velocity", np.int16),
+    ("program", np.int16),
+    ("instrument", np.int16),
+    ("is_drum", np.bool_),
+])
+
+def note_array(pitch, start, end, velocity, program=0, instrument=0, is_drum=False):
+    """
+    Pole not z jednotlivých sloupců; skaláry se roztáhnou na délku ostatních.
+    """
+    columns = np.broadcast_arrays(pitch, start, end, velocity, program, instrument, is_drum)
+    notes = np.empty(np.size(columns[0]), dtype=NOTE_DTYPE)
+    for name, column in zip(NOTE_DTYPE.names, columns):
+        notes[name] = np.ravel(column)
+    return notes
+
+def tile_pattern(pattern, anchors, period, length):
+    """
+    Zopakuje vzor po `period` sekundách a ponechá noty, jejichž kotva
+    (začátek kroku vzoru) leží před koncem skladby.
+    """
+    repetitions = int(np.ceil(length / period)) if length > 0 else 0
+    offsets = np.repeat(np.arange(repetitions) * period, len(pattern))
+    tiled = np.tile(pattern, repetitions)
+    tiled["start"] += offsets
+    tiled["end"] += offsets
+    return tiled[np.tile(anchors, repetitions) + offsets < length]
+
+def progression_pattern(progression, measure, velocity, program, instrument,
+                        duration=None, transpose=0, voices=None):
+    """
+    Jeden průchod progresí: akord na začátku každého taktu. Vrací noty a jejich kotvy.
+    """
+    chords = [chord[:voices] for chord in progression]
+    sizes = [len(chord) for chord in chords]
+    onsets = np.repeat(np.arange(len(chords)) * measure, sizes)
+    pitches = np.concatenate([np.asarray(chord) for chord in chords]) + transpose
+    pattern = note_array(pitches, onsets, onsets + (duration if duration is not None else measure),
+                         velocity, program, instrument)
+    return pattern, onsets
+
+def chord_layer(progression, length, program, measure=2.0):
+    pattern, anchors = progression_pattern(progression, measure, 70, program, 2, duration=1.5)
+    return tile_pattern(pattern, anchors, measure * len(progression), length)
+
+def pad_layer(progression, length, program, measure=2.0):
+    # první tři tóny akordu o oktávu níž, drží celý takt
+    pattern, anchors = progression_pattern(progression, measure, 60, program, 3, transpose=-12, voices=3)
+    return tile_pattern(pattern, anchors, measure * len(progression), length)
+
+def bass_layer(length, program, pitch=36, step=2.0):
+    pattern = note_array(pitch, 0.0, 1.5, 80, program, 1)
+    return tile_pattern(pattern, np.zeros(1), step, length)
+
+# Bicí na dvě doby: kopák a hi-hat na každé, virbl jen v první době (posunutý o sekundu)
+DRUM_PATTERN = note_array(
+    pitch=[36, 38, 42, 42, 36, 42, 42],
+    start=[0.0, 1.0, 0.0, 0.5, 1.0, 1.0, 1.5],
+    end=[0.2, 1.2, 0.1, 0.6, 1.2, 1.1, 1.6],
+    velocity=[100, 90, 70, 70, 100, 70, 70],
+    instrument=9,
+    is_drum=True,
+)
+DRUM_ANCHORS = np.array([0.0, 0.0, 0.0, 0.0, 1.0, 1.0, 1.0])
+
+def drum_layer(length, measure=2.0):
+    return tile_pattern(DRUM_PATTERN, DRUM_ANCHORS, measure, length)
+
+def arpeggio_layer(progression, length, program, make_pattern, measure=2.0, note_duration=0.25):
+    """
+    Arpeggio přes každý akord progrese; `make_pattern` určuje pořadí tónů
+    (u náhodného stylu se volá pro každý takt zvlášť).
+    """
+    onsets = np.arange(int(np.ceil(length / measure)) if length > 0 else 0) * measure
+    steps_per_measure = int(np.ceil(measure / note_duration))
+    patterns = [make_pattern(progression[k % len(progression)])[:steps_per_measure] for k in range(len(onsets))]
+    if not patterns:
+        return np.empty(0, dtype=NOTE_DTYPE)
+    sizes = [len(pattern) for pattern in patterns]
+    steps = np.concatenate([np.arange(size) for size in sizes]) * note_duration
+    starts = np.repeat(onsets, sizes) + steps
+    notes = note_array(np.concatenate(patterns), starts, starts + note_duration * 0.8, 85, program, 4)
+    return notes[starts < length]
+
+def build_layer(name, builder, *args):
+    """Sestaví vrstvu a zapíše do metrik, jak dlouho to trvalo a kolik má not."""
+    with LAYER_SECONDS.time(layer=name):
+        notes = builder(*args)
+    NOTES_EMITTED.inc(len(notes), layer=name)
+    return notes
+
+# --- konec doprovodných vrstev ----------------------------------------------
 
 def add_chords_to_sequence(sequence, start_time, duration, section_name='verse'):
     chords = CHORD_PROGRESSIONS.get(section_name, ['C', 'F', 'G', 'C'])
@@ -168,42 +402,1960 @@ def add_chords_to_sequence(sequence, start_time, duration, section_name='verse')
         annotation.text = chord
         annotation.annotation_type = note_seq.NoteSequence.TextAnnotation.CHORD_SYMBOL
 
-def generate_bass(notes, pitch, start, bass_instrument):
-    n = notes.add()
-    n.pitch = pitch
-    n.start_time = start
-    n.end_time = start + 1.5
-    n.velocity = 80
-    n.instrument = 1
-    n.program = bass_instrument
-    n.is_drum = False
-
-def generate_drums(notes, start):
-    kick = notes.add()
-    kick.pitch = 36
-    kick.start_time = start
-    kick.end_time = start + 0.2
-    kick.velocity = 100
-    kick.instrument = 9
-    kick.is_drum = True
-
-    snare = notes.add()
-    snare.pitch = 38
-    snare.start_time = start + 1.0
-    snare.end_time = start + 1.2
-    snare.velocity = 90
-    snare.instrument = 9
-    snare.is_drum = True
-
-    for i in [0, 0.5, 1, 1.5]:
-        hihat = notes.add()
-        hihat.pitch = 42
-        hihat.start_time = start + i
-        hihat.end_time = start + i + 0.1
-        hihat.velocity = 70
-        hihat.instrument = 9
-        hihat.is_drum = True
+# --- metriky ----------------------------------------------------------------
+# Jednoduché metriky bez další závislosti, čitelné Prometheem přes /metrics
+# (textový formát 0.0.4). Histogramy měří latence, čítače množství práce.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+def _metric_labels(pairs):
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def _samples(self):
+        return []
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{_metric_labels(pairs)} {value}" for name, pairs, value in self._samples()]
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, list(zip(self.labels, key)), value) for key, value in items]
+
+class Gauge(Metric):
+    """
+    Hodnota se čte až při výpisu z funkce `read`; s popisky vrací `read`
+    slovník {hodnota popisku (nebo n-tice hodnot): hodnota}.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help_text, read, labels=()):
+        super().__init__(name, help_text, labels)
+        self.read = read
+
+    def _samples(self):
+        try:
+            value = self.read()
+        except Exception:
+            return []
+        if not self.labels:
+            return [(self.name, [], value)]
+        return [(self.name, list(zip(self.labels, key if isinstance(key, tuple) else (key,))), item)
+                for key, item in value.items()]
+
+class CallbackCounter(Gauge):
+    """
+    Čítač, jehož hodnotu vede někdo jiný (např. cache) – čte se při výpisu
+    z funkce `read` stejně jako u Gauge, jen s typem counter.
+    """
+    kind = "counter"
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, totals = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0, 0]))
+            counts[index] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, (list(counts), list(totals))) for key, (counts, totals) in self._values.items())
+        samples = []
+        for key, (counts, (total, count)) in items:
+            pairs = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append((f"{self.name}_bucket", pairs + [("le", le)], cumulative))
+            samples.append((f"{self.name}_sum", pairs, round(total, 6)))
+            samples.append((f"{self.name}_count", pairs, count))
+        return samples
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name, help_text, read, labels=()):
+        return self._register(Gauge(name, help_text, read, labels))
+
+    def callback_counter(self, name, help_text, read, labels=()):
+        return self._register(CallbackCounter(name, help_text, read, labels))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.histogram("musicgen_stage_seconds", "Doba jednotlivých fází generovací úlohy.", ["stage"])
+MODEL_LOAD_SECONDS = metrics.histogram("musicgen_model_load_seconds", "Načtení bundlu a initialize() modelu.", ["model"])
+SECTION_SECONDS = metrics.histogram("musicgen_section_generate_seconds", "Generování jedné sekce melodie.", ["section"])
+LAYER_SECONDS = metrics.histogram("musicgen_layer_build_seconds", "Sestavení jedné doprovodné vrstvy.", ["layer"])
+MIDI_WRITE_SECONDS = metrics.histogram("musicgen_midi_write_seconds", "Serializace skladby do MIDI.")
+RENDER_SECONDS = metrics.histogram("musicgen_render_seconds", "Render MIDI do PCM přes FluidSynth.", ["backend"])
+ENCODE_SECONDS = metrics.histogram("musicgen_encode_seconds", "Kódování PCM do výstupního formátu.", ["format"])
+HTTP_SECONDS = metrics.histogram("musicgen_http_request_seconds", "Doba obsluhy HTTP požadavku (bez streamovaného těla).",
+                                 ["endpoint", "method", "status"])
+RNN_STEPS = metrics.counter("musicgen_rnn_steps_total", "Vygenerované kroky RNN.", ["model"])
+NOTES_EMITTED = metrics.counter("musicgen_notes_emitted_total", "Noty zapsané do skladeb podle vrstvy.", ["layer"])
+BYTES_WRITTEN = metrics.counter("musicgen_bytes_written_total", "Bajty výstupních souborů.", ["format", "target"])
+MELODY_CACHE_LOOKUPS = metrics.counter("musicgen_melody_cache_total", "Hledání melodie v paměti podle seedu.", ["result"])
+BATCH_TRACKS = metrics.counter("musicgen_batch_tracks_total", "Položky dávek podle výsledku.", ["status"])
+PIPELINE_WAIT_SECONDS = metrics.histogram("musicgen_pipeline_wait_seconds", "Čekání úlohy ve frontě před fází.",
+                                          ["stage"])
+PIPELINE_BUSY_SECONDS = metrics.counter("musicgen_pipeline_busy_seconds_total",
+                                        "Čas, kdy vlákna fáze pracovala (rate / počet vláken = vytížení).", ["stage"])
+JOBS_TOTAL = metrics.counter("musicgen_jobs_total", "Dokončené generovací úlohy podle výsledku.", ["status"])
+metrics.gauge("musicgen_jobs_active", "Běžící a čekající generovací úlohy.", lambda: job_manager.active)
+metrics.gauge("musicgen_models_loaded", "Modely načtené v paměti.", lambda: len(model_registry.loaded_models()))
+metrics.gauge("musicgen_render_cache_bytes", "Součet velikostí souborů v indexu cache vyrenderovaných skladeb.", lambda: render_cache.stats()["bytes"])
+metrics.callback_counter("musicgen_render_cache_hits_total", "Zásahy cache vyrenderovaných skladeb.",
+                         lambda: render_cache.stats()["hits"])
+metrics.callback_counter("musicgen_render_cache_misses_total", "Minutí cache vyrenderovaných skladeb.",
+                         lambda: render_cache.stats()["misses"])
+
+def add_server_timing(name, seconds, description=None):
+    """
+    Přidá položku do hlavičky Server-Timing aktuální odpovědi (viditelné v devtools).
+    """
+    if has_request_context():
+        g.setdefault("server_timing", []).append((name, seconds, description))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_timing(response):
+    started = g.get("request_started")
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    HTTP_SECONDS.observe(elapsed, endpoint=request.endpoint or "unknown", method=request.method,
+                         status=response.status_code)
+    entries = g.get("server_timing", []) + [("app", elapsed, None)]
+    response.headers["Server-Timing"] = ", ".join(
+        f"{name};dur={seconds * 1000:.1f}" + (f';desc="{description}"' if description else "")
+        for name, seconds, description in entries
+    )
+    return response
+
+# --- konec metrik -----------------------------------------------------------
+
+# --- registr modelů ------------------------------------------------------
+class ModelRegistry:
+    """
+    Drží inicializované generátory melody_rnn v paměti procesu.
+
+    • Každý bundle z BUNDLE_PATHS se načte a inicializuje jen jednou,
+      další požadavky dostanou už „zahřátý“ generátor.
+    • Počet modelů v paměti omezuje LRU limit max_models – nejdéle
+      nepoužitý model se uvolní, když je potřeba místo pro jiný.
+    """
+
+    def __init__(self, bundle_paths, max_models=3):
+        self.bundle_paths = bundle_paths
+        self.max_models = max(1, max_models)
+        self._generators = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in bundle_paths}
+
+    def _load(self, model):
+        bundle_path = self.bundle_paths[model]
+        bundle = sequence_generator_bundle.read_bundle_file(bundle_path)
+        generator_map = melody_rnn_sequence_generator.get_generator_map()
+        generator = generator_map[model](checkpoint=None, bundle=bundle)
+        generator.initialize()
+        return generator
+
+    def get(self, model):
+        bundle_path = self.bundle_paths.get(model)
+        if not bundle_path or not os.path.exists(bundle_path):
+            raise KeyError(model)
+
+        with self._lock:
+            if model in self._generators:
+                self._generators.move_to_end(model)
+                return self._generators[model]
+
+        # Načítání drží zámek jen pro daný model, ostatní modely mohou dál obsluhovat požadavky
+        with self._load_locks[model]:
+            with self._lock:
+                if model in self._generators:
+                    self._generators.move_to_end(model)
+                    return self._generators[model]
+
+            with MODEL_LOAD_SECONDS.time(model=model):
+                generator = self._load(model)
+
+            with self._lock:
+                self._generators[model] = generator
+                while len(self._generators) > self.max_models:
+                    evicted, _ = self._generators.popitem(last=False)
+                    print(f"Uvolňuji model z paměti: {evicted}")
+            return generator
+
+    def preload(self, models):
+        for model in models:
+            try:
+                self.get(model)
+                print(f"Model připraven: {model}")
+            except Exception as e:
+                print(f"Model '{model}' se nepodařilo přednačíst: {e}")
+
+    def loaded_models(self):
+        with self._lock:
+            return list(self._generators)
+
+
+model_registry = ModelRegistry(BUNDLE_PATHS, max_models=MODEL_CACHE_SIZE)
+# --- konec registru modelů ------------------------------------------------
+
+# --- inferenční procesy ------------------------------------------------------
+def parse_inference_workers(spec, models):
+    """
+    "basic_rnn:2,lookback_rnn:1" → {"basic_rnn": 2, "lookback_rnn": 1}; samotné číslo
+    platí pro všechny modely. Neznámý model je chyba konfigurace.
+    """
+    spec = spec.strip()
+    if not spec:
+        return {}
+    if spec.isdigit():
+        return {model: int(spec) for model in models} if int(spec) else {}
+    counts = {}
+    for item in spec.split(","):
+        model, _, count = item.strip().partition(":")
+        if model not in models:
+            raise ValueError(f"INFERENCE_WORKERS: neznámý model '{model}'")
+        counts[model] = int(count or 1)
+    return {model: count for model, count in counts.items() if count > 0}
+
+# Magenta vzorkuje tóny z globálního np.random. Aby stejný seed dal stejnou melodii,
+# generování se seedem se v jednom procesu střídá pod zámkem; souběžně generují jen
+# samostatné inferenční procesy (INFERENCE_WORKERS). Bez seedu se zámek nebere.
+_random_lock = threading.Lock()
+
+@contextmanager
+def seeded_random(seed):
+    if seed is None:
+        yield
+        return
+    with _random_lock:
+        state = np.random.get_state()
+        np.random.seed(seed)
+        try:
+            yield
+        finally:
+            np.random.set_state(state)
+
+def generate_melodies(generator, primer, plan, count, temperature=1.0, stats=None, on_section=None):
+    if count > 1 and plan:
+        # Více variant téhož zadání – všechny v jednom dávkovém průchodu RNN
+        return generate_song_candidates(generator, primer, plan, count, temperature, stats, on_section)
+    return [generate_planned_song(generator, primer, plan, temperature, stats, on_section)]
+
+def write_handoff(sequences):
+    """
+    Serializované NoteSequence zapíše za sebe do jednoho bloku sdílené paměti,
+    přes frontu pak jde jen jméno bloku a délky.
+    """
+    payloads = [sequence.SerializeToString() for sequence in sequences]
+    block = shared_memory.SharedMemory(create=True, size=max(1, sum(map(len, payloads))))
+    offset = 0
+    for payload in payloads:
+        block.buf[offset:offset + len(payload)] = payload
+        offset += len(payload)
+    block.close()  # blok uvolní (unlink) až příjemce
+    return block.name, [len(payload) for payload in payloads]
+
+def read_handoff(handoff):
+    name, sizes = handoff
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        sequences = []
+        offset = 0
+        for size in sizes:
+            sequences.append(music_pb2.NoteSequence.FromString(bytes(block.buf[offset:offset + size])))
+            offset += size
+        return sequences
+    finally:
+        block.close()
+        block.unlink()
+
+def discard_handoff(handoff):
+    """Uvolní blok sdílené paměti, který už nikdo nepřečte."""
+    try:
+        block = shared_memory.SharedMemory(name=handoff[0])
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
+
+def inference_worker(worker_id, model, bundle_path, tasks, results):
+    """
+    Hlavní smyčka inferenčního procesu: drží zahřátý generátor jednoho modelu
+    a obsluhuje úlohy z vlastní fronty, dokud nedostane None.
+    """
+    try:
+        generator = ModelRegistry({model: bundle_path}, max_models=1).get(model)
+    except Exception as e:
+        results.put((worker_id, None, "failed", f"{type(e).__name__}: {e}"))
+        return
+    results.put((worker_id, None, "ready", None))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, kind, primer_bytes, plan, count, temperature, seed, stream_sections = task
+
+        def on_section(index, section, start, end, song):
+            results.put((worker_id, task_id, "section", (index, section, start, end, write_handoff([song]))))
+
+        try:
+            stats = {}
+            primer = music_pb2.NoteSequence.FromString(primer_bytes)
+            if kind == "long_form":
+                # Seed si nastavuje každé okno samo
+                sequences = generate_long_form(generator, primer, plan, temperature, seed, stats,
+                                               on_section if stream_sections else None)
+            else:
+                with seeded_random(seed):
+                    sequences = generate_melodies(generator, primer, plan, count, temperature, stats,
+                                                  on_section if stream_sections else None)
+            results.put((worker_id, task_id, "done", (write_handoff(sequences), stats)))
+        except Exception as e:
+            results.put((worker_id, task_id, "failed", f"{type(e).__name__}: {e}"))
+
+
+@dataclass
+class InferenceWorker:
+    id: str
+    model: str
+    process: object = None
+    tasks: object = None
+    status: str = "starting"  # starting → ready | failed; po pádu se proces spustí znovu
+    error: str = None
+    restarts: int = 0
+    inflight: set = field(default_factory=set)
+
+
+class InferencePool:
+    """
+    Procesy se zahřátými generátory melody_rnn mimo proces serveru.
+
+    • Každý proces drží jeden model a vlastní TensorFlow session, takže
+      inference neblokuje GIL serveru a využije víc jader.
+    • Úloha jde na proces, který má požadovaný model už načtený – vybírá se
+      ten s nejmenším počtem rozpracovaných úloh.
+    • Vygenerované NoteSequence se předávají přes sdílenou paměť, frontou
+      jde jen jméno bloku. Při streamovaném generování chodí stejnou cestou
+      i jednotlivé sekce. Spadlý proces se spustí znovu a jeho rozpracované
+      úlohy skončí chybou.
+    """
+
+    def __init__(self, bundle_paths, worker_counts):
+        self.bundle_paths = bundle_paths
+        self._context = multiprocessing.get_context("spawn")  # TensorFlow nesnese fork
+        self._results = self._context.Queue()
+        self._workers = {}
+        for model, count in worker_counts.items():
+            for index in range(1, count + 1):
+                worker_id = f"{INFERENCE_PROCESS_PREFIX}{model}-{index}"
+                self._workers[worker_id] = InferenceWorker(worker_id, model)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._settled = threading.Event()
+        self._collector = None
+
+    def _spawn(self, worker):
+        worker.tasks = self._context.Queue()
+        worker.status = "starting"
+        worker.process = self._context.Process(
+            target=inference_worker, name=worker.id, daemon=True,
+            args=(worker.id, worker.model, self.bundle_paths[worker.model], worker.tasks, self._results))
+        worker.process.start()
+
+    def start(self):
+        for worker in self._workers.values():
+            self._spawn(worker)
+        self._collector = threading.Thread(target=self._collect, name="inference-results", daemon=True)
+        self._collector.start()
+
+    def stop(self, timeout=5):
+        for worker in self._workers.values():
+            if worker.process is not None and worker.process.is_alive():
+                worker.tasks.put(None)
+        for worker in self._workers.values():
+            if worker.process is not None:
+                worker.process.join(timeout)
+
+    def serves(self, model):
+        return any(worker.model == model for worker in self._workers.values())
+
+    def _pick(self, model):
+        with self._lock:
+            candidates = [w for w in self._workers.values() if w.model == model and w.status != "failed"]
+            if not candidates:
+                raise GenerationError(f"Pro model '{model}' neběží žádný inferenční proces.", 503)
+            # Připravené procesy mají přednost, úloha pro startující proces počká ve frontě
+            return min(candidates, key=lambda w: (w.status != "ready", len(w.inflight)))
+
+    def generate(self, model, primer, plan, count, temperature=1.0, stats=None, on_section=None, seed=None,
+                 kind="melodies"):
+        """
+        Vygeneruje melodie v procesu modelu; `kind` "long_form" volá generate_long_form
+        (noty pak chodí jen po oknech přes on_section).
+        """
+        worker = self._pick(model)
+        task_id = uuid.uuid4().hex
+        replies = queue.Queue()
+        with self._lock:
+            self._pending[task_id] = (replies, worker)
+            worker.inflight.add(task_id)
+        worker.tasks.put((task_id, kind, primer.SerializeToString(), plan, count, temperature, seed,
+                          on_section is not None))
+
+        try:
+            while True:
+                status, payload = self._next_reply(worker, replies)
+                if status == "section":
+                    index, section, start, end, handoff = payload
+                    on_section(index, section, start, end, read_handoff(handoff)[0])
+                elif status == "failed":
+                    raise GenerationError(payload, 500)
+                else:
+                    break
+        except BaseException:
+            self._abandon(task_id, replies)
+            raise
+
+        handoff, worker_stats = payload
+        if stats is not None:
+            for key, value in worker_stats.items():
+                if isinstance(value, list):
+                    stats.setdefault(key, []).extend(value)
+                else:
+                    stats[key] = stats.get(key, 0) + value
+        return read_handoff(handoff)
+
+    def _next_reply(self, worker, replies):
+        """
+        Další odpověď úlohy; když proces nebo sběrné vlákno skončí nebo proces
+        mlčí déle než INFERENCE_TIMEOUT, skončí GenerationError.
+        """
+        waited = 0
+        while True:
+            try:
+                return replies.get(timeout=INFERENCE_POLL_SECONDS)
+            except queue.Empty:
+                waited += INFERENCE_POLL_SECONDS
+            if worker.process is None or not worker.process.is_alive():
+                raise GenerationError(f"Inferenční proces {worker.id} neočekávaně skončil.", 500)
+            if self._collector is None or not self._collector.is_alive():
+                raise GenerationError("Výsledky inferenčních procesů nikdo nepřebírá.", 500)
+            if INFERENCE_TIMEOUT and waited >= INFERENCE_TIMEOUT:
+                raise GenerationError(f"Inferenční proces {worker.id} neodpověděl do {INFERENCE_TIMEOUT:g} s.", 504)
+
+    def _abandon(self, task_id, replies):
+        # Úloha už nikoho nezajímá: pozdní odpovědi uvolní _reply, doručené uvolníme tady
+        with self._lock:
+            _, worker = self._pending.pop(task_id, (None, None))
+            if worker is not None:
+                worker.inflight.discard(task_id)
+        while True:
+            try:
+                status, payload = replies.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(status, payload)
+
+    @staticmethod
+    def _discard(status, payload):
+        if status == "section":
+            discard_handoff(payload[4])
+        elif status == "done":
+            discard_handoff(payload[0])
+
+    def _reply(self, task_id, status, payload):
+        with self._lock:
+            replies, worker = self._pending.get(task_id, (None, None))
+            if status != "section" and worker is not None:
+                del self._pending[task_id]
+                worker.inflight.discard(task_id)
+            if replies is not None:
+                # Pod zámkem, aby _abandon po odebrání úlohy vyzvedl i tuto odpověď
+                replies.put((status, payload))
+        if replies is None:
+            # Na úlohu už nikdo nečeká (chyba, timeout) – sdílená paměť by zůstala viset
+            self._discard(status, payload)
+
+    def _collect(self):
+        last_check = time.monotonic()
+        while True:
+            if time.monotonic() - last_check >= 1:
+                self._check_processes()
+                last_check = time.monotonic()
+            try:
+                worker_id, task_id, status, payload = self._results.get(timeout=1)
+            except queue.Empty:
+                continue
+            worker = self._workers[worker_id]
+            if task_id is None:
+                worker.status = status
+                worker.error = payload
+                print(f"Inferenční proces {worker_id}: {status}" + (f" ({payload})" if payload else ""))
+                self._update_settled()
+            elif status == "failed":
+                self._reply(task_id, status, f"Chyba při generování v procesu {worker_id}: {payload}")
+            else:
+                self._reply(task_id, status, payload)
+
+    def _check_processes(self):
+        for worker in self._workers.values():
+            if worker.process is None or worker.process.is_alive() or worker.status == "failed":
+                continue
+            with self._lock:
+                lost = list(worker.inflight)
+            for task_id in lost:
+                self._reply(task_id, "failed", f"Inferenční proces {worker.id} neočekávaně skončil.")
+            if worker.status == "ready":
+                worker.restarts += 1
+                print(f"Inferenční proces {worker.id} skončil (kód {worker.process.exitcode}), spouštím znovu")
+                self._spawn(worker)
+            else:
+                # Spadl už při načítání modelu – opakovaný start by dopadl stejně
+                worker.status = "failed"
+                worker.error = worker.error or f"proces skončil s kódem {worker.process.exitcode}"
+                self._update_settled()
+
+    def _update_settled(self):
+        if all(worker.status != "starting" for worker in self._workers.values()):
+            self._settled.set()
+
+    def wait_settled(self, timeout=None):
+        """
+        Počká, až všechny procesy načtou model (nebo selžou).
+        """
+        return self._settled.wait(timeout)
+
+    def unavailable_models(self):
+        models = {worker.model for worker in self._workers.values()}
+        ready = {worker.model for worker in self._workers.values() if worker.status == "ready"}
+        return sorted(models - ready)
+
+    def ready_count(self):
+        return sum(worker.status == "ready" for worker in self._workers.values())
+
+    def to_dict(self):
+        with self._lock:
+            return [{
+                "id": worker.id,
+                "model": worker.model,
+                "status": worker.status,
+                "error": worker.error,
+                "pid": worker.process.pid if worker.process is not None else None,
+                "restarts": worker.restarts,
+                "inflight": len(worker.inflight),
+            } for worker in self._workers.values()]
+
+
+def create_inference_pool():
+    worker_counts = parse_inference_workers(INFERENCE_WORKERS, BUNDLE_PATHS)
+    if IS_INFERENCE_WORKER or not worker_counts:
+        return None
+    return InferencePool(BUNDLE_PATHS, worker_counts)
+
+inference_pool = create_inference_pool()
+metrics.gauge("musicgen_inference_workers_ready", "Inferenční procesy s načteným modelem.",
+              lambda: inference_pool.ready_count() if inference_pool is not None else 0)
+
+class MelodyCache:
+    """
+    LRU vygenerovaných melodií (serializované NoteSequence) podle všeho, co
+    výsledek určuje – model, primer, plán, počet variant, teplota a seed.
+    Se stejným seedem je generování deterministické, opakovaný požadavek
+    tak model vůbec nevolá.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(model, primer, plan, count, temperature, seed):
+        primer_digest = hashlib.sha256(primer.SerializeToString()).hexdigest()
+        return model, primer_digest, tuple(plan), count, temperature, seed
+
+    def get(self, key):
+        with self._lock:
+            payloads = self._entries.get(key)
+            if payloads is not None:
+                self._entries.move_to_end(key)
+        MELODY_CACHE_LOOKUPS.inc(result="hit" if payloads is not None else "miss")
+        if payloads is None:
+            return None
+        return [music_pb2.NoteSequence.FromString(payload) for payload in payloads]
+
+    def put(self, key, sequences):
+        if self.max_entries <= 0:
+            return
+        payloads = [sequence.SerializeToString() for sequence in sequences]
+        with self._lock:
+            self._entries[key] = payloads
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+melody_cache = MelodyCache(MELODY_CACHE_SIZE)
+
+def infer_melodies(model, primer, plan, count, temperature=1.0, stats=None, on_section=None, seed=None):
+    """
+    Vygeneruje melodie – v inferenčním procesu modelu, pokud pro něj nějaký běží,
+    jinak přímo v tomto procesu přes model_registry. Melodie se seedem se
+    pamatují v melody_cache.
+    """
+    cache_key = MelodyCache.key_for(model, primer, plan, count, temperature, seed) if seed is not None else None
+    cached = melody_cache.get(cache_key) if cache_key is not None else None
+    if cached is not None:
+        if stats is not None:
+            stats["melody_cache_hits"] = stats.get("melody_cache_hits", 0) + 1
+        if on_section is not None:
+            # Sekce se vyberou z hotové melodie podle časů, streamování tak funguje i ze zásahu
+            for index, (section, start, end) in enumerate(plan):
+                on_section(index, section, start, end, cached[0])
+        return cached
+
+    if inference_pool is not None and inference_pool.serves(model):
+        melodies = inference_pool.generate(model, primer, plan, count, temperature, stats, on_section, seed)
+    else:
+        generator = get_generator(model)
+        with seeded_random(seed):
+            melodies = generate_melodies(generator, primer, plan, count, temperature, stats, on_section)
+
+    if cache_key is not None:
+        melody_cache.put(cache_key, melodies)
+    return melodies
+
+def infer_long_form(model, primer, plan, temperature=1.0, stats=None, on_section=None, seed=None):
+    """
+    Dlouhá skladba po oknech (generate_long_form) – v inferenčním procesu modelu,
+    pokud běží, jinak v tomto procesu. Do melody_cache se neukládá, celá
+    melodie se nikde nedrží.
+    """
+    if inference_pool is not None and inference_pool.serves(model):
+        inference_pool.generate(model, primer, plan, 1, temperature, stats, on_section, seed, kind="long_form")
+    else:
+        generate_long_form(get_generator(model), primer, plan, temperature, seed, stats, on_section)
+
+def get_generator(model):
+    try:
+        return model_registry.get(model)
+    except KeyError:
+        raise GenerationError(f"Model '{model}' nebyl nalezen.", 400)
+    except Exception as e:
+        raise GenerationError(f"Chyba při inicializaci modelu Magenta: {str(e)}", 500)
+# --- konec inferenčních procesů ------------------------------------------------
+
+# --- fronta generovacích úloh ----------------------------------------------
+JOB_STAGES = ["parse", "generate", "arrange", "midi", "render"]
+
+
+class GenerationError(Exception):
+    """Chyba generování, kterou lze vrátit klientovi i s HTTP kódem."""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class EventLog:
+    """
+    Číslované události jedné úlohy pro Server-Sent Events. Kdo se připojí
+    později (nebo po výpadku spojení s Last-Event-ID), dostane i starší události.
+    """
+
+    def __init__(self):
+        self._events = []
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def publish(self, name, data):
+        with self._condition:
+            self._events.append((name, data))
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def iter_events(self, start=0, timeout=15):
+        """
+        Vrací (pořadí, název, data); None, když do `timeout` nic nepřišlo (keep-alive).
+        """
+        index = start
+        while True:
+            with self._condition:
+                if index >= len(self._events) and not self._closed:
+                    self._condition.wait(timeout)
+                if index >= len(self._events):
+                    if self._closed:
+                        return
+                    event = None
+                else:
+                    event = (index, *self._events[index])
+            if event is None:
+                yield None
+                continue
+            index += 1
+            yield event
+
+
+class GenerationJob:
+    def __init__(self, payload):
+        self.id = uuid.uuid4().hex
+        self.payload = payload
+        self.status = "queued"          # queued → running → done / failed
+        self.stage = None
+        self.stages = {name: "pending" for name in JOB_STAGES}
+        self.timings = {}
+        self.result = None
+        self.error = None
+        self.error_status = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.streams = {}               # číslo varianty → PcmBroadcast během renderu
+        self.artifacts = {}             # název souboru → (bajty, MIME) pro neuložené výstupy
+        self.streams_ready = threading.Event()
+        self.finished = threading.Event()
+        self.events = EventLog()        # průběh pro /jobs/<id>/events
+        self._stage_started = None
+        self._lock = threading.Lock()
+
+    def enter_stage(self, name):
+        """Uzavře právě běžící fázi (změří její délku) a začne další."""
+        now = time.perf_counter()
+        with self._lock:
+            if self.stage is not None:
+                self.stages[self.stage] = "done"
+                self.timings[self.stage] = round(now - self._stage_started, 4)
+                STAGE_SECONDS.observe(now - self._stage_started, stage=self.stage)
+            self.stage = name
+            self._stage_started = now
+            if name is not None:
+                self.stages[name] = "running"
+        if name is not None:
+            self.events.publish("stage", self.to_dict())
+
+    def finish(self, result):
+        self.enter_stage(None)
+        with self._lock:
+            self.result = result
+            self.status = "done"
+            self.finished_at = time.time()
+        self.events.publish("done", result)
+        self.events.close()
+        self.streams_ready.set()
+        self.finished.set()
+
+    def fail(self, message, status=500):
+        with self._lock:
+            if self.stage is not None:
+                self.stages[self.stage] = "failed"
+            self.error = message
+            self.error_status = status
+            self.status = "failed"
+            self.finished_at = time.time()
+            streams = list(self.streams.values())
+            self.streams.clear()
+        for stream in streams:
+            stream.close()
+        # "error" nepoužíváme – ten název má v EventSource vlastní význam (chyba spojení)
+        self.events.publish("failed", {"error": message, "status": status})
+        self.events.close()
+        self.streams_ready.set()
+        self.finished.set()
+
+    def to_dict(self):
+        with self._lock:
+            done = sum(1 for state in self.stages.values() if state == "done")
+            return {
+                "job_id": self.id,
+                "status": self.status,
+                "stage": self.stage,
+                "stages": dict(self.stages),
+                "progress": round(done / len(self.stages), 2),
+                "timings": dict(self.timings),
+                "error": self.error,
+                "status_url": f"/jobs/{self.id}",
+                "events_url": f"/jobs/{self.id}/events",
+                "result_url": f"/jobs/{self.id}/result",
+            }
+
+
+def parse_pipeline_workers(spec, defaults):
+    """
+    "generate:2,render:3" → počty vláken fází; neuvedené fáze mají hodnotu
+    z `defaults`. Neznámá fáze je chyba konfigurace.
+    """
+    counts = dict(defaults)
+    for item in spec.split(","):
+        stage, _, count = item.strip().partition(":")
+        if not stage:
+            continue
+        if stage not in counts:
+            raise ValueError(f"PIPELINE_WORKERS: neznámá fáze '{stage}'")
+        counts[stage] = max(1, int(count or 1))
+    return counts
+
+
+class JobManager:
+    """
+    Omezená fronta úloh zpracovávaná po fázích (pipeline).
+
+    • Každá fáze (`stages`: název → počet vláken) má vlastní vlákna a před
+      sebou frontu; fronty mezi fázemi mají nejvýše `stage_queue_size` míst.
+      Zatímco jedna úloha renderuje, další už generuje melodii. Plná fronta
+      zastaví předchozí fázi (backpressure), úlohy se tak nehromadí v paměti.
+    • Runner je generátor: `yield "fáze"` předá úlohu do fronty další fáze
+      a `return` vrací výsledek. Fáze, která vlastní vlákna nemá, běží dál
+      ve stejném vlákně; obyčejná funkce doběhne celá v první fázi.
+    • Rozpracovaných úloh je nejvýše tolik, kolik pojmou fáze a fronty mezi
+      nimi (`slots`), dalších `queue_limit` smí čekat na první fázi. Nad tento
+      limit se nové úlohy odmítají (JobQueueFull → HTTP 503).
+    • Hotové úlohy se drží v paměti, dokud jich není víc než `retention`.
+    """
+
+    def __init__(self, runner, workers=2, queue_limit=16, retention=200, stages=None,
+                 stage_queue_size=PIPELINE_QUEUE_SIZE):
+        self.runner = runner
+        self.stages = {stage: max(1, count) for stage, count in (stages or {"generate": workers}).items()}
+        self.slots = sum(self.stages.values()) + (len(self.stages) - 1) * max(1, stage_queue_size)
+        self.capacity = self.slots + max(0, queue_limit)
+        self.retention = retention
+        first_stage = next(iter(self.stages))
+        self._queues = {stage: queue.Queue() if stage == first_stage else queue.Queue(max(1, stage_queue_size))
+                        for stage in self.stages}
+        self._busy = dict.fromkeys(self.stages, 0)
+        self._jobs = OrderedDict()
+        self._active = 0
+        self._lock = threading.Lock()
+        for stage, count in self.stages.items():
+            for index in range(count):
+                threading.Thread(target=self._work, args=(stage,), name=f"{stage}-{index + 1}", daemon=True).start()
+
+    def submit(self, payload):
+        job = GenerationJob(payload)
+        with self._lock:
+            if self._active >= self.capacity:
+                raise JobQueueFull()
+            self._active += 1
+            self._jobs[job.id] = job
+            self._prune()
+        self._queues[next(iter(self.stages))].put((job, None, time.perf_counter()))
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _advance(self, job, steps):
+        """
+        Spustí úlohu do další fáze, která má vlastní vlákna; vrací (runner, fáze),
+        nebo (None, None), když je úloha hotová.
+        """
+        if steps is None:
+            job.status = "running"
+            steps = self.runner(job.payload, job)
+            if not hasattr(steps, "__next__"):
+                job.finish(steps)
+                return None, None
+        while True:
+            try:
+                stage = next(steps)
+            except StopIteration as done:
+                job.finish(done.value)
+                return None, None
+            if stage in self._queues:
+                return steps, stage
+
+    def _work(self, stage):
+        stage_queue = self._queues[stage]
+        while True:
+            job, steps, queued_at = stage_queue.get()
+            PIPELINE_WAIT_SECONDS.observe(time.perf_counter() - queued_at, stage=stage)
+            with self._lock:
+                self._busy[stage] += 1
+            started = time.perf_counter()
+            next_stage = None
+            try:
+                steps, next_stage = self._advance(job, steps)
+            except GenerationError as e:
+                job.fail(e.message, e.status)
+            except Exception as e:
+                job.fail(f"Neočekávaná chyba při generování: {str(e)}", 500)
+            finally:
+                PIPELINE_BUSY_SECONDS.inc(time.perf_counter() - started, stage=stage)
+                with self._lock:
+                    self._busy[stage] -= 1
+
+            if next_stage is not None:
+                # Čekání ve frontě další fáze se do doby fáze nepočítá
+                job.enter_stage(None)
+                self._queues[next_stage].put((job, steps, time.perf_counter()))
+                continue
+            JOBS_TOTAL.inc(status=job.status)
+            with self._lock:
+                self._active -= 1
+
+    @property
+    def active(self):
+        with self._lock:
+            return self._active
+
+    def queue_depths(self):
+        return {stage: stage_queue.qsize() for stage, stage_queue in self._queues.items()}
+
+    def utilization(self):
+        """Podíl právě pracujících vláken každé fáze."""
+        with self._lock:
+            return {stage: round(self._busy[stage] / self.stages[stage], 3) for stage in self.stages}
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in ("done", "failed")]
+        for job_id in finished[:max(0, len(self._jobs) - self.retention)]:
+            del self._jobs[job_id]
+# --- konec fronty úloh ------------------------------------------------------
+
+# --- úložiště výstupů -------------------------------------------------------
+
+# Typy, které mimetypes v základu nezná (nebo zná pod jiným názvem)
+mimetypes.add_type("audio/midi", ".mid")
+mimetypes.add_type("audio/flac", ".flac")
+mimetypes.add_type("audio/ogg", ".opus")
+
+@dataclass(frozen=True)
+class StoredObject:
+    size: int
+    etag: str
+    content_type: str
+    modified: datetime | None = None
+
+def artifact_key(filename, data=None, now=None, digest=None):
+    """
+    Klíč uloženého souboru: YYYY/MM/DD/<hash obsahu>/<název>.
+    Stejný název s jiným obsahem se nikdy nepřepíše, stejný obsah se uloží jednou.
+    U velkých souborů se místo `data` předá hotový `digest`.
+    """
+    now = now or datetime.now()
+    digest = (digest or hashlib.sha256(data).hexdigest())[:32]
+    return f"{now:%Y/%m/%d}/{digest}/{secure_filename(filename) or 'output'}"
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def key_etag(key):
+    """Obsahový hash z klíče (pro starší ploché názvy souborů None)."""
+    parts = key.split("/")
+    return parts[-2] if len(parts) >= 2 and re.fullmatch(r"[0-9a-f]{32}", parts[-2]) else None
+
+def content_type_for(key):
+    return mimetypes.guess_type(key)[0] or "application/octet-stream"
+
+class LocalStorage:
+    """
+    Soubory na lokálním disku pod `root`, rozdělené do adresářů podle data
+    a hashe obsahu. Starší ploché názvy v kořeni zůstávají čitelné.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise KeyError(key)
+        return path
+
+    def put(self, filename, data):
+        key = artifact_key(filename, data)
+        path = self._path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # zápis přes dočasný soubor, aby nikdo nečetl rozepsaný soubor
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return key
+
+    def put_file(self, filename, source_path):
+        """Uloží hotový soubor bez načtení do paměti; zdrojový soubor se přesune."""
+        key = artifact_key(filename, digest=file_sha256(source_path))
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(source_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            shutil.move(source_path, tmp_path)
+            os.replace(tmp_path, path)
+        return key
+
+    def stat(self, key):
+        try:
+            st = os.stat(self._path(key))
+        except (KeyError, OSError):
+            return None
+        # adresáře (datové podadresáře klíčů) nejsou ke stažení
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        etag = key_etag(key) or f"{st.st_size:x}-{st.st_mtime_ns:x}"
+        return StoredObject(st.st_size, etag, content_type_for(key), datetime.fromtimestamp(st.st_mtime))
+
+    def exists(self, key):
+        return self.stat(key) is not None
+
+    def read(self, key, start=0, end=None, chunk_size=64 * 1024):
+        """Vrací bajty [start, end) po blocích."""
+        with open(self._path(key), "rb") as f:
+            f.seek(start)
+            remaining = None if end is None else end - start
+            while remaining is None or remaining > 0:
+                chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def local_path(self, key):
+        return self._path(key)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except (KeyError, FileNotFoundError):
+            pass
+
+class S3Storage:
+    """
+    Úložiště kompatibilní s S3 (AWS, MinIO...). Přístupové údaje bere boto3
+    z prostředí, `endpoint_url` míří na vlastní server, např. lokální MinIO.
+    """
+
+    def __init__(self, bucket, prefix="", endpoint_url=None):
+        if boto3 is None:
+            raise RuntimeError("Pro STORAGE_BACKEND=s3 je potřeba knihovna boto3.")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def _head(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def put(self, filename, data):
+        key = artifact_key(filename, data)
+        if self._head(key) is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data,
+                                   ContentType=content_type_for(key))
+        return key
+
+    def put_file(self, filename, source_path):
+        """Nahraje hotový soubor po částech (multipart) a lokální kopii smaže."""
+        key = artifact_key(filename, digest=file_sha256(source_path))
+        if self._head(key) is None:
+            self.client.upload_file(source_path, self.bucket, self.prefix + key,
+                                    ExtraArgs={"ContentType": content_type_for(key)})
+        os.remove(source_path)
+        return key
+
+    def stat(self, key):
+        head = self._head(key)
+        if head is None:
+            return None
+        etag = key_etag(key) or head["ETag"].strip('"')
+        return StoredObject(head["ContentLength"], etag,
+                            head.get("ContentType") or content_type_for(key), head.get("LastModified"))
+
+    def exists(self, key):
+        return self.stat(key) is not None
+
+    def read(self, key, start=0, end=None, chunk_size=64 * 1024):
+        kwargs = {}
+        if start or end is not None:
+            kwargs["Range"] = f"bytes={start}-{'' if end is None else end - 1}"
+        body = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key, **kwargs)["Body"]
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+
+    def local_path(self, key):
+        return None
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+def create_storage():
+    if STORAGE_BACKEND == "s3":
+        return S3Storage(S3_BUCKET, S3_PREFIX, S3_ENDPOINT_URL)
+    return LocalStorage(OUTPUT_DIR)
+
+artifact_storage = create_storage()
+
+# Soubory s hashem obsahu v klíči se nikdy nemění – prohlížeč je může držet napořád.
+# Ostatní (starší ploché názvy) si musí ověřit přes ETag.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+def send_artifact(info, read, filename, cache_control):
+    """
+    Odpověď se souborem popsaným StoredObject. Podporuje If-None-Match (304),
+    jeden rozsah z hlavičky Range (206) i If-Range. Soubor se přehrává
+    v prohlížeči (inline), s ?download=1 se nabídne ke stažení.
+    `read(start, end)` vrací bajty [start, end) po blocích.
+    """
+    if request.if_none_match.contains(info.etag):
+        response = Response(status=304)
+        response.set_etag(info.etag)
+        response.headers["Cache-Control"] = cache_control
+        return response
+
+    byte_range = request.range
+    # If-Range: rozsah platí jen pro nezměněnou verzi souboru
+    if byte_range is not None and request.if_range.etag is not None and request.if_range.etag != info.etag:
+        byte_range = None
+    span = byte_range.range_for_length(info.size) if byte_range is not None else None
+
+    if byte_range is not None and span is None:
+        response = Response(status=416)
+        response.headers["Content-Range"] = f"bytes */{info.size}"
+        return response
+
+    start, end = span or (0, info.size)
+    response = Response(stream_with_context(read(start, end)),
+                        status=206 if span else 200, mimetype=info.content_type)
+    response.headers["Content-Length"] = str(end - start)
+    if span:
+        response.headers["Content-Range"] = byte_range.to_content_range_header(info.size)
+    response.headers["Accept-Ranges"] = "bytes"
+    response.headers["Cache-Control"] = cache_control
+    response.set_etag(info.etag)
+    if info.modified is not None:
+        response.last_modified = info.modified
+    disposition = "attachment" if request.args.get("download") else "inline"
+    response.headers["Content-Disposition"] = f'{disposition}; filename="{filename}"'
+    return response
+
+def serve_stored(key):
+    try:
+        info = artifact_storage.stat(key)
+    except KeyError:
+        info = None
+    if info is None:
+        return jsonify({"error": "Soubor nebyl nalezen."}), 404
+    cache_control = IMMUTABLE_CACHE_CONTROL if key_etag(key) else REVALIDATE_CACHE_CONTROL
+    return send_artifact(info, lambda start, end: artifact_storage.read(key, start, end),
+                         key.rsplit("/", 1)[-1], cache_control)
+
+# --- konec úložiště výstupů -------------------------------------------------
+
+# --- renderování zvuku ---------------------------------------------------
+DRUM_CHANNEL = 9
+
+def note_channels(notes):
+    """
+    Přiřadí MIDI kanály vrstvám skladby (pole NOTE_DTYPE) stejně jako pretty_midi
+    při zápisu MIDI: bicí jdou na kanál 9, ostatní dvojice (instrument, program)
+    postupně na 0–15 v pořadí prvního výskytu.
+    """
+    channels = {}
+    free_channels = [c for c in range(16) if c != DRUM_CHANNEL]
+    melodic_count = 0
+    for key in zip(notes["instrument"].tolist(), notes["program"].tolist(), notes["is_drum"].tolist()):
+        if key in channels:
+            continue
+        if key[2]:
+            channels[key] = DRUM_CHANNEL
+        else:
+            channels[key] = free_channels[melodic_count % len(free_channels)]
+            melodic_count += 1
+    return channels
+
+def note_events(notes):
+    """
+    Převede noty NOTE_DTYPE na časově seřazené MIDI události (čas, typ, kanál, výška, síla).
+    Při shodném čase jde note-off před note-on, aby se opakovaný tón neutnul.
+    """
+    channels = note_channels(notes)
+    note_channel = np.array([channels[key] for key in zip(notes["instrument"].tolist(), notes["program"].tolist(),
+                                                          notes["is_drum"].tolist())], dtype=np.int64)
+    count = len(notes)
+    times = np.concatenate([notes["end"], notes["start"]])
+    kinds = np.repeat([0, 1], count)
+    event_channels = np.concatenate([note_channel, note_channel])
+    pitches = np.concatenate([notes["pitch"], notes["pitch"]]).astype(np.int64)
+    velocities = np.concatenate([np.zeros(count, dtype=np.int64), notes["velocity"].astype(np.int64)])
+    order = np.lexsort((velocities, pitches, event_channels, kinds, times))
+    events = list(zip(times[order].tolist(), kinds[order].tolist(), event_channels[order].tolist(),
+                      pitches[order].tolist(), velocities[order].tolist()))
+    return channels, events
+
+# Přímý zápis Standard MIDI File (formát 1) z NoteSequence nebo z pole not
+# NOTE_DTYPE – bez mezikroku přes pretty_midi a jeho objekt pro každou notu.
+MIDI_TICKS_PER_QUARTER = 220
+DEFAULT_QPM = 120.0
+
+def sequence_note_array(note_sequence):
+    notes = np.empty(len(note_sequence.notes), dtype=NOTE_DTYPE)
+    if len(notes):
+        notes[:] = [(n.pitch, n.start_time, n.end_time, n.velocity, n.program, n.instrument, n.is_drum)
+                    for n in note_sequence.notes]
+    return notes
+
+def tempo_map(tempos):
+    """
+    Seřazená tempová mapa (časy, qpm) začínající v čase 0; při více změnách
+    ve stejném čase platí poslední, bez tempa na začátku se hraje 120 qpm.
+    """
+    changes = {0.0: DEFAULT_QPM}
+    for time_, qpm in sorted(tempos, key=lambda tempo: tempo[0]):
+        changes[max(0.0, float(time_))] = float(qpm)
+    times = np.array(sorted(changes))
+    return times, np.array([changes[t] for t in times])
+
+def seconds_to_ticks(seconds, tempo_times, tempo_qpms, ticks_per_quarter):
+    ticks_per_second = tempo_qpms / 60.0 * ticks_per_quarter
+    ticks_at_change = np.concatenate([[0.0], np.cumsum(np.diff(tempo_times) * ticks_per_second[:-1])])
+    index = np.searchsorted(tempo_times, seconds, side="right") - 1
+    return np.round(ticks_at_change[index] + (seconds - tempo_times[index]) * ticks_per_second[index]).astype(np.int64)
+
+def midi_varlen(value):
+    data = [value & 0x7F]
+    value >>= 7
+    while value:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(data))
+
+def encode_track_events(ticks, messages):
+    """
+    Seřazené události stopy (tick, trojice bajtů zprávy) → data MTrk.
+    Delta časy se kódují jako variable-length quantity najednou pro celé pole.
+    """
+    deltas = np.diff(ticks, prepend=0).astype(np.uint32)
+    rows = np.column_stack([
+        (deltas >> 21) & 0x7F | 0x80,
+        (deltas >> 14) & 0x7F | 0x80,
+        (deltas >> 7) & 0x7F | 0x80,
+        deltas & 0x7F,
+        messages,
+    ]).astype(np.uint8)
+    keep = np.column_stack([deltas >= 1 << 21, deltas >= 1 << 14, deltas >= 1 << 7]
+                           + [np.ones(len(deltas), dtype=bool)] * 4)
+    return rows[keep].tobytes()
+
+def midi_chunk(kind, data):
+    return kind + len(data).to_bytes(4, "big") + data
+
+def midi_bytes(notes, tempos=(), ticks_per_quarter=MIDI_TICKS_PER_QUARTER):
+    """
+    Pole not NOTE_DTYPE a tempa [(čas v s, qpm)] → bajty MIDI souboru.
+    Každá vrstva (instrument, program, is_drum) má vlastní stopu a kanál
+    podle stejného pravidla jako note_channels, bicí hrají na kanálu 9.
+    """
+    tempo_times, tempo_qpms = tempo_map(tempos)
+    start_ticks = seconds_to_ticks(notes["start"], tempo_times, tempo_qpms, ticks_per_quarter)
+    # nulová délka by se po seřazení (note-off před note-on) rozezněla natrvalo
+    end_ticks = np.maximum(seconds_to_ticks(notes["end"], tempo_times, tempo_qpms, ticks_per_quarter), start_ticks + 1)
+
+    # Stopa 0: tempová mapa
+    tempo_ticks = seconds_to_ticks(tempo_times, tempo_times, tempo_qpms, ticks_per_quarter)
+    tempo_track = bytearray()
+    previous = 0
+    for tick, qpm in zip(tempo_ticks.tolist(), tempo_qpms.tolist()):
+        tempo_track += midi_varlen(tick - previous) + b"\xff\x51\x03" + int(round(60e6 / qpm)).to_bytes(3, "big")
+        previous = tick
+    tempo_track += b"\x00\xff\x2f\x00"
+    tracks = [bytes(tempo_track)]
+
+    layer_keys = np.stack([notes["instrument"], notes["program"], notes["is_drum"]], axis=1).astype(np.int64)
+    keys, first_index, layer_of_note = np.unique(layer_keys, axis=0, return_index=True, return_inverse=True)
+    layer_of_note = layer_of_note.ravel()
+    free_channels = [c for c in range(16) if c != DRUM_CHANNEL]
+    melodic_count = 0
+    for layer in np.argsort(first_index):
+        instrument, program, is_drum = keys[layer].tolist()
+        if is_drum:
+            channel = DRUM_CHANNEL
+        else:
+            channel = free_channels[melodic_count % len(free_channels)]
+            melodic_count += 1
+
+        selected = layer_of_note == layer
+        pitches = np.clip(notes["pitch"][selected], 0, 127)
+        velocities = np.clip(notes["velocity"][selected], 1, 127)
+        count = len(pitches)
+        # v jednom ticku jde note-off před note-on, aby se opakovaný tón neutnul
+        ticks = np.concatenate([end_ticks[selected], start_ticks[selected]])
+        order = np.repeat([0, 1], count)
+        messages = np.column_stack([
+            np.repeat([0x80 | channel, 0x90 | channel], count),
+            np.concatenate([pitches, pitches]),
+            np.concatenate([np.zeros(count, dtype=np.int64), velocities]),
+        ])
+        sort = np.lexsort((messages[:, 1], order, ticks))
+        program_change = bytes([0x00, 0xC0 | channel, program & 0x7F])
+        events = program_change + encode_track_events(ticks[sort], messages[sort])
+        tracks.append(events + midi_varlen(0) + b"\xff\x2f\x00")
+
+    header = (1).to_bytes(2, "big") + len(tracks).to_bytes(2, "big") + ticks_per_quarter.to_bytes(2, "big")
+    return midi_chunk(b"MThd", header) + b"".join(midi_chunk(b"MTrk", track) for track in tracks)
+
+def sequence_to_midi_bytes(note_sequence):
+    tempos = [(tempo.time, tempo.qpm) for tempo in note_sequence.tempos]
+    return midi_bytes(sequence_note_array(note_sequence), tempos,
+                      note_sequence.ticks_per_quarter or MIDI_TICKS_PER_QUARTER)
+
+def write_midi(note_sequence, path_or_buffer):
+    """
+    Zapíše NoteSequence jako MIDI do souboru nebo do otevřeného binárního
+    bufferu (např. io.BytesIO) a vrátí zapsané bajty.
+    """
+    data = sequence_to_midi_bytes(note_sequence)
+    if hasattr(path_or_buffer, "write"):
+        path_or_buffer.write(data)
+    else:
+        with open(path_or_buffer, "wb") as midi_file:
+            midi_file.write(data)
+    return data
+
+class EventScheduler:
+    """
+    Převádí noty přicházející po oknech na časově seřazené MIDI události
+    (čas, typ, kanál, výška, síla) jako note_events. Události za koncem
+    okna (hlavně note-off) čekají na další okno, v paměti je tak jen to, co
+    ještě zní. Noty přidané později nesmí začínat před koncem minulého okna.
+    Kanály se přidělují podle note_channels v pořadí prvního výskytu;
+    nové kanály (kanál, program, bicí) vrací add() zvlášť pro program change.
+    """
+
+    # note-off musí padnout až za note-on i po převodu na ticky
+    MIN_DURATION = 0.01
+
+    def __init__(self):
+        self.channels = {}
+        self._pending = []  # halda čekajících note-off událostí
+
+    def _channel(self, key, new_channels):
+        channel = self.channels.get(key)
+        if channel is None:
+            free_channels = [c for c in range(16) if c != DRUM_CHANNEL]
+            melodic_count = sum(1 for instrument, program, is_drum in self.channels if not is_drum)
+            channel = DRUM_CHANNEL if key[2] else free_channels[melodic_count % len(free_channels)]
+            self.channels[key] = channel
+            new_channels.append((channel, key[1], key[2]))
+        return channel
+
+    def add(self, notes, horizon):
+        """
+        Noty NOTE_DTYPE → (nové kanály, všechny čekající události před `horizon`).
+        """
+        new_channels = []
+        columns = [notes[name].tolist() for name in ("pitch", "start", "end", "velocity", "program",
+                                                      "instrument", "is_drum")]
+        for pitch, start, end, velocity, program, instrument, is_drum in zip(*columns):
+            channel = self._channel((instrument, program, bool(is_drum)), new_channels)
+            pitch = min(max(pitch, 0), 127)
+            heapq.heappush(self._pending, (start, 1, channel, pitch, min(max(velocity, 1), 127)))
+            heapq.heappush(self._pending, (max(end, start + self.MIN_DURATION), 0, channel, pitch, 0))
+        events = []
+        while self._pending and self._pending[0][0] < horizon:
+            events.append(heapq.heappop(self._pending))
+        return new_channels, events
+
+    def flush(self):
+        """Zbylé události (konec skladby)."""
+        events = sorted(self._pending)
+        self._pending = []
+        return events
+
+
+class IncrementalMidiWriter:
+    """
+    Standard MIDI File (formát 0, jedna stopa) zapisovaný po částech přímo do
+    souboru. Délka stopy se doplní do hlavičky až při close(), takže se
+    v paměti nikdy nedrží celá skladba.
+    """
+
+    def __init__(self, path, qpm=DEFAULT_QPM, ticks_per_quarter=MIDI_TICKS_PER_QUARTER):
+        self._file = open(path, "wb")
+        self._ticks_per_second = qpm / 60.0 * ticks_per_quarter
+        self._last_tick = 0
+        header = (0).to_bytes(2, "big") + (1).to_bytes(2, "big") + ticks_per_quarter.to_bytes(2, "big")
+        self._file.write(midi_chunk(b"MThd", header) + b"MTrk\x00\x00\x00\x00")
+        self._track_start = self._file.tell()
+        self._file.write(b"\x00\xff\x51\x03" + int(round(60e6 / qpm)).to_bytes(3, "big"))
+
+    def _ticks(self, seconds):
+        ticks = np.round(np.asarray(seconds, dtype=np.float64) * self._ticks_per_second).astype(np.int64)
+        # události přicházejí seřazené, zaokrouhlení je nesmí poslat zpět v čase
+        return np.maximum(ticks, self._last_tick)
+
+    def program_change(self, time_s, channel, program):
+        tick = int(self._ticks([time_s])[0])
+        self._file.write(midi_varlen(tick - self._last_tick) + bytes([0xC0 | channel, program & 0x7F]))
+        self._last_tick = tick
+
+    def write(self, events):
+        """Seřazené události (čas, typ, kanál, výška, síla) navazující na předchozí."""
+        if not events:
+            return
+        times, is_on, channels, pitches, velocities = (np.array(column) for column in zip(*events))
+        ticks = np.maximum.accumulate(self._ticks(times))
+        # v jednom ticku jde note-off před note-on, aby se opakovaný tón neutnul
+        order = np.lexsort((is_on, ticks))
+        messages = np.column_stack([np.where(is_on == 1, 0x90, 0x80) | channels, pitches, velocities])[order]
+        self._file.write(encode_track_events(ticks[order] - self._last_tick, messages))
+        self._last_tick = int(ticks[-1])
+
+    def close(self):
+        self._file.write(b"\x00\xff\x2f\x00")
+        length = self._file.tell() - self._track_start
+        self._file.seek(self._track_start - 4)
+        self._file.write(length.to_bytes(4, "big"))
+        self._file.close()
+
+def write_wav(path, pcm, sample_rate=SAMPLE_RATE):
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(2)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm.astype("<i2").tobytes())
+
+def read_wav(path):
+    with wave.open(path, "rb") as wav_file:
+        frames = wav_file.readframes(wav_file.getnframes())
+        pcm = np.frombuffer(frames, dtype="<i2").reshape(-1, wav_file.getnchannels())
+    return pcm
+
+def encode_wav(pcm, sample_rate=SAMPLE_RATE):
+    buffer = io.BytesIO()
+    write_wav(buffer, pcm, sample_rate)
+    return buffer.getvalue()
+
+def encode_flac(pcm, sample_rate=SAMPLE_RATE):
+    buffer = io.BytesIO()
+    soundfile.write(buffer, pcm, sample_rate, format="FLAC", subtype="PCM_16")
+    return buffer.getvalue()
+
+def encode_compressed(pcm, sample_rate, audio_format, bitrate):
+    # MP3 a Opus kóduje pydub přes ffmpeg
+    segment = AudioSegment(data=pcm.astype("<i2").tobytes(), sample_width=2,
+                           frame_rate=sample_rate, channels=pcm.shape[1])
+    buffer = io.BytesIO()
+    segment.export(buffer, format=audio_format, bitrate=bitrate)
+    return buffer.getvalue()
+
+def encode_mp3(pcm, sample_rate=SAMPLE_RATE):
+    return encode_compressed(pcm, sample_rate, "mp3", MP3_BITRATE)
+
+def encode_opus(pcm, sample_rate=SAMPLE_RATE):
+    return encode_compressed(pcm, sample_rate, "opus", OPUS_BITRATE)
+
+class StreamingAudioWriter:
+    """
+    Zápis PCM po blocích rovnou do souboru – WAV a FLAC přes soundfile,
+    MP3 a Opus rourou do ffmpeg (stejného, kterého volá pydub). Pro dlouhé
+    skladby, které by se jako celek do paměti nevešly.
+    """
 
+    def __init__(self, path, audio_format, sample_rate=SAMPLE_RATE, channels=2):
+        self.path = path
+        self.audio_format = audio_format
+        self._file = None
+        self._process = None
+        if audio_format in ("wav", "flac"):
+            self._file = soundfile.SoundFile(path, "w", samplerate=sample_rate, channels=channels,
+                                             format=audio_format.upper(), subtype="PCM_16")
+        else:
+            bitrate = MP3_BITRATE if audio_format == "mp3" else OPUS_BITRATE
+            self._process = subprocess.Popen([
+                AudioSegment.converter, "-y", "-loglevel", "error",
+                "-f", "s16le", "-ar", str(sample_rate), "-ac", str(channels), "-i", "pipe:0",
+                "-b:a", bitrate, "-f", audio_format, path,
+            ], stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, pcm):
+        if self._file is not None:
+            self._file.write(pcm)
+        else:
+            self._process.stdin.write(pcm.astype("<i2").tobytes())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            return
+        self._process.stdin.close()
+        error = self._process.stderr.read().decode("utf-8", "replace")
+        if self._process.wait() != 0:
+            raise GenerationError(f"Chyba při kódování zvuku do formátu {self.audio_format}: {error}", 500)
+
+# formát → (kodér, přípona souboru, MIME typ)
+AUDIO_ENCODERS = {
+    "wav": (encode_wav, "wav", "audio/wav"),
+    "flac": (encode_flac, "flac", "audio/flac"),
+    "mp3": (encode_mp3, "mp3", "audio/mpeg"),
+    "opus": (encode_opus, "opus", "audio/ogg"),
+}
+
+def parse_audio_formats(formats, preview_format):
+    """
+    Ověří požadované formáty (seznam nebo text "flac,mp3") a vrátí je
+    i s formátem náhledu, který se ukládá vždy.
+    """
+    if isinstance(formats, str):
+        formats = formats.split(",")
+    formats = [f.strip().lower() for f in (formats or AUDIO_FORMATS) if f.strip()]
+    preview_format = (preview_format or PREVIEW_FORMAT).strip().lower()
+    unknown = [f for f in formats + [preview_format] if f not in AUDIO_ENCODERS]
+    if unknown:
+        raise GenerationError(f"Nepodporovaný zvukový formát: {', '.join(unknown)}. "
+                              f"Dostupné: {', '.join(AUDIO_ENCODERS)}", 400)
+    if preview_format not in formats:
+        formats.append(preview_format)
+    return formats, preview_format
+
+def encode_audio(pcm, audio_format, sample_rate=SAMPLE_RATE):
+    encoder = AUDIO_ENCODERS[audio_format][0]
+    try:
+        return encoder(pcm, sample_rate)
+    except Exception as e:
+        raise GenerationError(f"Chyba při kódování zvuku do formátu {audio_format}: {str(e)}", 500)
+
+def wav_header(frames, sample_rate=SAMPLE_RATE, channels=2):
+    """
+    Hlavička 16bitového WAV pro streamování. Když délka ještě není známá
+    (frames=None), uvede se maximální velikost – prohlížeče to snesou.
+    """
+    block_align = channels * 2
+    data_size = frames * block_align if frames is not None else 0xFFFFFFFF - 36
+    return b"".join([
+        b"RIFF", (36 + data_size).to_bytes(4, "little"), b"WAVE",
+        b"fmt ", (16).to_bytes(4, "little"), (1).to_bytes(2, "little"),
+        channels.to_bytes(2, "little"), sample_rate.to_bytes(4, "little"),
+        (sample_rate * block_align).to_bytes(4, "little"), block_align.to_bytes(2, "little"),
+        (16).to_bytes(2, "little"),
+        b"data", data_size.to_bytes(4, "little"),
+    ])
+
+class PcmBroadcast:
+    """
+    Průběžně renderované PCM jedné skladby, ze kterého může číst víc posluchačů.
+    Render bloky zveřejňuje přes publish(), streamy je čtou přes iter_blocks().
+    """
+
+    def __init__(self, frames=None, sample_rate=SAMPLE_RATE):
+        self.frames = frames
+        self.sample_rate = sample_rate
+        self._blocks = []
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def publish(self, block):
+        with self._condition:
+            self._blocks.append(block)
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def iter_blocks(self, timeout=60):
+        index = 0
+        while True:
+            with self._condition:
+                while index >= len(self._blocks) and not self._closed:
+                    if not self._condition.wait(timeout):
+                        return
+                if index >= len(self._blocks):
+                    return
+                block = self._blocks[index]
+            index += 1
+            yield block
+
+class FluidSynthRenderer:
+    """
+    Renderuje NoteSequence do PCM v paměti přes trvale běžící pyfluidsynth.
+
+    SoundFont se načte jen jednou při vytvoření syntezátoru, takže délka
+    renderu už nezahrnuje parsování stovek MB souboru. Syntezátor není
+    vláknově bezpečný – pro souběžné rendery se drží pool `pool_size` instancí.
+    """
+
+    def __init__(self, soundfont, sample_rate=SAMPLE_RATE, pool_size=1):
+        self.soundfont = soundfont
+        self.sample_rate = sample_rate
+        self.pool_size = max(1, pool_size)
+        self._pool = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _create_synth(self):
+        if fluidsynth is None:
+            raise GenerationError("Knihovna pyfluidsynth není dostupná, nastavte RENDER_BACKEND=subprocess.", 500)
+        if not os.path.exists(self.soundfont):
+            raise GenerationError(f"SoundFont soubor nebyl nalezen na absolutní cestě: {os.path.abspath(self.soundfont)}", 500)
+        synth = fluidsynth.Synth(samplerate=float(self.sample_rate))
+        sfid = synth.sfload(os.path.abspath(self.soundfont))
+        if sfid == -1:
+            synth.delete()
+            raise GenerationError(f"SoundFont se nepodařilo načíst: {self.soundfont}", 500)
+        return synth, sfid
+
+    def _acquire(self):
+        with self._lock:
+            if self._pool.empty() and self._created < self.pool_size:
+                self._created += 1
+                try:
+                    return self._create_synth()
+                except Exception:
+                    self._created -= 1
+                    raise
+        return self._pool.get()
+
+    def warm_up(self):
+        self._pool.put(self._acquire())
+
+    def expected_frames(self, notes):
+        """Přesná délka výsledku ve vzorcích (poslední událost + dozvuk)."""
+        last_time = float(notes["end"].max()) if len(notes) else 0.0
+        return int(round(last_time * self.sample_rate)) + int(RENDER_TAIL_SECONDS * self.sample_rate)
+
+    def render(self, notes, midi_path=None):
+        blocks = list(self.iter_render(notes))
+        if not blocks:
+            return np.zeros((0, 2), dtype=np.int16)
+        return np.concatenate(blocks)
+
+    def iter_render(self, notes, midi_path=None, block_seconds=0.5):
+        """
+        Renderuje noty NOTE_DTYPE postupně – vrací bloky PCM (nejvýše
+        block_seconds), jak vznikají.
+        """
+        with self.session(block_seconds) as session:
+            channels, events = note_events(notes)
+            for (_, program, is_drum), channel in channels.items():
+                session.program(channel, program, is_drum)
+            yield from session.play(events)
+            yield from session.samples(int(RENDER_TAIL_SECONDS * self.sample_rate))
+
+    @contextmanager
+    def session(self, block_seconds=0.5, dedicated=False):
+        """
+        Syntezátor pro postupné přehrávání událostí – z poolu pro jednu skladbu
+        (iter_render). S `dedicated` vlastní syntezátor mimo pool, který se po
+        skončení zahodí: dlouhá skladba přehrává okna po celou dobu inference
+        a sdílený syntezátor by tak blokoval rendery ostatních úloh.
+        """
+        synth, sfid = self._create_synth() if dedicated else self._acquire()
+        try:
+            yield SynthSession(synth, sfid, self.sample_rate, int(block_seconds * self.sample_rate))
+        finally:
+            if dedicated:
+                synth.delete()
+            else:
+                # Umlčí doznívající tóny a vrátí ovladače do výchozího stavu pro další render
+                for channel in range(16):
+                    synth.cc(channel, 120, 0)
+                    synth.cc(channel, 121, 0)
+                self._pool.put((synth, sfid))
+
+class SynthSession:
+    """
+    Přehrávání seřazených MIDI událostí na syntezátoru; pozici v čase si
+    pamatuje, takže play() lze volat opakovaně s navazujícími událostmi.
+    """
+
+    def __init__(self, synth, sfid, sample_rate, block_frames):
+        self.synth = synth
+        self.sfid = sfid
+        self.sample_rate = sample_rate
+        self.block_frames = block_frames
+        self.position = 0
+
+    def program(self, channel, program, is_drum):
+        self.synth.program_select(channel, self.sfid, 128 if is_drum else 0, 0 if is_drum else program)
+
+    def samples(self, frames):
+        while frames > 0:
+            count = min(frames, self.block_frames)
+            yield self.synth.get_samples(count).astype(np.int16).reshape(-1, 2)
+            frames -= count
+            self.position += count
+
+    def play(self, events, until=None):
+        """Zahraje události a vrací bloky PCM; s `until` (s) dohraje i ticho do tohoto času."""
+        for time_s, is_on, channel, pitch, velocity in events:
+            target = int(round(time_s * self.sample_rate))
+            if target > self.position:
+                yield from self.samples(target - self.position)
+            if is_on:
+                self.synth.noteon(channel, pitch, velocity)
+            else:
+                self.synth.noteoff(channel, pitch)
+        if until is not None:
+            yield from self.samples(int(round(until * self.sample_rate)) - self.position)
+
+class FluidSynthProcessRenderer:
+    """Záložní renderer – pro každý požadavek spustí program fluidsynth."""
+
+    def __init__(self, executable, soundfont, sample_rate=SAMPLE_RATE):
+        self.executable = executable
+        self.soundfont = soundfont
+        self.sample_rate = sample_rate
+
+    def warm_up(self):
+        pass
+
+    def expected_frames(self, notes):
+        return None  # délku zná až fluidsynth po dokončení
+
+    def iter_render(self, notes, midi_path=None, block_seconds=0.5):
+        yield self.render(notes, midi_path)
+
+    def render(self, notes, midi_path=None):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if midi_path is None:
+                # Časy not jsou v sekundách, na tempové mapě zvuk nezávisí
+                midi_path = os.path.join(tmp_dir, "input.mid")
+                with open(midi_path, "wb") as midi_file:
+                    midi_file.write(midi_bytes(notes))
+            wav_path = os.path.join(tmp_dir, "output.wav")
+            self._run(midi_path, wav_path)
+            return read_wav(wav_path)
+
+    def _run(self, midi_path, wav_path):
+        # --- ZAČÁTEK DŮLEŽITÉ OPRAVY ---
+        # Převedeme všechny cesty na absolutní, než je předáme externímu programu
+        abs_fluidsynth_path = shutil.which(self.executable) or os.path.abspath(self.executable)
+        abs_soundfont_path = os.path.abspath(self.soundfont)
+        abs_midi_path = os.path.abspath(midi_path)
+        abs_wav_path = os.path.abspath(wav_path)
+
+        # Převod MIDI na WAV pomocí subprocess a FluidSynth
+        try:
+            if not os.path.exists(abs_soundfont_path):
+                raise GenerationError(f"SoundFont soubor nebyl nalezen na absolutní cestě: {abs_soundfont_path}", 500)
+            if not os.path.exists(abs_midi_path):
+                raise GenerationError(f"Vstupní MIDI soubor nebyl nalezen na absolutní cestě: {abs_midi_path}", 500)
+
+            result = subprocess.run([
+                abs_fluidsynth_path,  # Používáme absolutní cestu
+                "-ni",
+                abs_soundfont_path,  # Používáme absolutní cestu
+                abs_midi_path,       # Používáme absolutní cestu
+                "-F", abs_wav_path,  # Používáme absolutní cestu
+                "-r", str(self.sample_rate)
+            ], check=True, capture_output=True, text=True, encoding='utf-8')
+
+            if not os.path.exists(abs_wav_path) or os.path.getsize(abs_wav_path) == 0:
+                error_message = f"Převod na WAV selhal (soubor je prázdný nebo nebyl vytvořen). Hláška z FluidSynth: {result.stderr}"
+                raise GenerationError(error_message, 500)
+
+        except subprocess.CalledProcessError as e:
+            error_output = e.stderr or "FluidSynth neposkytl žádnou chybovou hlášku."
+            raise GenerationError(f"Chyba při převodu MIDI na WAV (kód {e.returncode}): {error_output}", 500)
+        except FileNotFoundError:
+            raise GenerationError("FluidSynth nebyl nalezen. Zkontrolujte cestu v proměnné prostředí FLUIDSYNTH_PATH.", 500)
+        # --- KONEC DŮLEŽITÉ OPRAVY ---
+
+def create_renderer():
+    if RENDER_BACKEND == "subprocess":
+        return FluidSynthProcessRenderer(fluidsynth_executable_path, soundfont_path)
+    return FluidSynthRenderer(soundfont_path, pool_size=RENDER_POOL_SIZE)
+
+renderer = create_renderer()
+
+def song_fingerprint(song):
+    """
+    Kanonický otisk skladby (ArrangedSong) – nezávisí na pořadí not, jen na tom,
+    co se opravdu zahraje.
+    """
+    digest = hashlib.sha256()
+    digest.update(np.sort(song.notes, order=list(NOTE_DTYPE.names)).tobytes())
+    digest.update(repr([(float(t), float(qpm)) for t, qpm in song.tempos]).encode())
+    digest.update(str(song.ticks_per_quarter).encode())
+    return digest.hexdigest()
+
+def soundfont_identity(path):
+    try:
+        st = os.stat(path)
+        return f"{os.path.abspath(path)}:{st.st_size}:{int(st.st_mtime)}"
+    except OSError:
+        return os.path.abspath(path)
+
+class RenderCache:
+    """
+    Cache vyrenderovaných skladeb adresovaná obsahem.
+
+    • Klíč = otisk skladby (noty a tempa) + identita SoundFontu + vzorkovací frekvence,
+      takže stejná sekvence se stejným zvukem se renderuje jen jednou.
+    • Hodnotou jsou klíče MIDI a zvuku v úložišti (storage) ve formátech, které
+      už existují; zásah nastane, jen když jsou k dispozici všechny požadované formáty.
+    • Součet velikostí souborů v indexu je omezen max_bytes, nejdéle nepoužité
+      záznamy se z indexu vyřazují (LRU). Limit tedy omezuje jen index, ne místo
+      v úložišti: cache žádné soubory nevlastní, všechny patří k záznamům
+      historie a vyřazením se nemažou.
+    """
+
+    def __init__(self, max_bytes, soundfont, sample_rate=SAMPLE_RATE, storage=None):
+        self.max_bytes = max_bytes
+        self.soundfont = soundfont
+        self.sample_rate = sample_rate
+        self.storage = storage
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def key_for(self, song):
+        source = f"{song_fingerprint(song)}|{soundfont_identity(self.soundfont)}|{self.sample_rate}"
+        return hashlib.sha256(source.encode()).hexdigest()
+
+    def get(self, key, formats):
+        # Úložiště (disk, S3) se kontroluje mimo zámek nad snímkem záznamu
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry:
+            midi_key, audio_keys, _ = entry
+            keys = [midi_key] + [audio_keys.get(f) for f in formats]
+            if all(k and self.storage.exists(k) for k in keys):
+                with self._lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                    self.hits += 1
+                return midi_key, {f: audio_keys[f] for f in formats}
+            if not all(self.storage.exists(k) for k in [midi_key] + list(audio_keys.values())):
+                with self._lock:
+                    # Mezitím mohl záznam nahradit put – ten už neodstraňujeme
+                    if self._entries.get(key) is entry:
+                        self._remove(key)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, midi_key, audio_keys):
+        with self._lock:
+            old = self._entries.get(key)
+        if old:
+            # Další formáty téže skladby se přidají ke stávajícím
+            old_midi, old_audio, _ = old
+            if self.storage.exists(old_midi):
+                audio_keys = {**{f: k for f, k in old_audio.items() if self.storage.exists(k)}, **audio_keys}
+        stats = [self.storage.stat(k) for k in [midi_key] + list(audio_keys.values())]
+        size = sum(info.size for info in stats if info is not None)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (midi_key, dict(audio_keys), size)
+            self._size += size
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry[2]
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+render_cache = RenderCache(RENDER_CACHE_INDEX_MB * 1024 * 1024, soundfont_path, storage=artifact_storage)
+# --- konec renderování zvuku ----------------------------------------------
 
 # --- nový blok -----------------------------------------------------------
 def prepare_layers_for_genre(genre_key: str,
@@ -246,162 +2398,473 @@ def prepare_layers_for_genre(genre_key: str,
     return base
 # --- konec nového bloku ---------------------------------------------------
 
-def generate_section_with_style(generator, primer_sequence, section_name, start_time):
-    # Defaultní parametry
-    length_map = {
-        'intro': 16,
-        'verse': 32,
-        'chorus': 32,
-        'bridge': 32,
-        'outro': 16
-    }
+# Styl jednotlivých sekcí: násobek teploty a číslo nástroje (instrument) pro melodii
+# Násobitele teploty požadavku, ne absolutní hodnoty: při teplotě 1.0 dávají
+# původní teploty sekcí, teplota z požadavku (preset, žánr) je posouvá úměrně.
+# Výsledek se ořezává na 0.1–2.0.
+SECTION_TEMPERATURES = {
+    'intro': 0.7,
+    'verse': 1.0,
+    'chorus': 1.2,
+    'bridge': 0.9,
+    'outro': 0.6
+}
 
-    temperature_map = {
-        'intro': 0.7,
-        'verse': 1.0,
-        'chorus': 1.2,
-        'bridge': 0.9,
-        'outro': 0.6
-    }
+SECTION_INSTRUMENTS = {
+    'intro': 0, # Piano
+    'verse': 24, # Guitar
+    'chorus': 30, # Overdriven Guitar
+    'bridge': 40, # Violin
+    'outro': 0 # Piano
+}
 
-    instrument_map = {
-        'intro': 0, # Piano
-        'verse': 24, # Guitar
-        'chorus': 30, # Overdriven Guitar
-        'bridge': 40, # Violin
-        'outro': 0 # Piano
-    }
+SECTION_DURATION = 8  # délka sekce v sekundách (stejná jako u tempo křivky)
 
-    # Urči délku a teplotu podle sekce
-    total_steps = length_map.get(section_name, 32)
-    temperature = temperature_map.get(section_name, 1.0)
-    instrument = instrument_map.get(section_name, 0)
+def plan_song(length, prompt_lower=""):
+    """
+    Rozvrhne skladbu na sekce – vrací seznam (název, začátek, konec) v sekundách.
 
-    generator_options = generator_pb2.GeneratorOptions()
-    generator_options.generate_sections.add(
-        start_time=start_time,
-        end_time=start_time + total_steps * 0.25 # 0.25 sekundy = 1 krok při 4 krocích za čtvrťovou
-    )
-    generator_options.args['temperature'].float_value = temperature
+    Strukturu lze zadat přímo v promptu (intro, verse, chorus, ...), jinak se použije
+    intro + střídání verse/chorus/bridge/outro. Sekce za koncem skladby se zahodí.
+    """
+    section_types = re.findall(r'(intro|verse|chorus|bridge|outro)', prompt_lower)
+    if not section_types:
+        sections = int(length // SECTION_DURATION)
+        section_types = ["intro"] + [get_section_type(i) for i in range(sections)]
 
-    del primer_sequence.notes[:]
+    plan = []
+    for i, section in enumerate(section_types):
+        start = i * SECTION_DURATION
+        if start >= length:
+            break
+        plan.append((section, start, min(start + SECTION_DURATION, length)))
+    return plan
 
-    generated_sequence = generator.generate(primer_sequence, generator_options)
+def generate_planned_song(generator, primer_sequence, plan, temperature=1.0, stats=None, on_section=None):
+    """
+    Jedna melodie pro celý plán skladby – generate_song_candidates s jednou variantou.
 
-    # Nastavení nástroje pro každou notu této sekce
-    for note in generated_sequence.notes:
-        if start_time <= note.start_time < start_time + total_steps * 0.25:
-            note.instrument = instrument
+    Stav RNN se přenáší přes hranice sekcí, takže se každý krok počítá jen
+    jednou a cena roste lineárně s délkou. Po každé sekci se volá
+    on_section(pořadí, název, začátek, konec, noty sekce).
+    """
+    if not plan:
+        song = music_pb2.NoteSequence()
+        song.CopyFrom(primer_sequence)
+        return song
+    return generate_song_candidates(generator, primer_sequence, plan, 1, temperature, stats, on_section)[0]
 
-    return generated_sequence, total_steps * 0.25
+# Krokování RNN se stavem přenášeným mezi sekcemi nemá v Magentě veřejné API.
+# Interní atributy jsou ověřené s verzí z requirements.txt.
+MAGENTA_TESTED_VERSION = "2.1.4"
 
-def generate_full_song(generator, primer_sequence):
-    final_sequence = note_seq.NoteSequence()
-    start_time = 0.0
+class MelodyRnnModel:
+    """
+    Jediné místo, které sahá na neveřejné API Magenty (generator._model a jeho
+    _config, _session, _batch_size a _generate_step). Jiná verze Magenty bez
+    těchto atributů skončí srozumitelnou GenerationError hned při vytvoření,
+    ne AttributeError uprostřed generování.
+    """
+    REQUIRED = ("_config", "_session", "_batch_size", "_generate_step")
 
-    # Seznam sekcí ve skladbě
-    song_structure = ['intro', 'verse', 'chorus', 'verse', 'bridge', 'outro']
+    def __init__(self, generator):
+        model = getattr(generator, "_model", None)
+        missing = ["_model"] if model is None else [name for name in self.REQUIRED if not hasattr(model, name)]
+        if missing:
+            raise GenerationError(
+                f"Nepodporovaná verze Magenty: chybí interní atributy {', '.join(missing)} "
+                f"(ověřeno s magenta=={MAGENTA_TESTED_VERSION}).", 500)
+        self._model = model
 
-    for i, section in enumerate(song_structure):
-        print(f"Generuji část: {section}...")
+    @property
+    def config(self):
+        return self._model._config
 
-        if i == 0:
-            primer = primer_sequence
-        else:
-            primer = note_seq.NoteSequence()
-
-        section_sequence, section_duration = generate_section_with_style(
-            generator,
-            primer_sequence,
-            section,
-            start_time
-        )
-
-        # Přidej akordy do sekce (dle sekce)
-        add_chords_to_sequence(final_sequence, start_time, section_duration, section)
-
-        # Přidej noty z této sekce do finální sekvence
-        for note in section_sequence.notes:
-            final_sequence.notes.add().CopyFrom(note)
-
-        # Aktualizuj čas začátku pro další sekci
-        start_time += section_duration
-
-    # Zkopíruj metadata (tempo, tonality atd.) z poslední sekce
-    final_sequence.tempos.extend(section_sequence.tempos)
-    final_sequence.ticks_per_quarter = section_sequence.ticks_per_quarter
-    final_sequence.total_time = start_time
-
-    return final_sequence
-
-def generate_full_song_structure(generator, primer_sequence):
-    sections = ['intro', 'verse', 'chorus', 'verse', 'bridge', 'outro']
-    full_sequence = music_pb2.NoteSequence()
-    current_start_time = 0.0
-
-    for section in sections:
-        generated_part = generate_section_with_style(
-            generator,
-            primer_sequence,
-            section_name=section,
-            start_time=current_start_time
-        )
-
-        # Přidej noty ze sekce do hlavní sekvence
-        for note in generated_part.notes:
-            full_sequence.notes.add().CopyFrom(note)
-
-        # Posuň časový ukazatel
-        section_duration = max(
-            (note.end_time for note in generated_part.notes),
-            default=current_start_time
-        )
-        current_start_time = section_duration
-
-    full_sequence.total_time = current_start_time
-    full_sequence.tempos.add(qpm=120) # nebo jiná hodnota podle promptu
-    return full_sequence
+    @property
+    def session(self):
+        return self._model._session
 
-def save_history(record):
-    history = []
-    if os.path.exists(HISTORY_FILE):
-        try:
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-        except json.JSONDecodeError:
-            pass
-    history.insert(0, record)
-    history = history[:50]
-    with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-        json.dump(history, f, indent=4, ensure_ascii=False)
+    def batch_size(self):
+        return self._model._batch_size()
 
-def load_history():
-    if os.path.exists(HISTORY_FILE):
-        try:
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            return []
+    def step(self, melodies, model_states, logliks, temperature):
+        """Jeden krok RNN pro všechny melodie dávky; vrací (melodie, stavy, logliky)."""
+        return self._model._generate_step(melodies, model_states, logliks, temperature=temperature)
+
+@dataclass(frozen=True)
+class PrimerState:
+    melody: object          # melodie primeru po squash (kopíruje se pro každou variantu)
+    transpose_amount: int
+    inputs: list            # vstup posledního kroku primeru
+    rnn_state: object       # stav RNN po všech krocích primeru kromě posledního
+
+
+def encode_primer(generator, primer_sequence, start_step, qpm):
+    """
+    Připraví primer stejně jako MelodyRnnSequenceGenerator._generate a protlačí
+    ho sítí. Poslední krok primeru se neposílá – jde do sítě spolu s prvním
+    generovaným krokem, takže výsledný stav i softmax jsou stejné jako při
+    průchodu celým primerem najednou.
+    """
+    model = MelodyRnnModel(generator)
+    quantized_primer = note_seq.quantize_note_sequence(primer_sequence, generator.steps_per_quarter)
+    extracted_melodies, _ = melody_pipelines.extract_melodies(
+        quantized_primer, search_start_step=0, min_bars=0, min_unique_pitches=1,
+        gap_bars=float('inf'), ignore_polyphonic_notes=True)
+    if extracted_melodies and extracted_melodies[0]:
+        primer_melody = extracted_melodies[0]
+    else:
+        steps_per_bar = int(note_seq.steps_per_bar_in_quantized_sequence(quantized_primer))
+        primer_melody = note_seq.Melody([], start_step=max(0, start_step - 1), steps_per_bar=steps_per_bar,
+                                        steps_per_quarter=generator.steps_per_quarter)
+    primer_melody.set_length(start_step - primer_melody.start_step)
+    transpose_amount = primer_melody.squash(
+        model.config.min_note, model.config.max_note, model.config.transpose_to_key)
+
+    inputs = model.config.encoder_decoder.get_inputs_batch([primer_melody], full_length=True)[0]
+    graph = model.session.graph
+    graph_initial_state = graph.get_collection('initial_state')
+    rnn_state = state_util.unbatch(model.session.run(graph_initial_state))[0]
+    if len(inputs) > 1:
+        batch_size = model.batch_size()
+        final_state = model.session.run(graph.get_collection('final_state'), {
+            graph.get_collection('inputs')[0]: [inputs[:-1]] * batch_size,
+            tuple(graph_initial_state): state_util.batch([rnn_state] * batch_size, batch_size),
+        })
+        rnn_state = state_util.unbatch(final_state)[0]
+    return PrimerState(primer_melody, transpose_amount, inputs[-1:], rnn_state)
+
+
+class PrimerStateCache:
+    """
+    Zakódované primery podle (model, primer, tempo, krok začátku). Primer je
+    u většiny požadavků stejný, teplý start tak přeskočí kvantizaci, extrakci
+    melodie i průchod primeru sítí.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, generator, primer_sequence, start_step, qpm, stats=None):
+        primer_digest = hashlib.sha256(primer_sequence.SerializeToString()).hexdigest()
+        key = (generator.details.id, primer_digest, qpm, start_step)
+        with self._lock:
+            state = self._entries.get(key)
+            if state is not None:
+                self._entries.move_to_end(key)
+        if stats is not None:
+            name = "primer_cache_hits" if state is not None else "primer_cache_misses"
+            stats[name] = stats.get(name, 0) + 1
+        if state is None:
+            state = encode_primer(generator, primer_sequence, start_step, qpm)
+            with self._lock:
+                self._entries[key] = state
+                while len(self._entries) > max(1, self.max_entries):
+                    self._entries.popitem(last=False)
+        return state
+
+
+primer_states = PrimerStateCache(PRIMER_CACHE_SIZE)
+
+def generate_song_candidates(generator, primer_sequence, plan, count, temperature=1.0, stats=None, on_section=None):
+    """
+    Vygeneruje `count` variant melodie pro celý plán v jednom dávkovém průchodu RNN.
+
+    Všechny varianty startují ze stejného primeru a model je rozšiřuje krok po kroku
+    společně – jedno volání session.run obslouží celou dávku (Magenta ji doplní
+    na batch_size modelu), takže další varianta stojí zlomek ceny první.
+    Stav RNN se přenáší přes hranice sekcí, mění se jen teplota. Zakódovaný
+    primer se bere z primer_states. Po každé sekci se volá
+    on_section(pořadí, název, začátek, konec, noty) s notami první varianty
+    od začátku sekce – callback je nesmí měnit.
+    """
+    model = MelodyRnnModel(generator)
+    qpm = primer_sequence.tempos[0].qpm if primer_sequence.tempos else note_seq.DEFAULT_QUARTERS_PER_MINUTE
+    start_step = generator.seconds_to_steps(max(plan[0][1], primer_sequence.total_time), qpm)
+    primer = primer_states.get(generator, primer_sequence, start_step, qpm, stats)
+    transpose_amount = primer.transpose_amount
+
+    melodies = [copy.deepcopy(primer.melody) for _ in range(count)]
+    model_states = [events_rnn_model.ModelState(inputs=primer.inputs, rnn_state=primer.rnn_state,
+                                                    control_events=None, control_state=None)
+                    for _ in range(count)]
+    logliks = np.zeros(count)
+
+    rnn_steps = 0
+    for index, (section, section_start, end) in enumerate(plan):
+        section_started = time.perf_counter()
+        end_step = generator.seconds_to_steps(end, qpm)
+        section_temperature = max(0.1, min(2.0, temperature * SECTION_TEMPERATURES.get(section, 1.0)))
+        with SECTION_SECONDS.time(section=section):
+            while melodies[0].start_step + len(melodies[0]) < end_step:
+                melodies, model_states, logliks = model.step(melodies, model_states, logliks, section_temperature)
+                rnn_steps += 1
+        if stats is not None:
+            stats.setdefault("section_seconds", []).append(round(time.perf_counter() - section_started, 4))
+        if on_section is not None:
+            # Jen noty od začátku sekce – převod celé melodie po každé sekci by rostl kvadraticky
+            first_step = max(0, generator.seconds_to_steps(section_start, qpm) - melodies[0].start_step)
+            section_melody = melodies[0][first_step:]
+            section_melody.transpose(-transpose_amount)
+            section_sequence = section_melody.to_sequence(qpm=qpm)
+            apply_section_instruments(section_sequence, [(section, section_start, end)])
+            on_section(index, section, section_start, end, section_sequence)
+
+    if stats is not None:
+        stats["inference_calls"] = stats.get("inference_calls", 0) + 1
+        stats["rnn_steps"] = stats.get("rnn_steps", 0) + rnn_steps
+
+    sequences = []
+    for melody in melodies:
+        melody.transpose(-transpose_amount)
+        sequence = melody.to_sequence(qpm=qpm)
+        apply_section_instruments(sequence, plan)
+        sequences.append(sequence)
+    return sequences
+
+def long_form_windows(plan, window_seconds=LONG_FORM_WINDOW_SECONDS):
+    """Sekce plánu seskupené do oken po `window_seconds` podle začátku sekce."""
+    windows = {}
+    for entry in plan:
+        windows.setdefault(int(entry[1] // max(window_seconds, SECTION_DURATION)), []).append(entry)
+    return list(windows.values())
+
+def generate_long_form(generator, primer_sequence, plan, temperature=1.0, seed=None, stats=None, on_section=None):
+    """
+    Dlouhá skladba po oknech s pamětí nezávislou na délce.
+
+    Melodie se generuje krok po kroku jako v generate_song_candidates a stav
+    RNN se přenáší mezi okny. Po každém okně se hotové noty předají
+    on_section(pořadí, "window", začátek, konec, noty okna) a z melodie se
+    nechá jen kontext posledních LONG_FORM_CONTEXT_BARS taktů. Okno končí
+    na posledním nástupu tónu, aby se tón přes hranici okna nerozdělil.
+    Každé okno má vlastní seed (seed + pořadí), vrací se prázdný seznam.
+    """
+    model = MelodyRnnModel(generator)
+    qpm = primer_sequence.tempos[0].qpm if primer_sequence.tempos else note_seq.DEFAULT_QUARTERS_PER_MINUTE
+    start_step = generator.seconds_to_steps(max(plan[0][1], primer_sequence.total_time), qpm)
+    primer = primer_states.get(generator, primer_sequence, start_step, qpm, stats)
+
+    melody = copy.deepcopy(primer.melody)
+    model_states = [events_rnn_model.ModelState(inputs=primer.inputs, rnn_state=primer.rnn_state,
+                                                control_events=None, control_state=None)]
+    logliks = np.zeros(1)
+    # Lookback kóduje pozici binárním čítačem s periodou dvou taktů – kontext se
+    # proto zkracuje po dvou taktech, aby se vstupy sítě po zkrácení nezměnily
+    trim_period = 2 * melody.steps_per_bar
+    context_steps = LONG_FORM_CONTEXT_BARS * melody.steps_per_bar
+    no_event = note_seq.melodies_lib.MELODY_NO_EVENT
+    emitted_step = melody.start_step
+    rnn_steps = 0
+
+    windows = long_form_windows(plan)
+    for index, sections in enumerate(windows):
+        window_started = time.perf_counter()
+        with seeded_random(None if seed is None else (seed + index) % 2 ** 32):
+            for section, _, end in sections:
+                end_step = generator.seconds_to_steps(end, qpm)
+                section_temperature = max(0.1, min(2.0, temperature * SECTION_TEMPERATURES.get(section, 1.0)))
+                with SECTION_SECONDS.time(section=section):
+                    while melody.end_step < end_step:
+                        melodies, model_states, logliks = model.step(
+                            [melody], model_states, logliks, section_temperature)
+                        melody = melodies[0]
+                        rnn_steps += 1
+
+        offset = emitted_step - melody.start_step
+        cut = len(melody)
+        if index < len(windows) - 1:
+            # Poslední tón okna může pokračovat – vydá se až s dalším oknem
+            cut = next((i for i in range(len(melody) - 1, offset - 1, -1) if melody[i] != no_event), offset)
+        window = melody[offset:cut]
+        window.transpose(-primer.transpose_amount)
+        window_sequence = window.to_sequence(qpm=qpm)
+        apply_section_instruments(window_sequence, sections)
+        if on_section is not None:
+            seconds_per_step = 60.0 / qpm / generator.steps_per_quarter
+            on_section(index, "window", emitted_step * seconds_per_step,
+                       (melody.start_step + cut) * seconds_per_step, window_sequence)
+        emitted_step = melody.start_step + cut
+
+        trim = min(len(melody) - context_steps, emitted_step - melody.start_step) // trim_period * trim_period
+        if trim > 0:
+            melody.set_length(len(melody) - trim, from_left=True)
+        if stats is not None:
+            stats.setdefault("window_seconds", []).append(round(time.perf_counter() - window_started, 4))
+
+    if stats is not None:
+        stats["inference_calls"] = stats.get("inference_calls", 0) + len(windows)
+        stats["rnn_steps"] = stats.get("rnn_steps", 0) + rnn_steps
     return []
 
-@app.route("/delete_record/<timestamp>", methods=["POST"])
-def delete_record(timestamp):
-    history = []
-    if os.path.exists(HISTORY_FILE):
-        try:
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-        except json.JSONDecodeError:
-            pass # Soubor je prázdný nebo poškozený, začneme s prázdnou historií
+def apply_section_instruments(sequence, plan):
+    for section, start, end in plan:
+        instrument = SECTION_INSTRUMENTS.get(section, 0)
+        for note in sequence.notes:
+            if start <= note.start_time < end:
+                note.instrument = instrument
+
+# --- historie v SQLite -----------------------------------------------------
+class HistoryStore:
+    """
+    Historie skladeb v SQLite (režim WAL) s indexem podle času.
+
+    • Vložení i smazání záznamu je jeden indexovaný příkaz, žádné přepisování
+      celého souboru – souběžné požadavky o záznamy nepřijdou.
+    • Výpis je stránkovaný kurzorem (timestamp, id) od nejnovějších záznamů.
+    • Při prvním spuštění se jednorázově převezme původní history.json.
+    """
+
+    def __init__(self, db_path, legacy_json=None):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp TEXT NOT NULL,
+                    genre TEXT,
+                    model TEXT,
+                    tempo REAL,
+                    record TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history (timestamp, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_history_genre ON history (genre, timestamp, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_history_model ON history (model, timestamp, id)")
+        if legacy_json:
+            self.migrate_json(legacy_json)
+
+    def _connect(self):
+        # Jedno spojení na vlákno – sqlite3 spojení nejde sdílet mezi vlákny
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def migrate_json(self, json_path):
+        with self._connect() as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= 1:
+                return
+            records = []
+            if os.path.exists(json_path):
+                try:
+                    with open(json_path, 'r', encoding='utf-8') as f:
+                        records = json.load(f)
+                except json.JSONDecodeError:
+                    pass # Soubor je prázdný nebo poškozený, začneme s prázdnou historií
+            # history.json má nejnovější záznam první, vkládáme od nejstaršího
+            for record in reversed(records):
+                self._insert(conn, record)
+            conn.execute("PRAGMA user_version = 1")
+        if records:
+            print(f"Historie převedena z {json_path}: {len(records)} záznamů")
+
+    def _insert(self, conn, record):
+        record = {k: v for k, v in record.items() if k != "id"}
+        cursor = conn.execute(
+            "INSERT INTO history (timestamp, genre, model, tempo, record) VALUES (?, ?, ?, ?, ?)",
+            (record.get("timestamp", ""), record.get("genre"), record.get("model"), record.get("tempo"),
+             json.dumps(record, ensure_ascii=False)))
+        return cursor.lastrowid
+
+    def add(self, record):
+        with self._connect() as conn:
+            return self._insert(conn, record)
+
+    def delete(self, record_id):
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM history WHERE id = ?", (record_id,)).rowcount
+
+    def delete_by_timestamp(self, timestamp):
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM history WHERE timestamp = ?", (timestamp,)).rowcount
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM history")
+
+    def query(self, limit=None, cursor=None, genre=None, model=None,
+              tempo_min=None, tempo_max=None, date_from=None, date_to=None):
+        """
+        Vrátí záznamy od nejnovějších. `cursor` je dvojice (timestamp, id)
+        posledního záznamu předchozí stránky, ostatní parametry filtrují
+        (date_from/date_to jako datetime.date, včetně krajních dnů).
+        """
+        conditions = []
+        params = []
+        if cursor is not None:
+            conditions.append("(timestamp < ? OR (timestamp = ? AND id < ?))")
+            params += [cursor[0], cursor[0], cursor[1]]
+        if genre:
+            conditions.append("genre = ?")
+            params.append(genre)
+        if model:
+            conditions.append("model = ?")
+            params.append(model)
+        if tempo_min is not None:
+            conditions.append("tempo >= ?")
+            params.append(tempo_min)
+        if tempo_max is not None:
+            conditions.append("tempo <= ?")
+            params.append(tempo_max)
+        # Razítko má tvar YYYYmmdd_HHMMSS, takže se dá porovnávat jako text
+        if date_from is not None:
+            conditions.append("timestamp >= ?")
+            params.append(date_from.strftime("%Y%m%d_000000"))
+        if date_to is not None:
+            conditions.append("timestamp <= ?")
+            params.append(date_to.strftime("%Y%m%d_235959"))
+
+        sql = "SELECT id, record FROM history"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY timestamp DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        records = []
+        for record_id, payload in self._connect().execute(sql, params):
+            record = json.loads(payload)
+            record["id"] = record_id
+            records.append(record)
+        return records
+
+# Inferenční proces modul importuje znovu, historii ani frontu úloh ale nepotřebuje
+history_store = HistoryStore(HISTORY_DB, legacy_json=HISTORY_FILE) if not IS_INFERENCE_WORKER else None
+
+def save_history(record):
+    return history_store.add(record)
+
+def load_history(limit=None, cursor=None, **filters):
+    return history_store.query(limit=limit, cursor=cursor, **filters)
+
+def parse_history_cursor(value):
+    """Kurzor stránkování v URL má tvar "<timestamp>:<id>"."""
+    if not value:
+        return None
+    timestamp, _, record_id = value.rpartition(":")
+    try:
+        return timestamp, int(record_id)
+    except ValueError:
+        return None
 
-    # Filtrujeme záznamy: ponecháme jen ty, které nemají stejné časové razítko
-    # jako záznam, který chceme smazat.
-    # Ujistěte se, že timestamp v URL a v JSON souboru jsou ve stejném formátu.
-    updated_history = [record for record in history if record.get("timestamp") != timestamp]
+def history_cursor(record):
+    return f"{record['timestamp']}:{record['id']}"
 
+@app.route("/delete_record/<key>", methods=["POST"])
+def delete_record(key):
+    # Nové odkazy mažou podle id záznamu, starší podle časového razítka
     try:
-        with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(updated_history, f, indent=4, ensure_ascii=False)
+        if key.isdigit():
+            history_store.delete(int(key))
+        else:
+            history_store.delete_by_timestamp(key)
         return jsonify({"message": "Záznam byl úspěšně smazán."}), 200
     except Exception as e:
         return jsonify({"error": f"Chyba při ukládání historie po smazání: {str(e)}"}), 500
@@ -417,218 +2880,363 @@ def datetimeformat(value, input_fmt="%Y%m%d_%H%M%S", output_fmt="%d.%m.%Y %H:%M:
 @app.route("/clear_history", methods=["POST"])
 def clear_history():
     try:
-        if os.path.exists(HISTORY_FILE):
-            os.remove(HISTORY_FILE)
+        history_store.clear()
         return jsonify({"message": "Celá historie byla úspěšně smazána."}), 200
     except Exception as e:
-        return jsonify({"error": f"Chyba při mazání souboru historie: {str(e)}"}), 500
+        return jsonify({"error": f"Chyba při mazání historie: {str(e)}"}), 500
 
-def parse_prompt(prompt, current_params):
-    prompt_lower = prompt.lower()
-    detected_Genre = None
-
-    parsed_params = {
-        "length": current_params.get("length", 30),
-        "tempo": current_params.get("tempo", 120),
-        "temperature": current_params.get("temperature", 1.0),
-        "melody_instrument": current_params.get("instrument", 0),
-        "bass_instrument": 33,
-        "chord_instrument": 29,
-        "pad_instrument": None,
-        "add_drums": True,
-        "chord_progression_type": "standard",
-        "major_key": True,
-        "add_arpeggio": False,
-        "model": current_params.get("model", "basic_rnn")
-    }
+# --- rozbor promptu ---------------------------------------------------------
+# Všechna klíčová slova (žánry, nástroje, nálady, styly akordů...) se při importu
+# zkompilují do jednoho automatu, prompt se pak projde jen jednou a cena rozboru
+# nezávisí na velikosti slovníku.
+
+PROMPT_CACHE_SIZE = int(os.environ.get("PROMPT_CACHE_SIZE", 1024))
+
+class KeywordAutomaton:
+    """
+    Aho–Corasickův automat nad pevnou sadou klíčových slov. Jedním průchodem
+    textem najde všechny výskyty včetně překrývajících se ("electric bass"
+    i "bass"), takže odpovídá původním testům `keyword in prompt`.
+    """
+
+    def __init__(self, keywords):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+        for keyword in dict.fromkeys(keywords):
+            state = 0
+            for char in keyword:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                state = next_state
+            self._output[state] += (keyword,)
+
+        # Zpětné (fail) přechody po vrstvách, výstupy se dědí po fail řetězu
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, next_state in self._goto[state].items():
+                pending.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] += self._output[self._fail[next_state]]
+
+    def find(self, text):
+        """
+        Vrátí {klíčové slovo: pozice prvního výskytu} pro všechna slova v textu.
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        hits = {}
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for keyword in output[state]:
+                if keyword not in hits:
+                    hits[keyword] = index - len(keyword) + 1
+        return hits
+
+PROMPT_MODELS = [("attention rnn", "attention_rnn"), ("lookback rnn", "lookback_rnn"), ("basic rnn", "basic_rnn")]
+PROMPT_TEMPOS = [("fast", 160), ("slow", 80), ("medium", 120)]
+PROMPT_BASS_FALLBACK = [("acoustic bass", 32), ("electric bass", 33), ("synth bass", 38)]
+PROMPT_CHORD_FALLBACK = [("piano chords", 0), ("guitar chords", 27)]
+PROMPT_CHORD_STYLES = [
+    ("seventh", ["seventh chord", "7th chord", "maj7", "major 7", "minor 7", "min7"]),
+    ("sus", ["sus chord", "suspended", "sus4", "sus2"]),
+    ("diminished", ["diminished", "dim chord", "dim7", "o7"]),
+    ("augmented", ["augmented", "aug chord", "aug7", "+7"]),
+    ("transition", ["transition chord", "chromatic", "intermediate chord"]),
+]
+PROMPT_WORDS = [
+    "complex", "experimental", "simple", "calm", "rock",
+    "melody", "lead", "chords", "bass", "pad", "strings", "choir",
+    "no pad", "without pad", "arpeggio", "no drums", "without drums", "drums",
+]
+
+# Pořadí ve slovnících rozhoduje při více shodách (vyhrává dřívější položka)
+GENRE_RANK = {keyword: rank for rank, keyword in enumerate(GENRE_MAP)}
+INSTRUMENT_RANK = {name: rank for rank, name in enumerate(INSTRUMENT_MIDI_MAP)}
+
+def _instrument_phrases(*templates):
+    phrases = {}
+    for inst_name in INSTRUMENT_MIDI_MAP:
+        for template in templates:
+            phrases.setdefault(template.format(inst_name), []).append(inst_name)
+    return phrases
+
+BASS_PHRASES = _instrument_phrases("{} bass", "bass {}")
+CHORD_PHRASES = _instrument_phrases("{} chords")
+PAD_PHRASES = _instrument_phrases("{} pad", "pad {}")
+
+PROMPT_AUTOMATON = KeywordAutomaton(
+    list(GENRE_MAP) + list(INSTRUMENT_MIDI_MAP) + PROMPT_WORDS
+    + list(BASS_PHRASES) + list(CHORD_PHRASES) + list(PAD_PHRASES)
+    + [phrase for phrase, _ in PROMPT_MODELS + PROMPT_TEMPOS + PROMPT_BASS_FALLBACK + PROMPT_CHORD_FALLBACK]
+    + [word for _, words in PROMPT_CHORD_STYLES for word in words]
+)
+
+TEMPO_PATTERN = re.compile(r'(\d+)\s*(bpm|tempo)')
+LENGTH_PATTERN = re.compile(r'(\d+)\s*(seconds|s|second)')
+TEMPERATURE_PATTERN = re.compile(r'temperature\s*[:=]?\s*(\d+\.?\d*)')
+INSTRUMENT_NUMBER_PATTERN = re.compile(r'(?:instrument|midi)\s*(\d+)')
+
+@dataclass(frozen=True)
+class PromptParams:
+    """
+    Parametry vyčtené z promptu. Pořadí polí odpovídá klíčům slovníku,
+    který vrací parse_prompt.
+    """
+    length: int
+    tempo: float
+    temperature: float
+    melody_instrument: int
+    bass_instrument: int
+    chord_instrument: int
+    pad_instrument: int | None
+    add_drums: bool
+    chord_progression_type: str
+    major_key: bool
+    add_arpeggio: bool
+    model: str
+    chord_style: str
+    genre: str | None
+    prompt_lower: str
+
+def _first_phrase(hits, phrases):
+    """První nástroj (v pořadí INSTRUMENT_MIDI_MAP), jehož fráze je v promptu."""
+    names = [name for phrase in hits if phrase in phrases for name in phrases[phrase]]
+    return min(names, key=INSTRUMENT_RANK.get) if names else None
+
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def compile_prompt(prompt_lower, length=30, tempo=120, temperature=1.0, instrument=0, model="basic_rnn"):
+    """
+    Rozebere prompt (už převedený na malá písmena) jedním průchodem automatu.
+    Výsledek je neměnný, takže se může sdílet mezi opakovanými dotazy.
+    """
+    hits = PROMPT_AUTOMATON.find(prompt_lower)
+    genres = sorted((keyword for keyword in hits if keyword in GENRE_RANK), key=GENRE_RANK.get)
+    instruments = sorted((name for name in hits if name in INSTRUMENT_RANK), key=INSTRUMENT_RANK.get)
+
+    def genre_value(key, default=None, skip_none=False):
+        # Hodnota prvního nalezeného žánru, který klíč definuje
+        for keyword in genres:
+            if key in GENRE_MAP[keyword] and not (skip_none and GENRE_MAP[keyword][key] is None):
+                return GENRE_MAP[keyword][key]
+        return default
+
+    detected_genre = None
+    bass_instrument = 33
+    chord_instrument = 29
+    pad_instrument = None
+    add_drums = True
+    chord_progression_type = "standard"
+    major_key = True
 
     # Přednastavení modelu z promptu
-    if "attention rnn" in prompt_lower:
-        parsed_params["model"] = "attention_rnn"
-    elif "lookback rnn" in prompt_lower:
-        parsed_params["model"] = "lookback_rnn"
-    elif "basic rnn" in prompt_lower:
-        parsed_params["model"] = "basic_rnn"
-
-    tempo_match = re.search(r'(\d+)\s*(bpm|tempo)', prompt_lower)
+    for phrase, model_name in PROMPT_MODELS:
+        if phrase in hits:
+            model = model_name
+            break
+
+    tempo_match = TEMPO_PATTERN.search(prompt_lower)
     if tempo_match:
-        parsed_params["tempo"] = int(tempo_match.group(1))
+        tempo = int(tempo_match.group(1))
     else:
-        for keyword, config in GENRE_MAP.items():
-            if keyword in prompt_lower:
-                if "tempo_range" in config:
-                    parsed_params["tempo"] = (config["tempo_range"][0] + config["tempo_range"][1]) // 2
-                    detected_Genre = keyword
+        # Rozhoduje jen první žánr v pořadí GENRE_MAP, i když tempo nemá
+        if genres and "tempo_range" in GENRE_MAP[genres[0]]:
+            tempo_range = GENRE_MAP[genres[0]]["tempo_range"]
+            tempo = (tempo_range[0] + tempo_range[1]) // 2
+            detected_genre = genres[0]
+        for word, word_tempo in PROMPT_TEMPOS:
+            if word in hits:
+                tempo = word_tempo
                 break
-        if "fast" in prompt_lower:
-            parsed_params["tempo"] = 160
-        elif "slow" in prompt_lower:
-            parsed_params["tempo"] = 80
-        elif "medium" in prompt_lower:
-            parsed_params["tempo"] = 120
-
-    length_match = re.search(r'(\d+)\s*(seconds|s|second)', prompt_lower)
+
+    length_match = LENGTH_PATTERN.search(prompt_lower)
     if length_match:
-        parsed_params["length"] = int(length_match.group(1))
+        length = int(length_match.group(1))
 
-    temp_match = re.search(r'temperature\s*[:=]?\s*(\d+\.?\d*)', prompt_lower)
+    temp_match = TEMPERATURE_PATTERN.search(prompt_lower)
     if temp_match:
-        parsed_params["temperature"] = float(temp_match.group(1))
+        temperature = float(temp_match.group(1))
     else:
-        for keyword, config in GENRE_MAP.items():
-            if keyword in prompt_lower and "temperature_range" in config:
-                parsed_params["temperature"] = (config["temperature_range"][0] + config["temperature_range"][1]) / 2
-                break
-        if "complex" in prompt_lower or "experimental" in prompt_lower:
-            parsed_params["temperature"] = max(parsed_params["temperature"], 1.2)
-        elif "simple" in prompt_lower or "calm" in prompt_lower:
-            parsed_params["temperature"] = min(parsed_params["temperature"], 0.8)
-            # Speciálně pro rock chceme spíše umírněnější (méně chaotické) tóny
-        if "rock" in prompt_lower:
-            parsed_params["temperature"] = min(parsed_params["temperature"], 0.85)
-
+        temperature_range = genre_value("temperature_range")
+        if temperature_range:
+            temperature = (temperature_range[0] + temperature_range[1]) / 2
+        if "complex" in hits or "experimental" in hits:
+            temperature = max(temperature, 1.2)
+        elif "simple" in hits or "calm" in hits:
+            temperature = min(temperature, 0.8)
+        # Speciálně pro rock chceme spíše umírněnější (méně chaotické) tóny
+        if "rock" in hits:
+            temperature = min(temperature, 0.85)
+
+    melody_instrument = instrument
     melody_instrument_found_in_prompt = False
-    # Check for specific_instrument by MIDI number first
-    inst_num_match = re.search(r'(?:instrument|midi)\s*(\d+)', prompt_lower)
+    inst_num_match = INSTRUMENT_NUMBER_PATTERN.search(prompt_lower)
     if inst_num_match:
-        parsed_params["melody_instrument"] = int(inst_num_match.group(1))
+        melody_instrument = int(inst_num_match.group(1))
         melody_instrument_found_in_prompt = True
     else:
-        # Then check by name
-        for inst_name, midi_num in INSTRUMENT_MIDI_MAP.items():
-            if inst_name in prompt_lower:
-                if "melody" in prompt_lower or "lead" in prompt_lower or (prompt_lower.startswith(inst_name) and "chords" not in prompt_lower and "bass" not in prompt_lower and "pad" not in prompt_lower):
-                    parsed_params["melody_instrument"] = midi_num
-                    melody_instrument_found_in_prompt = True
-                    break
+        melody_hint = "melody" in hits or "lead" in hits
+        other_layer = "chords" in hits or "bass" in hits or "pad" in hits
+        for inst_name in instruments:
+            if melody_hint or (hits[inst_name] == 0 and not other_layer):
+                melody_instrument = INSTRUMENT_MIDI_MAP[inst_name]
+                melody_instrument_found_in_prompt = True
+                break
 
     if not melody_instrument_found_in_prompt:
-        for keyword, config in GENRE_MAP.items():
-            if keyword in prompt_lower and "melody_instrument" in config:
-                parsed_params["melody_instrument"] = config["melody_instrument"]
-                break
+        melody_instrument = genre_value("melody_instrument", melody_instrument)
 
-    for keyword, config in GENRE_MAP.items():
-        if keyword in prompt_lower and "bass_instrument" in config:
-            parsed_params["bass_instrument"] = config["bass_instrument"]
-            break
-    if "bass" in prompt_lower:
-        for inst_name, midi_num in INSTRUMENT_MIDI_MAP.items():
-            if f"{inst_name} bass" in prompt_lower or f"bass {inst_name}" in prompt_lower:
-                parsed_params["bass_instrument"] = midi_num
-                break
+    bass_instrument = genre_value("bass_instrument", bass_instrument)
+    if "bass" in hits:
+        inst_name = _first_phrase(hits, BASS_PHRASES)
+        if inst_name is not None:
+            bass_instrument = INSTRUMENT_MIDI_MAP[inst_name]
         else:
-            if "acoustic bass" in prompt_lower: parsed_params["bass_instrument"] = 32
-            elif "electric bass" in prompt_lower: parsed_params["bass_instrument"] = 33
-            elif "synth bass" in prompt_lower: parsed_params["bass_instrument"] = 38
+            for phrase, midi_num in PROMPT_BASS_FALLBACK:
+                if phrase in hits:
+                    bass_instrument = midi_num
+                    break
 
-    for keyword, config in GENRE_MAP.items():
-        if keyword in prompt_lower and "chord_instrument" in config:
-            parsed_params["chord_instrument"] = config["chord_instrument"]
-            break
-    if "chords" in prompt_lower:
-        for inst_name, midi_num in INSTRUMENT_MIDI_MAP.items():
-            if f"{inst_name} chords" in prompt_lower:
-                parsed_params["chord_instrument"] = midi_num
-                break
+    chord_instrument = genre_value("chord_instrument", chord_instrument)
+    if "chords" in hits:
+        inst_name = _first_phrase(hits, CHORD_PHRASES)
+        if inst_name is not None:
+            chord_instrument = INSTRUMENT_MIDI_MAP[inst_name]
         else:
-            if "piano chords" in prompt_lower: parsed_params["chord_instrument"] = 0
-            elif "guitar chords" in prompt_lower: parsed_params["chord_instrument"] = 27
-
-    if "no pad" in prompt_lower or "without pad" in prompt_lower:
-        parsed_params["pad_instrument"] = None
-    else:
-        for keyword, config in GENRE_MAP.items():
-            if keyword in prompt_lower and "pad_instrument" in config and config["pad_instrument"] is not None:
-                parsed_params["pad_instrument"] = config["pad_instrument"]
-                break
-        if parsed_params["pad_instrument"] is None:
-            for inst_name, midi_num in INSTRUMENT_MIDI_MAP.items():
-                if f"{inst_name} pad" in prompt_lower or f"pad {inst_name}" in prompt_lower or "strings" in prompt_lower or "choir" in prompt_lower:
-                    parsed_params["pad_instrument"] = midi_num
+            for phrase, midi_num in PROMPT_CHORD_FALLBACK:
+                if phrase in hits:
+                    chord_instrument = midi_num
                     break
-            else:
-                if "pad" in prompt_lower:
-                    parsed_params["pad_instrument"] = 88
-
-    if "arpeggio" in prompt_lower:
-        parsed_params["add_arpeggio"] = True
-
-    if "no drums" in prompt_lower or "without drums" in prompt_lower:
-        parsed_params["add_drums"] = False
-    elif "drums" in prompt_lower:
-        parsed_params["add_drums"] = True
-
-    for keyword, config in GENRE_MAP.items():
-        if keyword in prompt_lower:
-            if "mood_major" in config:
-                parsed_params["major_key"] = config["mood_major"]
-            if "mood_minor" in config:
-                parsed_params["major_key"] = not config["mood_minor"]
-            if "chords_preset" in config:
-                parsed_params["chord_progression_type"] = config["chords_preset"]
-            if "drums_preset" in config:
-                if config["drums_preset"] == "none":
-                    parsed_params["add_drums"] = False
-
-    parsed_params["temperature"] = max(0.1, min(2.0, parsed_params["temperature"]))
-
-    # --- Nové rozpoznání stylu akordů ---
-    # --- rozpoznání stylu akordů (rozšířené) ---
-    if any(w in prompt_lower for w in [
-        "seventh chord", "7th chord", "maj7", "major 7", "minor 7", "min7"
-    ]):
-        parsed_params["chord_style"] = "seventh"
-
-    elif any(w in prompt_lower for w in [
-        "sus chord", "suspended", "sus4", "sus2"
-    ]):
-        parsed_params["chord_style"] = "sus"
-
-    elif any(w in prompt_lower for w in [
-        "diminished", "dim chord", "dim7", "o7"
-    ]):
-        parsed_params["chord_style"] = "diminished"
-
-    elif any(w in prompt_lower for w in [
-        "augmented", "aug chord", "aug7", "+7"
-    ]):
-        parsed_params["chord_style"] = "augmented"
-
-    elif any(w in prompt_lower for w in [
-        "transition chord", "chromatic", "intermediate chord"
-    ]):
-        parsed_params["chord_style"] = "transition"
 
-    else:
-        parsed_params["chord_style"] = "standard"
+    if not ("no pad" in hits or "without pad" in hits):
+        pad_instrument = genre_value("pad_instrument", skip_none=True)
+        if pad_instrument is None:
+            # "strings"/"choir" kdekoli v promptu vybere hned první nástroj slovníku
+            if "strings" in hits or "choir" in hits:
+                pad_instrument = next(iter(INSTRUMENT_MIDI_MAP.values()))
+            else:
+                inst_name = _first_phrase(hits, PAD_PHRASES)
+                if inst_name is not None:
+                    pad_instrument = INSTRUMENT_MIDI_MAP[inst_name]
+                elif "pad" in hits:
+                    pad_instrument = 88
+
+    add_arpeggio = "arpeggio" in hits
+
+    if "no drums" in hits or "without drums" in hits:
+        add_drums = False
+
+    for keyword in genres:
+        config = GENRE_MAP[keyword]
+        if "mood_major" in config:
+            major_key = config["mood_major"]
+        if "mood_minor" in config:
+            major_key = not config["mood_minor"]
+        if "chords_preset" in config:
+            chord_progression_type = config["chords_preset"]
+        if config.get("drums_preset") == "none":
+            add_drums = False
+
+    temperature = max(0.1, min(2.0, temperature))
+
+    # --- rozpoznání stylu akordů ---
+    chord_style = "standard"
+    for style, words in PROMPT_CHORD_STYLES:
+        if any(word in hits for word in words):
+            chord_style = style
+            break
 
-    parsed_params["genre"] = detected_Genre
+    return PromptParams(
+        length=length, tempo=tempo, temperature=temperature,
+        melody_instrument=melody_instrument, bass_instrument=bass_instrument,
+        chord_instrument=chord_instrument, pad_instrument=pad_instrument,
+        add_drums=add_drums, chord_progression_type=chord_progression_type,
+        major_key=major_key, add_arpeggio=add_arpeggio, model=model,
+        chord_style=chord_style, genre=detected_genre, prompt_lower=prompt_lower
+    )
 
-    parsed_params["prompt_lower"] = prompt_lower
+def parse_prompt(prompt, current_params):
+    """
+    Vrátí parametry z promptu jako nový slovník (volající ho dál upravuje),
+    samotný rozbor se pro opakované prompty bere z cache.
+    """
+    params = compile_prompt(
+        prompt.lower(),
+        current_params.get("length", 30),
+        current_params.get("tempo", 120),
+        current_params.get("temperature", 1.0),
+        current_params.get("instrument", 0),
+        current_params.get("model", "basic_rnn")
+    )
+    return asdict(params)
 
-    return parsed_params
+# --- konec rozboru promptu --------------------------------------------------
 
 @app.route("/")
 def index():
     return render_template("index.html")
 
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+def decorate_history_record(record):
+    record['instrument_name'] = REVERSE_INSTRUMENT_MIDI_MAP.get(record.get('melody_instrument'), f"Unknown ({record.get('melody_instrument')})")
+    record['bass_instrument_name'] = REVERSE_INSTRUMENT_MIDI_MAP.get(record.get('bass_instrument'), f"Unknown ({record.get('bass_instrument')})")
+    record['chord_instrument_name'] = REVERSE_INSTRUMENT_MIDI_MAP.get(record.get('chord_instrument'), f"Unknown ({record.get('chord_instrument')})")
+    record['pad_instrument_name'] = REVERSE_INSTRUMENT_MIDI_MAP.get(record.get('pad_instrument'), "None")
+    return record
+
+def parse_history_filters(args):
+    """Filtry historie z query stringu; neplatná hodnota vyhodí ValueError."""
+    filters = {
+        "genre": args.get("genre") or None,
+        "model": args.get("model") or None,
+        "tempo_min": float(args["tempo_min"]) if args.get("tempo_min") else None,
+        "tempo_max": float(args["tempo_max"]) if args.get("tempo_max") else None,
+        "date_from": datetime.strptime(args["date_from"], "%Y-%m-%d").date() if args.get("date_from") else None,
+        "date_to": datetime.strptime(args["date_to"], "%Y-%m-%d").date() if args.get("date_to") else None,
+    }
+    return filters
+
 @app.route("/history")
 def history():
-    records = load_history()
-    for record in records:
-        record['instrument_name'] = REVERSE_INSTRUMENT_MIDI_MAP.get(record.get('melody_instrument'), f"Unknown ({record.get('melody_instrument')})")
-        record['bass_instrument_name'] = REVERSE_INSTRUMENT_MIDI_MAP.get(record.get('bass_instrument'), f"Unknown ({record.get('bass_instrument')})")
-        record['chord_instrument_name'] = REVERSE_INSTRUMENT_MIDI_MAP.get(record.get('chord_instrument'), f"Unknown ({record.get('chord_instrument')})")
-        record['pad_instrument_name'] = REVERSE_INSTRUMENT_MIDI_MAP.get(record.get('pad_instrument'), "None")
-    return render_template("history.html", records=records)
+    # Záznamy si stránka dotahuje postupně přes /api/history při posouvání
+    return render_template("history.html", models=list(BUNDLE_PATHS), page_size=HISTORY_PAGE_SIZE)
+
+@app.route("/api/history")
+def history_api():
+    try:
+        filters = parse_history_filters(request.args)
+        limit = max(1, min(HISTORY_MAX_PAGE_SIZE, int(request.args.get("limit", HISTORY_PAGE_SIZE))))
+    except ValueError:
+        return jsonify({"error": "Neplatný filtr historie."}), 400
+
+    cursor = parse_history_cursor(request.args.get("cursor"))
+    records = load_history(limit=limit + 1, cursor=cursor, **filters)
+    # Záznam navíc jen prozradí, jestli existuje další stránka
+    next_cursor = history_cursor(records[limit - 1]) if len(records) > limit else None
+    return jsonify({
+        "records": [decorate_history_record(record) for record in records[:limit]],
+        "next_cursor": next_cursor
+    })
 
 def get_section_type(i):
     types = ["verse", "chorus", "bridge", "outro"]
     return types[i % len(types)]
 
 def apply_tempo_curve(note_sequence, section_types, base_tempo=120):
-    section_length = 8  # sekund
+    section_length = SECTION_DURATION  # sekund
 
     for i, section in enumerate(section_types):
         tempo_change = base_tempo
@@ -644,148 +3252,24 @@ def apply_tempo_curve(note_sequence, section_types, base_tempo=120):
         note_sequence.tempos.add().qpm = tempo_change
         note_sequence.tempos[-1].time = i * section_length
 
-@app.route("/generate_music", methods=["POST"])
-def generate_music(section_types=None):
-    data = request.json
-    if not data:
-        return jsonify({"error": "Nebyla poskytnuta žádná data."}), 400
-
-    # Původní hodnoty, které se případně přepíší z promptu
-    current_params = {
-        "length": 30, "tempo": 120, "temperature": 1.0,
-        "model": "basic_rnn", "instrument": 0 # Defaultní hlavní nástroj (piano)
-    }
-    prompt = data.get("prompt", "")
-    title = data.get("title", "").strip()
-    parsed_params = parse_prompt(prompt, current_params)
-    prompt_lower = parsed_params.get("prompt_lower", "")
-
-    # pokud uživatel zvolil předvolbu, použij její hodnoty
-    preset = data.get("preset")
-    PRESETS = {
-        'pop_default': {'model':'lookback_rnn','genre':'pop','length':30,'tempo':120,'temperature':1.0},
-        'rock_fast': {'model':'basic_rnn','genre':'rock','length':30,'tempo':160,'temperature':0.8},
-        'jazz_slow': {'model':'attention_rnn','genre':'jazz','length':30,'tempo':90,'temperature':1.2},
-    }
-    if preset in PRESETS:
-        for k, v in PRESETS[preset].items():
-            parsed_params[k] = v
-
-
-    # přepiš hodnoty z dropdownů, pokud přišly
-    if data.get("model"):
-        parsed_params["model"] = data["model"]
-    if data.get("genre"):
-        parsed_params["genre"] = data["genre"]
-    if data.get("length"):
-        parsed_params["length"] = int(data["length"])
-    if data.get("tempo"):
-        parsed_params["tempo"] = float(data["tempo"])
-    if data.get("temperature"):
-        parsed_params["temperature"] = float(data["temperature"])
-    # případně tempo, temperature, instrument atp. stejným způsobem
-
-    length = parsed_params["length"]
-    tempo = parsed_params["tempo"]
-    temperature = parsed_params["temperature"]
-    model = parsed_params["model"]
-    layers = prepare_layers_for_genre(parsed_params.get("genre") or "pop",
-        melody_instrument=parsed_params["melody_instrument"],
-        pad_instrument=parsed_params["pad_instrument"])
-
-    melody_instrument = layers["melody"]
-    # Pokud je žánr rock, nechceme melodii (vypneme ji nastavením na None)
-    if parsed_params.get("genre") == "rock":
-        melody_instrument = None
-
-    bass_instrument   = layers["bass"]
-    chord_instrument  = layers["chords"]
-    pad_instrument    = layers["pad"]
-    add_drums         = layers["drums"] is not None
-
-    chord_progression_type = parsed_params["chord_progression_type"]
-    major_key = parsed_params["major_key"]
-    add_arpeggio = parsed_params["add_arpeggio"]
-
-    bundle_path = BUNDLE_PATHS.get(model)
-    if not bundle_path or not os.path.exists(bundle_path):
-        return jsonify({"error": f"Model '{model}' nebyl nalezen."}), 400
-
-    try:
-        bundle = sequence_generator_bundle.read_bundle_file(bundle_path)
-        generator_map = melody_rnn_sequence_generator.get_generator_map()
-        melody_rnn = generator_map[model](checkpoint=None, bundle=bundle)
-        melody_rnn.initialize()
-    except Exception as e:
-        return jsonify({"error": f"Chyba při inicializaci modelu Magenta: {str(e)}"}), 500
-
-    input_sequence = music_pb2.NoteSequence()
-    input_sequence.notes.add(pitch=60, start_time=0.0, end_time=0.5, velocity=80)
-    input_sequence.total_time = 0.5
-    # První tempo (počáteční hodnota), detailnější křivku aplikujeme až později
-    input_sequence.tempos.add(qpm=tempo)
-
-    # Vytvoření sekcí skladby (intro + hlavní části)
-    section_duration = 8  # délka sekce v sekundách
-    sections = int(length // section_duration)
-    section_types = ["intro"] + [get_section_type(i) for i in range(sections)]
-
-    full_sequence = music_pb2.NoteSequence()
-    start_time = 0.5
-
-    # Vytvoření prázdné základní sekvence pro generování
-    primer_sequence = music_pb2.NoteSequence()
-    primer_sequence.tempos.add(qpm=tempo)  # tempo už máš definované z promptu
-    primer_sequence.ticks_per_quarter = 220
-
-    # Načti .mag model
-    bundle = sequence_generator_bundle.read_bundle_file('bundles/lookback_rnn.mag')
-
-    # Vytvoř generátor
-    generator_map = melody_rnn_sequence_generator.get_generator_map()
-    generator = generator_map['lookback_rnn'](checkpoint=None, bundle=bundle)
-
-    generator.initialize()
-
-    for section_type in section_types:
-        section_length = section_duration
-        generated = generate_section(
-            generator=melody_rnn,
-            primer_sequence=primer_sequence,
-            total_steps=section_length,
-            temperature=temperature
-            )
-
-    for note in generated.notes:
-        full_sequence.notes.add().CopyFrom(note)
-        start_time += section_length
-
-    note_sequence = full_sequence
-
-    # Výpočet sekcí a jejich typů před aplikací tempa
-    section_duration = 8  # délka sekce v sekundách
-    custom_section_match = re.findall(r'(intro|verse|chorus|bridge|outro)', prompt_lower)
-    if custom_section_match:
-        section_types = custom_section_match
-    else:
-        sections = int(length // section_duration)
-        section_types = ["intro"] + [get_section_type(i) for i in range(sections)]
-
-    # Aplikace tempo křivky
-    apply_tempo_curve(note_sequence, section_types, base_tempo=tempo)
-
-    # Nové styly akordů podle typu
-    chord_style = parsed_params.get("chord_style", "standard")
-
-    output_sequence = primer_sequence
-    start_time = primer_sequence.total_time
+def accompaniment_notes(length, arrangement):
+    """
+    Doprovod skladby (akordy, bas, bicí, pad, arpeggio) jako pole NOTE_DTYPE.
 
-    sections = ['intro', 'verse', 'chorus', 'verse' 'bridge', 'outro']
-    for section in sections:
-        generated_part, duration = generate_section_with_style(generator, output_sequence, section, start_time)
-        start_time += duration
-        output_sequence.notes.extend(generated_part.notes)
-        output_sequence.total_time = start_time
+    `arrangement` je slovník s nastavením vrstev, jak ho sestaví run_generation.
+    Doprovod nezávisí na melodii, takže ho streamované generování může
+    sestavit předem a rozdělit po sekcích.
+    """
+    chord_style = arrangement["chord_style"]
+    chord_progression_type = arrangement["chord_progression_type"]
+    major_key = arrangement["major_key"]
+    melody_instrument = arrangement["melody_instrument"]
+    bass_instrument = arrangement["bass_instrument"]
+    chord_instrument = arrangement["chord_instrument"]
+    pad_instrument = arrangement["pad_instrument"]
+    add_drums = arrangement["add_drums"]
+    add_arpeggio = arrangement["add_arpeggio"]
+    prompt_lower = arrangement["prompt_lower"]
 
     if chord_style == "seventh":
         chord_progression = [
@@ -862,113 +3346,15 @@ def generate_music(section_types=None):
         ]
 
     measure_duration = 2.0
-    total_chord_beats = len(chord_progression) * measure_duration
-    num_repetitions = int(length / total_chord_beats) + 1
-
-    for rep in range(num_repetitions):
-        for i, chord in enumerate(chord_progression):
-            start = (rep * total_chord_beats) + (i * measure_duration)
-            if start >= length:
-                break
-            end = start + 1.5
-            for pitch in chord:
-                chord_note = note_sequence.notes.add()
-                chord_note.pitch = pitch
-                chord_note.start_time = start
-                chord_note.end_time = end
-                chord_note.velocity = 70
-                chord_note.instrument = 2
-                chord_note.program = chord_instrument
-                chord_note.is_drum = False
-        if start >= length:
-            break
-
-    # Basová linka
-    for i in range(0, length, 2):
-        if i >= length:
-            break
-        bass_note = note_sequence.notes.add()
-        bass_note.pitch = 36
-        bass_note.start_time = i
-        bass_note.end_time = i + 1.5
-        bass_note.velocity = 80
-        bass_note.instrument = 1
-        bass_note.program = bass_instrument
-        bass_note.is_drum = False
-
 
+    layers = [
+        build_layer("chords", chord_layer, chord_progression, length, chord_instrument, measure_duration),
+        build_layer("bass", bass_layer, length, bass_instrument),
+    ]
     if add_drums:
-        for i in range(0, length):
-            if i >= length:
-                break
-            kick = note_sequence.notes.add()
-            kick.pitch = 36
-            kick.start_time = i
-            kick.end_time = i + 0.2
-            kick.velocity = 100
-            kick.instrument = 9
-            kick.is_drum = True
-
-            if (i % measure_duration) == 0:
-                snare = note_sequence.notes.add()
-                snare.pitch = 38
-                snare.start_time = i + 1.0
-                snare.end_time = i + 1.2
-                snare.velocity = 90
-                snare.instrument = 9
-                snare.is_drum = True
-
-            hihat = note_sequence.notes.add()
-            hihat.pitch = 42
-            hihat.start_time = i
-            hihat.end_time = i + 0.1
-            hihat.velocity = 70
-            hihat.instrument = 9
-            hihat.is_drum = True
-
-            hihat2 = note_sequence.notes.add()
-            hihat2.pitch = 42
-            hihat2.start_time = i + 0.5
-            hihat2.end_time = i + 0.6
-            hihat2.velocity = 70
-            hihat2.instrument = 9
-            hihat2.is_drum = True
-
+        layers.append(build_layer("drums", drum_layer, length, measure_duration))
     if pad_instrument is not None:
-        for rep in range(num_repetitions):
-            for i, chord in enumerate(chord_progression):
-                start = (rep * total_chord_beats) + (i * measure_duration)
-                if start >= length:
-                    break
-                end = start + measure_duration
-                pad_root_note = note_sequence.notes.add()
-                pad_root_note.pitch = chord[0] - 12
-                pad_root_note.start_time = start
-                pad_root_note.end_time = end
-                pad_root_note.velocity = 60
-                pad_root_note.instrument = 3
-                pad_root_note.program = pad_instrument
-                pad_root_note.is_drum = False
-
-                pad_third_note = note_sequence.notes.add()
-                pad_third_note.pitch = chord[1] - 12
-                pad_third_note.start_time = start
-                pad_third_note.end_time = end
-                pad_third_note.velocity = 60
-                pad_third_note.instrument = 3
-                pad_third_note.program = pad_instrument
-                pad_third_note.is_drum = False
-
-                pad_fifth_note = note_sequence.notes.add()
-                pad_fifth_note.pitch = chord[2] - 12
-                pad_fifth_note.start_time = start
-                pad_fifth_note.end_time = end
-                pad_fifth_note.velocity = 60
-                pad_fifth_note.instrument = 3
-                pad_fifth_note.program = pad_instrument
-                pad_fifth_note.is_drum = False
-            if start >= length:
-                break
+        layers.append(build_layer("pad", pad_layer, chord_progression, length, pad_instrument, measure_duration))
 
     if add_arpeggio:
         prompt_style = "up"  # výchozí
@@ -980,12 +3366,9 @@ def generate_music(section_types=None):
         elif "random arpeggio" in prompt_lower:
             prompt_style = "random"
 
-        # Pak pokračuje funkce make_pattern a použití arpeggia
-
-
-        arpeggio_instrument = melody_instrument if melody_instrument != 0 else 80
-        arpeggio_velocity   = 85
-        note_dur            = 0.25  # délka jedné noty
+        arpeggio_instrument = melody_instrument if melody_instrument not in (0, None) else 80
+        # Vlastní generátor se seedem požadavku – stejný seed dá stejné pořadí tónů
+        rng = random.Random(arrangement.get("seed"))
 
         def make_pattern(ch):
             if prompt_style == "up":
@@ -995,167 +3378,1138 @@ def generate_music(section_types=None):
             if prompt_style == "up_down":
                 return ch + list(reversed(ch[:-1]))
             if prompt_style == "random":
-                import random, copy
                 pat = copy.copy(ch)
-                random.shuffle(pat)
+                rng.shuffle(pat)
                 return pat
             return ch
 
-        for rep in range(num_repetitions):
-            for i, chord in enumerate(chord_progression):
-                base = (rep * total_chord_beats) + (i * measure_duration)
-                if base >= length:
-                    break
-                pattern = make_pattern(chord)
-                for j, pitch in enumerate(pattern):
-                    t_start = base + j * note_dur
-                    if t_start >= base + measure_duration or t_start >= length:
-                        break
-                    n = note_sequence.notes.add()
-                    n.pitch       = pitch
-                    n.start_time  = t_start
-                    n.end_time    = t_start + note_dur * 0.8
-                    n.velocity    = arpeggio_velocity
-                    n.instrument  = 4
-                    n.program     = arpeggio_instrument
-                    n.is_drum     = False
-            if base >= length:
-                break
+        layers.append(build_layer("arpeggio", arpeggio_layer, chord_progression, length,
+                                  arpeggio_instrument, make_pattern, measure_duration))
 
-    # --- úsek po veškerém přidávání not, těsně před uložením do MIDI ---
-    MIN_NOTE_DURATION = 0.5   # minimální délka tónu (s) – klidně si uprav
+    accompaniment = np.concatenate(layers)
 
     if melody_instrument is not None:
-        for note in note_sequence.notes:
-            if not note.is_drum:
-                duration = note.end_time - note.start_time
-                if duration < MIN_NOTE_DURATION:
-                    note.end_time = note.start_time + MIN_NOTE_DURATION
+        # prodluž krátké tóny – doprovod najednou, melodii pak style_melody
+        short = ~accompaniment["is_drum"] & (accompaniment["end"] - accompaniment["start"] < MIN_NOTE_DURATION)
+        accompaniment["end"][short] = accompaniment["start"][short] + MIN_NOTE_DURATION
+    return accompaniment
 
-                # b) sjednoť nástroj melodické vrstvy (nástroje 1-4 a 9 už necháváme)
-                if note.instrument not in [1, 2, 3, 4, 9]:
-                    note.instrument = 0
-                    note.program = melody_instrument
+MIN_NOTE_DURATION = 0.5   # minimální délka tónu (s) – klidně si uprav
 
-    safe_title = title.replace(" ", "_") if title else ""
+def style_melody(notes, melody_instrument):
+    """
+    Úprava not melodie těsně před uložením do MIDI: prodloužení krátkých
+    tónů a sjednocení nástroje melodické vrstvy.
+    """
+    if melody_instrument is None:
+        return
+    for note in notes:
+        if not note.is_drum:
+            duration = note.end_time - note.start_time
+            if duration < MIN_NOTE_DURATION:
+                note.end_time = note.start_time + MIN_NOTE_DURATION
+
+            # sjednoť nástroj melodické vrstvy (nástroje 1-4 a 9 už necháváme)
+            if note.instrument not in [1, 2, 3, 4, 9]:
+                note.instrument = 0
+                note.program = melody_instrument
+
+@dataclass
+class ArrangedSong:
+    """Skladba po aranžmá: noty NOTE_DTYPE (melodie + doprovod) a tempa [(čas v s, qpm)]."""
+    notes: np.ndarray
+    tempos: list
+    ticks_per_quarter: int = MIDI_TICKS_PER_QUARTER
+
+def song_to_midi_bytes(song):
+    return midi_bytes(song.notes, song.tempos, song.ticks_per_quarter)
+
+def arrange_song(note_sequence, length, arrangement, accompaniment=None):
+    """
+    Sjednotí nástroj melodické vrstvy a přidá k ní doprovod (akordy, bas, bicí,
+    pad, arpeggio). Doprovod se do NoteSequence nezapisuje – výsledkem je
+    ArrangedSong, jehož pole not jde rovnou do midi_bytes a syntezátoru.
+    Předem sestavený doprovod (streamované generování) lze předat v `accompaniment`.
+    """
+    if accompaniment is None:
+        accompaniment = accompaniment_notes(length, arrangement)
+    style_melody(note_sequence.notes, arrangement["melody_instrument"])
+    NOTES_EMITTED.inc(len(note_sequence.notes), layer="melody")
+    return ArrangedSong(np.concatenate([sequence_note_array(note_sequence), accompaniment]),
+                        [(tempo.time, tempo.qpm) for tempo in note_sequence.tempos],
+                        note_sequence.ticks_per_quarter or MIDI_TICKS_PER_QUARTER)
+
+def primer_sequence(tempo):
+    """
+    Úvodní nota (C4), na kterou model navazuje.
+    """
+    sequence = music_pb2.NoteSequence()
+    sequence.notes.add(pitch=60, start_time=0.0, end_time=0.5, velocity=80)
+    sequence.total_time = 0.5
+    # První tempo (počáteční hodnota), detailnější křivku aplikujeme až později
+    sequence.tempos.add(qpm=tempo)
+    sequence.ticks_per_quarter = 220
+    return sequence
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+def build_arrangement(parsed_params):
+    """
+    Nastavení doprovodných vrstev pro arrange_song z rozebraného promptu
+    (po případném přepsání předvolbou nebo hodnotami z formuláře).
+    """
+    layers = prepare_layers_for_genre(parsed_params.get("genre") or "pop",
+        melody_instrument=parsed_params["melody_instrument"],
+        pad_instrument=parsed_params["pad_instrument"])
 
-    if safe_title:
-        # Použijeme pouze název od uživatele
-        midi_filename = f"{safe_title}.mid"
-        wav_filename = f"{safe_title}.wav"
-    else:
-        # Výchozí název s detaily skladby
-        midi_filename = f"generated_{model}_{length}s_{tempo}bpm_{timestamp}.mid"
-        wav_filename = f"generated_{model}_{length}s_{tempo}bpm_{timestamp}.wav"
+    melody_instrument = layers["melody"]
+    # Pokud je žánr rock, nechceme melodii (vypneme ji nastavením na None)
+    if parsed_params.get("genre") == "rock":
+        melody_instrument = None
+
+    return {
+        # Nové styly akordů podle typu
+        "chord_style": parsed_params.get("chord_style", "standard"),
+        "chord_progression_type": parsed_params["chord_progression_type"],
+        "major_key": parsed_params["major_key"],
+        "melody_instrument": melody_instrument,
+        "bass_instrument": layers["bass"],
+        "chord_instrument": layers["chords"],
+        "pad_instrument": layers["pad"],
+        "add_drums": layers["drums"] is not None,
+        "add_arpeggio": parsed_params["add_arpeggio"],
+        "prompt_lower": parsed_params.get("prompt_lower", ""),
+        "seed": parsed_params.get("seed"),
+    }
+
+# --- streamované generování po sekcích ------------------------------------------
+def section_chunk(melody, accompaniment, section, start, end, melody_instrument):
+    """
+    Samostatně přehratelná sekce (pole NOTE_DTYPE): noty melodie a doprovodu,
+    které v ní začínají, posunuté na začátek sekce a zkrácené na její konec.
+    """
+    section_melody = music_pb2.NoteSequence()
+    for note in melody.notes:
+        if start <= note.start_time < end:
+            section_note = section_melody.notes.add()
+            section_note.CopyFrom(note)
+            section_note.instrument = SECTION_INSTRUMENTS.get(section, 0)
+    style_melody(section_melody.notes, melody_instrument)
+    chunk = np.concatenate([sequence_note_array(section_melody),
+                            accompaniment[(accompaniment["start"] >= start) & (accompaniment["start"] < end)]])
+    chunk["start"] -= start
+    chunk["end"] = np.minimum(chunk["end"], end) - start
+    return chunk
+
+
+class SectionStreamer:
+    """
+    Streamované generování: každá sekce se hned po vygenerování doplní
+    doprovodem, vyrenderuje a ohlásí událostí "section" s odkazem na zvuk.
+
+    Render běží ve vlastním vlákně, takže model mezitím generuje další sekci.
+    Sekce se zveřejňují v pořadí, v jakém vznikly; první zvuk tak klient
+    dostane po jedné sekci, ne po celé skladbě.
+    """
+
+    def __init__(self, job, arrangement, accompaniment, audio_format=STREAM_CHUNK_FORMAT):
+        self.job = job
+        self.melody_instrument = arrangement["melody_instrument"]
+        self.accompaniment = accompaniment
+        self.audio_format = audio_format
+        self.first_audio_seconds = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="section-render")
+
+    def __call__(self, index, section, start, end, melody):
+        # Noty se vyberou hned – melodii generátor v dalších sekcích nahrazuje
+        chunk = section_chunk(melody, self.accompaniment, section, start, end, self.melody_instrument)
+        self._executor.submit(self._publish, index, section, start, end, chunk)
+
+    def _publish(self, index, section, start, end, chunk):
+        try:
+            frames = int(round((end - start) * SAMPLE_RATE))
+            with RENDER_SECONDS.time(backend=RENDER_BACKEND):
+                pcm = renderer.render(chunk)
+            # Dozvuk se ořízne, aby sekce na sebe navazovaly přesně
+            pcm = pcm[:frames]
+            if len(pcm) < frames:
+                pcm = np.concatenate([pcm, np.zeros((frames - len(pcm), pcm.shape[1]), dtype=pcm.dtype)])
+            with ENCODE_SECONDS.time(format=self.audio_format):
+                audio_data = encode_audio(pcm, self.audio_format, SAMPLE_RATE)
+        except Exception as e:
+            # Výpadek náhledu sekce úlohu neshodí, celá skladba se renderuje znovu na konci
+            print(f"Sekci {index + 1} ({section}) se nepodařilo vyrenderovat: {e}")
+            return
+
+        _, extension, mime = AUDIO_ENCODERS[self.audio_format]
+        name = f"section_{index + 1:02d}.{extension}"
+        self.job.artifacts[name] = (audio_data, mime)
+        if self.first_audio_seconds is None:
+            self.first_audio_seconds = round(time.time() - self.job.created_at, 4)
+        self.job.events.publish("section", {
+            "index": index,
+            "section": section,
+            "start": start,
+            "end": end,
+            "format": self.audio_format,
+            "audio_url": f"/jobs/{self.job.id}/files/{name}",
+        })
 
-    # Cesty k souborům (vždy se provede)
-    midi_path = os.path.join(OUTPUT_DIR, midi_filename)
-    wav_path = os.path.join(OUTPUT_DIR, wav_filename)
+    def close(self):
+        """Počká, až se vyrenderují všechny ohlášené sekce."""
+        self._executor.shutdown(wait=True)
+# --- konec streamovaného generování -----------------------------------------------
 
-    midi_io.sequence_proto_to_midi_file(note_sequence, midi_path)
+# --- dlouhé skladby ---------------------------------------------------------------
+class LongFormWriter:
+    """
+    Dlouhá skladba po oknech: k oknu melodie se přidá doprovod a noty se
+    rovnou zapisují do MIDI souboru a – se syntezátorem – přehrávají do
+    zvukových souborů. V paměti je jen rozpracované okno, nikdy celá skladba.
 
-    # --- ZAČÁTEK DŮLEŽITÉ OPRAVY ---
-    # Převedeme všechny cesty na absolutní, než je předáme externímu programu
-    abs_fluidsynth_path = os.path.abspath(fluidsynth_executable_path)
-    abs_soundfont_path = os.path.abspath(soundfont_path)
-    abs_midi_path = os.path.abspath(midi_path)
-    abs_wav_path = os.path.abspath(wav_path)
+    Doprovod se skládá z bloků po LONG_FORM_WINDOW_SECONDS, každý s vlastním
+    seedem (seed + pořadí bloku), stejně jako okna melodie.
+    """
 
-    # Převod MIDI na WAV pomocí subprocess a FluidSynth
+    def __init__(self, job, arrangement, length, midi_path, qpm, session=None, audio_paths=None):
+        self.job = job
+        self.arrangement = arrangement
+        self.length = length
+        self.session = session
+        self.scheduler = EventScheduler()
+        self.midi = IncrementalMidiWriter(midi_path, qpm)
+        self.audio_writers = {}
+        for audio_format, path in (audio_paths or {}).items():
+            self.audio_writers[audio_format] = StreamingAudioWriter(path, audio_format)
+        self.notes = 0
+        self._closed = False
+        self._horizon = 0.0       # vše před tímto časem je zapsané
+        self._accompanied = 0.0   # doprovod je přidaný do tohoto času
+        self._blocks = 0
+
+    def _accompaniment(self, until):
+        layers = []
+        while self._accompanied < min(until, self.length):
+            start = self._accompanied
+            end = min(start + LONG_FORM_WINDOW_SECONDS, self.length)
+            arrangement = self.arrangement
+            if arrangement.get("seed") is not None:
+                arrangement = dict(arrangement, seed=(arrangement["seed"] + self._blocks) % 2 ** 32)
+            notes = accompaniment_notes(end - start, arrangement)
+            notes["start"] += start
+            notes["end"] += start
+            layers.append(notes)
+            self._accompanied = end
+            self._blocks += 1
+        return layers
+
+    def _write(self, new_channels, events, until=None):
+        for channel, program, is_drum in new_channels:
+            self.midi.program_change(self._horizon, channel, program)
+            if self.session is not None:
+                self.session.program(channel, program, is_drum)
+        self.midi.write(events)
+        if self.session is not None:
+            for block in self.session.play(events, until):
+                for writer in self.audio_writers.values():
+                    writer.write(block)
+
+    def __call__(self, index, section, start, end, window):
+        style_melody(window.notes, self.arrangement["melody_instrument"])
+        NOTES_EMITTED.inc(len(window.notes), layer="melody")
+        notes = np.concatenate([sequence_note_array(window)] + self._accompaniment(end))
+        new_channels, events = self.scheduler.add(notes, end)
+        self._write(new_channels, events, until=end)
+        self._horizon = max(self._horizon, end)
+        self.notes += len(notes)
+        self.job.events.publish("window", {"index": index, "start": start, "end": end, "notes": len(notes)})
+
+    def finish(self):
+        """Doplní doprovod do konce skladby a dohraje zbylé události i dozvuk."""
+        notes = self._accompaniment(self.length)
+        if notes:
+            new_channels, events = self.scheduler.add(np.concatenate(notes), self._horizon)
+            self.notes += sum(len(layer) for layer in notes)
+        else:
+            new_channels, events = [], []
+        events += self.scheduler.flush()
+        self._write(new_channels, events)
+        if self.session is not None:
+            for block in self.session.samples(int(RENDER_TAIL_SECONDS * self.session.sample_rate)):
+                for writer in self.audio_writers.values():
+                    writer.write(block)
+        self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.midi.close()
+        for writer in self.audio_writers.values():
+            writer.close()
+
+
+def transcode_wav(wav_path, audio_paths, block_frames=SAMPLE_RATE * 10):
+    """WAV z fluidsynth (záložní renderer) → výstupní formáty, po blocích."""
+    writers = {}
     try:
-        if not os.path.exists(soundfont_path):
-            return jsonify({"error": f"SoundFont soubor nebyl nalezen na absolutní cestě: {abs_soundfont_path}"}), 500
-        if not os.path.exists(abs_midi_path):
-            return jsonify({"error": f"Vstupní MIDI soubor nebyl nalezen na absolutní cestě: {abs_midi_path}"}), 500
-
-        result = subprocess.run([
-            abs_fluidsynth_path,  # Používáme absolutní cestu
-            "-ni",
-            abs_soundfont_path,  # Používáme absolutní cestu
-            abs_midi_path,       # Používáme absolutní cestu
-            "-F", abs_wav_path,  # Používáme absolutní cestu
-            "-r", "44100"
-        ], check=True, capture_output=True, text=True, encoding='utf-8')
-
-        if not os.path.exists(abs_wav_path) or os.path.getsize(abs_wav_path) == 0:
-            error_message = f"Převod na WAV selhal (soubor je prázdný nebo nebyl vytvořen). Hláška z FluidSynth: {result.stderr}"
-            return jsonify({"error": error_message}), 500
-
-    except subprocess.CalledProcessError as e:
-        error_output = e.stderr or "FluidSynth neposkytl žádnou chybovou hlášku."
-        return jsonify({"error": f"Chyba při převodu MIDI na WAV (kód {e.returncode}): {error_output}"}), 500
-    except FileNotFoundError:
-        return jsonify({"error": "FluidSynth nebyl nalezen. Zkontrolujte cestu v proměnné 'fluidsynth_executable_path'."}), 500
-    # --- KONEC DŮLEŽITÉ OPRAVY ---
-
-    history_record = {
-        "title": title or "Bez názvu",
-        "timestamp": timestamp,
-        "model": model,
-        "length": length,
-        "tempo": tempo,
-        "temperature": temperature,
-        "genre": parsed_params.get("genre") or "-",
-        "melody_instrument": melody_instrument,
-        "bass_instrument": bass_instrument,
-        "chord_instrument": chord_instrument,
-        "pad_instrument": pad_instrument,
-        "add_drums": add_drums,
-        "chord_progression_type": chord_progression_type,
-        "major_key": major_key,
-        "add_arpeggio": add_arpeggio,
-        "prompt": prompt,
-        "midi_file": f"/download_music/{os.path.basename(midi_path)}",
-        "wav_file": f"/download_music/{os.path.basename(wav_path)}"
-    }
-    save_history(history_record)
+        with soundfile.SoundFile(wav_path) as source:
+            for audio_format, path in audio_paths.items():
+                writers[audio_format] = StreamingAudioWriter(path, audio_format, source.samplerate, source.channels)
+            for block in source.blocks(blocksize=block_frames, dtype="int16"):
+                for writer in writers.values():
+                    writer.write(block)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def run_long_form(job, parsed_params, arrangement, plan, audio_formats, base_name, stats):
+    """
+    Dlouhá skladba (long-form): melodie po oknech z infer_long_form jde přímo
+    do LongFormWriter, paměť tak nezávisí na délce. Výstupy vznikají jako
+    soubory v dočasném adresáři a do úložiště se přesunou přes put_file –
+    ukládají se vždy, v paměti úlohy by se nevešly.
+
+    Je to generátor jako run_generation: okna se zapisují ve fázi generate,
+    `yield "arrange"` předá dopsání doprovodu a dozvuku, `yield "render"`
+    záložní render a uložení. Vrací (klíč MIDI, {formát: klíč zvuku}).
+    """
+    tempo = parsed_params["tempo"]
+    work_dir = tempfile.mkdtemp(prefix="long-form-")
+    try:
+        midi_path = os.path.join(work_dir, f"{base_name}.mid")
+        audio_paths = {fmt: os.path.join(work_dir, f"{base_name}.{AUDIO_ENCODERS[fmt][1]}")
+                       for fmt in audio_formats}
+        # Syntezátor přehrává okna průběžně, záložní renderer až hotové MIDI.
+        # Syntezátor je vlastní, mimo pool – ten zůstává renderům ostatních úloh.
+        synth = isinstance(renderer, FluidSynthRenderer)
+        with (renderer.session(dedicated=True) if synth else nullcontext()) as session:
+            writer = LongFormWriter(job, arrangement, parsed_params["length"], midi_path, tempo, session,
+                                    audio_paths if synth else None)
+            try:
+                infer_long_form(parsed_params["model"], primer_sequence(tempo), plan,
+                                parsed_params["temperature"], stats, writer, parsed_params["seed"])
+                yield "arrange"
+                job.enter_stage("arrange")
+                with RENDER_SECONDS.time(backend=RENDER_BACKEND):
+                    writer.finish()
+            except BaseException:
+                writer.close()
+                raise
+        stats["notes"] = writer.notes
+
+        # MIDI soubor je po finish() hotový, záložní renderer z něj teprve renderuje
+        job.enter_stage("midi")
+        BYTES_WRITTEN.inc(os.path.getsize(midi_path), format="mid", target="storage")
+
+        yield "render"
+        job.enter_stage("render")
+        # Živý stream se pro dlouhé skladby neotevírá – posluchač dostane hotový soubor
+        job.streams_ready.set()
+        if not synth:
+            wav_path = os.path.join(work_dir, "render.wav")
+            with RENDER_SECONDS.time(backend=RENDER_BACKEND):
+                renderer._run(midi_path, wav_path)
+            transcode_wav(wav_path, audio_paths)
+        midi_name = artifact_storage.put_file(f"{base_name}.mid", midi_path)
+        audio_names = {}
+        for audio_format, path in audio_paths.items():
+            if os.path.getsize(path) == 0:
+                raise GenerationError("Převod na zvuk selhal (renderer nevrátil žádný zvuk).", 500)
+            BYTES_WRITTEN.inc(os.path.getsize(path), format=audio_format, target="storage")
+            audio_names[audio_format] = artifact_storage.put_file(os.path.basename(path), path)
+        return midi_name, audio_names
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+# --- konec dlouhých skladeb -------------------------------------------------------
+
+# Původní hodnoty, které se případně přepíší z promptu
+DEFAULT_PARAMS = {
+    "length": 30, "tempo": 120, "temperature": 1.0,
+    "model": "basic_rnn", "instrument": 0 # Defaultní hlavní nástroj (piano)
+}
 
-    # Po úspěšném vygenerování souborů vracíme jejich názvy
-    return jsonify({
-        "midi_file": f"/download_music/{os.path.basename(midi_path)}",
-        "wav_file": f"/download_music/{os.path.basename(wav_path)}"
-    })
+PRESETS = {
+    'pop_default': {'model':'lookback_rnn','genre':'pop','length':30,'tempo':120,'temperature':1.0},
+    'rock_fast': {'model':'basic_rnn','genre':'rock','length':30,'tempo':160,'temperature':0.8},
+    'jazz_slow': {'model':'attention_rnn','genre':'jazz','length':30,'tempo':90,'temperature':1.2},
+}
 
-def generate_jazzy_chords(notes, chord, start_time, chord_instrument):
-    pass
+def run_generation(data, job):
+    """
+    Celý generovací řetězec jedné skladby (prompt → melodie → vrstvy → MIDI → WAV).
 
-def generate_section(generator, primer_sequence, total_steps=16, temperature=1.0):
-    from note_seq.protobuf import generator_pb2
+    Běží ve vláknech fronty úloh, průběh hlásí přes job.enter_stage(...).
+    Je to generátor: `yield "arrange"` a `yield "render"` předávají úlohu
+    další fázi pipeline (JobManager), výsledek se vrací přes return.
+    Chyby se nevrací jako HTTP odpověď, ale vyhazují se jako GenerationError.
+    """
+    job.enter_stage("parse")
 
-    generator_options = generator_pb2.GeneratorOptions()
-    generate_section = generator_options.generate_sections.add()
-    generate_section.start_time = primer_sequence.total_time
-    generate_section.end_time = primer_sequence.total_time + total_steps
-    generator_options.args['temperature'].float_value = temperature
+    prompt = data.get("prompt", "")
+    title = data.get("title", "").strip()
+    parsed_params = parse_prompt(prompt, dict(DEFAULT_PARAMS))
+    prompt_lower = parsed_params.get("prompt_lower", "")
 
-    # Tady je klíčová oprava: zavoláme metodu `generate()` na instanci generátoru
-    generated_sequence = generate_full_song(generator, primer_sequence)
+    # pokud uživatel zvolil předvolbu, použij její hodnoty
+    preset = data.get("preset")
+    if preset in PRESETS:
+        for k, v in PRESETS[preset].items():
+            parsed_params[k] = v
 
-    return generated_sequence
 
-    # Spoj původní a novou část
-    final_sequence = magenta.music.sequences_lib.concatenate_sequences([primer_sequence, generated_sequence])
-    notes = final_sequence.notes
+    # přepiš hodnoty z dropdownů, pokud přišly
+    if data.get("model"):
+        parsed_params["model"] = data["model"]
+    if data.get("genre"):
+        parsed_params["genre"] = data["genre"]
+    if data.get("length"):
+        parsed_params["length"] = int(data["length"])
+    if data.get("tempo"):
+        parsed_params["tempo"] = float(data["tempo"])
+    if data.get("temperature"):
+        parsed_params["temperature"] = float(data["temperature"])
+    # případně tempo, temperature, instrument atp. stejným způsobem
 
-    # Akord – například C dur
-    chord = [60, 64, 67]
+    # Seed určuje vzorkování melodie i náhodné arpeggio – stejný seed dá stejnou skladbu.
+    # Jen když ho klient pošle: generování se seedem se v procesu střídá pod zámkem,
+    # bez seedu běží souběžně a výsledek není opakovatelný.
+    seed = data.get("seed")
+    if seed is None or seed == "":
+        seed = None
+    else:
+        try:
+            seed = int(seed)
+        except (TypeError, ValueError):
+            seed = -1
+        if not 0 <= seed < 2 ** 32:
+            raise GenerationError("Seed musí být celé číslo od 0 do 4294967295.", 400)
+    parsed_params["seed"] = seed
+
+    length = parsed_params["length"]
+    tempo = parsed_params["tempo"]
+    temperature = parsed_params["temperature"]
+    model = parsed_params["model"]
+    arrangement = build_arrangement(parsed_params)
+    melody_instrument = arrangement["melody_instrument"]
+    bass_instrument = arrangement["bass_instrument"]
+    chord_instrument = arrangement["chord_instrument"]
+    pad_instrument = arrangement["pad_instrument"]
+    add_drums = arrangement["add_drums"]
+    chord_progression_type = arrangement["chord_progression_type"]
+    major_key = arrangement["major_key"]
+    add_arpeggio = arrangement["add_arpeggio"]
 
-    # Přidání dalších vrstev
-    start_time = primer_sequence.total_time
-    generate_pad(notes, chord, start_time, start_time + total_steps, pad_instrument)
-    generate_jazzy_chords(notes, chord, start_time, chord_instrument)
-    generate_bass(notes, chord[0] - 12, start_time, bass_instrument)
-    generate_drums(notes, start_time)
+    try:
+        candidates = max(1, min(MAX_CANDIDATES, int(data.get("candidates") or 1)))
+    except (TypeError, ValueError):
+        raise GenerationError("Počet variant (candidates) musí být celé číslo.", 400)
+
+    audio_formats, preview_format = parse_audio_formats(data.get("formats"), data.get("preview_format"))
+    persist = data.get("persist", PERSIST_OUTPUTS)
+    if isinstance(persist, str):
+        persist = persist.lower() not in ("0", "false", "no")
+    stream = bool(data.get("stream"))
+    if stream and candidates > 1:
+        raise GenerationError("Streamované generování podporuje jen jednu variantu (candidates=1).", 400)
+    # Dlouhé skladby se generují po oknech rovnou do souborů (run_long_form)
+    long_form = bool(data.get("long_form")) or length > LONG_FORM_SECONDS
+    if length > MAX_LONG_FORM_SECONDS:
+        raise GenerationError(f"Skladba může mít nejvýše {MAX_LONG_FORM_SECONDS} sekund.", 400)
+    if long_form and (candidates > 1 or stream):
+        raise GenerationError("Dlouhá skladba podporuje jen jednu variantu bez streamování sekcí.", 400)
+
+    safe_title = secure_filename(title) if title else ""
 
-    # Aktualizuj celkový čas
-    final_sequence.total_time = start_time + total_steps
-    return final_sequence
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    def history_record_for(midi_url, audio_urls):
+        history_record = {
+            "title": title or "Bez názvu",
+            "timestamp": timestamp,
+            "model": model,
+            "length": length,
+            "tempo": tempo,
+            "temperature": temperature,
+            "genre": parsed_params.get("genre") or "-",
+            "melody_instrument": melody_instrument,
+            "bass_instrument": bass_instrument,
+            "chord_instrument": chord_instrument,
+            "pad_instrument": pad_instrument,
+            "add_drums": add_drums,
+            "chord_progression_type": chord_progression_type,
+            "major_key": major_key,
+            "add_arpeggio": add_arpeggio,
+            "prompt": prompt,
+            "seed": seed,
+            "midi_file": midi_url,
+            "audio_files": audio_urls,
+            "preview_format": preview_format,
+            "preview_file": audio_urls[preview_format]
+        }
+        if "wav" in audio_urls:
+            history_record["wav_file"] = audio_urls["wav"]
+        return history_record
+
+    def result_for(history_records):
+        # Po úspěšném vygenerování souborů vracíme jejich názvy (první varianta je i v kořeni odpovědi)
+        result = {
+            key: history_records[0][key]
+            for key in ("midi_file", "wav_file", "audio_files", "preview_format", "preview_file")
+            if key in history_records[0]
+        }
+        result["stats"] = generation_stats
+        result["persisted"] = bool(persist)
+        result["seed"] = seed
+        if len(history_records) > 1:
+            result["candidates"] = history_records
+        return result
+
+    job.enter_stage("generate")
+    input_sequence = primer_sequence(tempo)
+
+    # Rozvržení skladby na sekce – každá se vygeneruje právě jednou
+    plan = plan_song(length, prompt_lower)
+    section_types = [section for section, _, _ in plan]
+    generation_stats = {"inference_calls": 0, "sections": len(plan), "candidates": candidates}
+
+    if long_form:
+        base_name = safe_title or f"generated_{model}_{length}s_{tempo}bpm_{timestamp}"
+        midi_name, audio_names = yield from run_long_form(job, parsed_params, arrangement, plan, audio_formats,
+                                                          base_name, generation_stats)
+        RNN_STEPS.inc(generation_stats.get("rnn_steps", 0), model=model)
+        history_records = [history_record_for(
+            f"/download_music/{midi_name}",
+            {fmt: f"/download_music/{name}" for fmt, name in audio_names.items()})]
+        history_records[0]["long_form"] = True
+        if persist:
+            save_history(history_records[0])
+        result = result_for(history_records)
+        # Výstupy dlouhé skladby jsou v úložišti vždy (viz run_long_form)
+        result["persisted"] = True
+        result["long_form"] = True
+        return result
+
+    # Při streamování se doprovod sestaví předem a každá hotová sekce se hned vyrenderuje
+    accompaniment = accompaniment_notes(length, arrangement) if stream else None
+    streamer = SectionStreamer(job, arrangement, accompaniment) if stream else None
+    try:
+        # Více variant téhož zadání se generuje v jednom dávkovém průchodu RNN
+        melodies = infer_melodies(model, input_sequence, plan, candidates, temperature, generation_stats,
+                                  streamer, seed)
+    finally:
+        if streamer is not None:
+            streamer.close()
+    if streamer is not None and streamer.first_audio_seconds is not None:
+        generation_stats["first_audio_seconds"] = streamer.first_audio_seconds
+    print(f"Melodie hotová: {generation_stats['inference_calls']} volání modelu pro {len(plan)} sekcí")
+    RNN_STEPS.inc(generation_stats.get("rnn_steps", 0), model=model)
+
+    for note_sequence in melodies:
+        # Aplikace tempo křivky (nahradí počáteční tempo z primeru)
+        del note_sequence.tempos[:]
+        apply_tempo_curve(note_sequence, section_types, base_tempo=tempo)
+
+    yield "arrange"
+    job.enter_stage("arrange")
+
+    songs = [arrange_song(note_sequence, length, arrangement, accompaniment) for note_sequence in melodies]
+
+    job.enter_stage("midi")
+
+    def output_url(name, stored):
+        # Uložené soubory (i zásahy v cache) jdou přes download_music podle klíče v úložišti,
+        # ostatní z paměti úlohy podle názvu
+        return f"/download_music/{name}" if stored else f"/jobs/{job.id}/files/{name}"
+
+    outputs = []
+    for index, song in enumerate(songs):
+        # Varianty téhož zadání se liší příponou _1, _2, ...
+        suffix = f"_{index + 1}" if len(songs) > 1 else ""
+        if safe_title:
+            # Použijeme pouze název od uživatele
+            base_name = f"{safe_title}{suffix}"
+        else:
+            # Výchozí název s detaily skladby
+            base_name = f"generated_{model}_{length}s_{tempo}bpm_{timestamp}{suffix}"
+
+        # Stejná sekvence už byla vyrenderována – vrátíme hotové soubory
+        cache_key = render_cache.key_for(song)
+        cached = render_cache.get(cache_key, audio_formats)
+        if cached:
+            outputs.append((song, cached[0], cached[1], cache_key, True))
+            continue
+
+        # U uložených výstupů se název nahradí klíčem z úložiště
+        midi_name = f"{base_name}.mid"
+        audio_names = {fmt: f"{base_name}.{AUDIO_ENCODERS[fmt][1]}" for fmt in audio_formats}
+        with MIDI_WRITE_SECONDS.time():
+            midi_data = song_to_midi_bytes(song)
+        BYTES_WRITTEN.inc(len(midi_data), format="mid", target="storage" if persist else "memory")
+        if persist:
+            midi_name = artifact_storage.put(midi_name, midi_data)
+        else:
+            job.artifacts[midi_name] = (midi_data, "audio/midi")
+        outputs.append((song, midi_name, audio_names, cache_key, False))
+
+    yield "render"
+    job.enter_stage("render")
+
+    # Streamy se otevřou pro všechny varianty najednou, posluchač se může připojit hned
+    for index, output in enumerate(outputs):
+        if not output[4]:
+            job.streams[index + 1] = PcmBroadcast(renderer.expected_frames(output[0].notes), SAMPLE_RATE)
+    job.streams_ready.set()
+
+    history_records = []
+    for index, (song, midi_name, audio_names, cache_key, cached) in enumerate(outputs):
+        if not cached:
+            stream = job.streams[index + 1]
+            blocks = []
+            # Syntezátor dostává události přímo z NoteSequence, MIDI soubor
+            # potřebuje jen záložní renderer přes příkazovou řádku
+            midi_path = artifact_storage.local_path(midi_name) if persist else None
+            try:
+                with RENDER_SECONDS.time(backend=RENDER_BACKEND):
+                    for block in renderer.iter_render(song.notes, midi_path):
+                        blocks.append(block)
+                        stream.publish(block)
+            finally:
+                stream.close()
+            pcm = np.concatenate(blocks) if blocks else np.zeros((0, 2), dtype=np.int16)
+            if pcm.size == 0:
+                raise GenerationError("Převod na WAV selhal (renderer nevrátil žádný zvuk).", 500)
+            for audio_format, audio_name in list(audio_names.items()):
+                with ENCODE_SECONDS.time(format=audio_format):
+                    audio_data = encode_audio(pcm, audio_format, SAMPLE_RATE)
+                BYTES_WRITTEN.inc(len(audio_data), format=audio_format, target="storage" if persist else "memory")
+                if persist:
+                    audio_names[audio_format] = artifact_storage.put(audio_name, audio_data)
+                else:
+                    job.artifacts[audio_name] = (audio_data, AUDIO_ENCODERS[audio_format][2])
+            if persist:
+                render_cache.put(cache_key, midi_name, audio_names)
+            # Další posluchači už dostanou hotový soubor, bloky v paměti nedržíme
+            job.streams.pop(index + 1, None)
+
+        stored = persist or cached
+        history_record = history_record_for(
+            output_url(midi_name, stored), {fmt: output_url(name, stored) for fmt, name in audio_names.items()})
+        if len(outputs) > 1:
+            history_record["candidate"] = index + 1
+        if cached:
+            history_record["render_cached"] = True
+        # Neuložené výstupy žijí jen v paměti úlohy, do historie nepatří
+        if persist:
+            save_history(history_record)
+        history_records.append(history_record)
+
+    return result_for(history_records)
+
+PIPELINE_STAGE_WORKERS = parse_pipeline_workers(
+    PIPELINE_WORKERS, {"generate": JOB_WORKERS, "arrange": 1, "render": RENDER_POOL_SIZE})
+job_manager = None
+if not IS_INFERENCE_WORKER:
+    # Vlákna fází v inferenčním procesu nemají co dělat
+    job_manager = JobManager(run_generation, queue_limit=JOB_QUEUE_LIMIT, retention=JOB_RETENTION,
+                             stages=PIPELINE_STAGE_WORKERS)
+    metrics.gauge("musicgen_pipeline_queue_depth", "Úlohy čekající ve frontě před fází.",
+                  job_manager.queue_depths, ["stage"])
+    metrics.gauge("musicgen_pipeline_utilization", "Podíl právě pracujících vláken fáze.",
+                  job_manager.utilization, ["stage"])
+    metrics.gauge("musicgen_pipeline_workers", "Počet vláken fáze.", lambda: job_manager.stages, ["stage"])
+
+# --- dávkové generování -----------------------------------------------------
+BATCH_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+def parse_batch_items(text):
+    """JSONL s položkami dávky → seznam slovníků; prázdné řádky a řádky s # se přeskočí."""
+    items = []
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"řádek {number}: neplatný JSON ({e})")
+        if not isinstance(item, dict):
+            raise ValueError(f"řádek {number}: položka musí být objekt JSON")
+        items.append(item)
+    return items
+
+def batch_item_ids(items):
+    """
+    Id položek pro manifest: vlastní "id", jinak otisk obsahu položky (stejné
+    položky se rozliší pořadím výskytu). Při opakovaném spuštění nad stejným
+    vstupem tak vyjdou stejná id.
+    """
+    ids = []
+    seen = {}
+    for item in items:
+        if item.get("id") is not None:
+            ids.append(str(item["id"]))
+            continue
+        digest = hashlib.sha256(json.dumps(item, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+        seen[digest] = seen.get(digest, 0) + 1
+        ids.append(digest if seen[digest] == 1 else f"{digest}-{seen[digest]}")
+    return ids
+
+def request_model(data):
+    """Model, který pro požadavek použije run_generation (formulář > předvolba > prompt)."""
+    if data.get("model"):
+        return data["model"]
+    preset = PRESETS.get(data.get("preset"), {})
+    if "model" in preset:
+        return preset["model"]
+    return parse_prompt(data.get("prompt", ""), dict(DEFAULT_PARAMS))["model"]
+
+def read_manifest(path):
+    """Poslední záznam každé položky z manifestu; neúplný řádek po přerušení se přeskočí."""
+    records = {}
+    try:
+        with open(path, encoding="utf-8") as manifest:
+            for line in manifest:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[record.get("id")] = record
+    except FileNotFoundError:
+        pass
+    return records
+
+
+class BatchRun:
+    """
+    Dávka skladeb pro katalog.
+
+    • Položky se seřadí podle modelu, takže celá skupina využije jeden
+      zahřátý generátor (v registru i v inferenčním procesu).
+    • Do fronty úloh jde najednou `concurrency` položek – zatímco jedna
+      skladba renderuje, další už generuje melodii.
+    • Každá dokončená položka se hned připíše do manifestu (JSONL). Nové
+      spuštění se stejným manifestem přeskočí položky, které jsou hotové,
+      chybné zkusí znovu.
+    Výstupy dávek se vždy ukládají do úložiště, manifest na ně odkazuje.
+    """
 
-@app.route("/download_music/<filename>")
-def download_music(filename):
-    return send_from_directory(OUTPUT_DIR, filename, as_attachment=True)
+    def __init__(self, batch_id, items, manifest_path, submit, concurrency):
+        self.id = batch_id
+        self.manifest_path = manifest_path
+        self.submit = submit
+        self.concurrency = max(1, concurrency)
+        self.status = "pending"
+        self.total = len(items)
+        self.counts = {"done": 0, "failed": 0, "skipped": 0}
+        self.models = {}
+        self.started_at = None
+        self.finished_at = None
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+
+        finished = {item_id for item_id, record in read_manifest(manifest_path).items()
+                    if record.get("status") == "done"}
+        if os.path.exists(manifest_path) and os.path.getsize(manifest_path):
+            # Řádek useknutý přerušeným zápisem se ukončí, nové záznamy pak začnou na novém řádku
+            with open(manifest_path, "rb+") as manifest:
+                manifest.seek(-1, os.SEEK_END)
+                if manifest.read(1) != b"\n":
+                    manifest.write(b"\n")
+        entries = []
+        for item_id, item in zip(batch_item_ids(items), items):
+            if item_id in finished:
+                self.counts["skipped"] += 1
+            else:
+                entries.append((item_id, item, request_model(item)))
+        # Skupiny podle modelu v pořadí prvního výskytu, uvnitř skupiny pořadí ze vstupu
+        model_order = {}
+        for _, _, model in entries:
+            model_order.setdefault(model, len(model_order))
+        entries.sort(key=lambda entry: model_order[entry[2]])
+        for entry in entries:
+            self._queue.put(entry)
+            self.models[entry[2]] = self.models.get(entry[2], 0) + 1
+        self.pending = len(entries)
+
+    def run(self):
+        self.status = "running"
+        self.started_at = time.time()
+        workers = [threading.Thread(target=self._work, name=f"batch-{self.id}-{index}", daemon=True)
+                   for index in range(min(self.concurrency, max(1, self.pending)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.finished_at = time.time()
+        self.status = "done"
+
+    def _work(self):
+        while True:
+            try:
+                item_id, item, model = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            started = time.time()
+            while True:
+                try:
+                    job = self.submit(dict(item, persist=True))
+                    break
+                except JobQueueFull:
+                    # Fronta je plná (např. interaktivními požadavky) – dávka počká
+                    time.sleep(1)
+            job.finished.wait()
+
+            record = {
+                "id": item_id,
+                "status": job.status,
+                "model": model,
+                "title": item.get("title"),
+                "prompt": item.get("prompt"),
+                "job_id": job.id,
+                "seconds": round(time.time() - started, 3),
+                "finished_at": datetime.now().isoformat(timespec="seconds"),
+            }
+            if job.status == "done":
+                for key in ("seed", "midi_file", "audio_files", "preview_file", "stats"):
+                    if key in job.result:
+                        record[key] = job.result[key]
+            else:
+                record["error"] = job.error
+            self._record(record)
+
+    def _record(self, record):
+        with self._lock:
+            with open(self.manifest_path, "a", encoding="utf-8") as manifest:
+                manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.counts[record["status"]] += 1
+            self.pending -= 1
+        BATCH_TRACKS.inc(status=record["status"])
+
+    def to_dict(self):
+        with self._lock:
+            elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0
+            return {
+                "batch_id": self.id,
+                "status": self.status,
+                "total": self.total,
+                "pending": self.pending,
+                "counts": dict(self.counts),
+                "models": dict(self.models),
+                "elapsed_seconds": round(elapsed, 1),
+                # průchodnost dávky – jen skladby vygenerované v tomto běhu
+                "tracks_per_minute": round(self.counts["done"] / elapsed * 60, 2) if elapsed else 0.0,
+                "manifest": self.manifest_path,
+                "status_url": f"/batches/{self.id}",
+                "manifest_url": f"/batches/{self.id}/manifest",
+            }
+
+
+batch_runs = OrderedDict()
+batch_runs_lock = threading.Lock()
+# --- konec dávkového generování ---------------------------------------------
+
+# --- start a připravenost -----------------------------------------------------
+class WarmUp:
+    """
+    Načtení TensorFlow/Magenty, přednačtení PRELOAD_MODELS a zahřátí syntezátoru.
+
+    • /healthz jen potvrzuje, že proces žije a obsluhuje požadavky,
+    • /readyz vrací 503, dokud nejsou ML knihovny a přednačítané modely
+      připravené – load balancer tak neposílá generování na startující instanci.
+    V režimu "lazy" se nic nepřednačítá a instance je připravená hned,
+    knihovny si načte až první generování.
+    """
+
+    def __init__(self, mode, models):
+        self.mode = mode
+        self.models = models
+        self.status = "pending"
+        self.error = None
+        self.timings = {}
+        self.ready = threading.Event()
+        self._started = time.time()
+
+    def _timed(self, name, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        self.timings[name] = time.perf_counter() - started
+        return result
+
+    def _import_ml_modules(self):
+        # Magentu (a s ní TensorFlow) potřebuje server jen pro modely bez inferenčního procesu
+        in_process = [m for m in BUNDLE_PATHS if inference_pool is None or not inference_pool.serves(m)]
+        for module in NOTE_SEQ_MODULES + (MAGENTA_MODULES if in_process else []):
+            module.load()
+
+    def run(self):
+        self.status = "loading"
+        try:
+            self._timed("imports", self._import_ml_modules)
+            if inference_pool is not None:
+                self._timed("inference_workers", inference_pool.wait_settled)
+                missing = inference_pool.unavailable_models()
+                if missing:
+                    raise RuntimeError(f"inferenční procesy nenačetly modely: {', '.join(missing)}")
+            if self.models:
+                self._timed("models", model_registry.preload, self.models)
+                missing = [m for m in self.models if m not in model_registry.loaded_models()]
+                if missing:
+                    raise RuntimeError(f"nepodařilo se načíst modely: {', '.join(missing)}")
+        except Exception as e:
+            self.status = "failed"
+            self.error = str(e)
+            print(f"Start generování selhal: {e}")
+            return
+
+        try:
+            self._timed("renderer", renderer.warm_up)
+        except Exception as e:
+            # Bez syntezátoru jde pořád generovat MIDI, připravenost to neblokuje
+            print(f"Syntezátor se nepodařilo zahřát: {e}")
+
+        self.status = "ready"
+        self.ready.set()
+        print(f"Generování připraveno za {time.time() - self._started:.1f} s")
+
+    def start(self):
+        if inference_pool is not None:
+            inference_pool.start()
+            atexit.register(inference_pool.stop)
+        if self.mode == "lazy":
+            self.status = "lazy"
+            self.ready.set()
+        elif self.mode == "eager":
+            self.run()
+        else:
+            threading.Thread(target=self.run, name="warm-up", daemon=True).start()
+
+    def to_dict(self):
+        return {
+            "status": self.status,
+            "startup_mode": self.mode,
+            "error": self.error,
+            "timings": {name: round(seconds, 3) for name, seconds in self.timings.items()},
+            "models": model_registry.loaded_models(),
+            "inference_workers": inference_pool.to_dict() if inference_pool is not None else [],
+            "uptime": round(time.time() - self._started, 1),
+        }
+
+
+# Modely obsluhované inferenčními procesy se v serveru nepřednačítají
+warm_up = WarmUp(STARTUP_MODE, [m for m in PRELOAD_MODELS if inference_pool is None or not inference_pool.serves(m)])
+metrics.gauge("musicgen_ready", "1, pokud instance přijímá generovací úlohy.", lambda: int(warm_up.ready.is_set()))
+if not IS_INFERENCE_WORKER:
+    warm_up.start()
+
+@app.route("/healthz")
+def healthz():
+    return jsonify({"status": "ok"})
+
+@app.route("/readyz")
+def readyz():
+    return jsonify(warm_up.to_dict()), 200 if warm_up.ready.is_set() else 503
+# --- konec startu a připravenosti ---------------------------------------------
+
+@app.route("/generate_music", methods=["POST"])
+def generate_music():
+    data = request.json
+    if not data:
+        return jsonify({"error": "Nebyla poskytnuta žádná data."}), 400
+
+    # Generování běží na pozadí, klient dostane hned id úlohy a stav si dotazuje
+    try:
+        job = job_manager.submit(data)
+    except JobQueueFull:
+        return jsonify({"error": "Server je přetížený, zkuste to prosím za chvíli znovu."}), 503
+    return jsonify(job.to_dict()), 202
+
+@app.route("/batch_generate", methods=["POST"])
+def batch_generate():
+    """
+    Spustí dávku. Tělo je buď JSON {"items": [...], "batch_id": ..., "concurrency": ...},
+    nebo JSONL s položkami (batch_id a concurrency pak v query stringu).
+    Položky mají stejný tvar jako požadavek na /generate_music. Dávka se stejným
+    batch_id pokračuje podle svého manifestu – hotové položky přeskočí.
+    """
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        items = data.get("items")
+    else:
+        data = request.args
+        try:
+            items = parse_batch_items(request.get_data(as_text=True))
+        except ValueError as e:
+            return jsonify({"error": f"Neplatná dávka: {e}"}), 400
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        return jsonify({"error": "Dávka musí obsahovat neprázdný seznam položek."}), 400
+    if len(items) > MAX_BATCH_ITEMS:
+        return jsonify({"error": f"Dávka může mít nejvýše {MAX_BATCH_ITEMS} položek."}), 400
+
+    batch_id = str(data.get("batch_id") or uuid.uuid4().hex)
+    if not BATCH_ID_PATTERN.fullmatch(batch_id):
+        return jsonify({"error": "batch_id smí obsahovat jen písmena, číslice, _ a - (nejvýše 64 znaků)."}), 400
+    try:
+        concurrency = int(data.get("concurrency") or BATCH_CONCURRENCY or job_manager.slots)
+    except (TypeError, ValueError):
+        return jsonify({"error": "concurrency musí být celé číslo."}), 400
+
+    with batch_runs_lock:
+        previous = batch_runs.get(batch_id)
+        if previous is not None and previous.status != "done":
+            return jsonify({"error": "Dávka s tímto batch_id už běží.", **previous.to_dict()}), 409
+        os.makedirs(BATCH_DIR, exist_ok=True)
+        batch = BatchRun(batch_id, items, os.path.join(BATCH_DIR, f"{batch_id}.jsonl"),
+                         job_manager.submit, concurrency)
+        batch_runs[batch_id] = batch
+        batch_runs.move_to_end(batch_id)
+        finished = [key for key, run in batch_runs.items() if run.status == "done"]
+        for key in finished[:max(0, len(batch_runs) - JOB_RETENTION)]:
+            del batch_runs[key]
+    threading.Thread(target=batch.run, name=f"batch-{batch_id}", daemon=True).start()
+    return jsonify(batch.to_dict()), 202
+
+@app.route("/batches/<batch_id>")
+def batch_status(batch_id):
+    batch = batch_runs.get(batch_id)
+    if batch is None:
+        return jsonify({"error": "Dávka nebyla nalezena."}), 404
+    return jsonify(batch.to_dict())
+
+@app.route("/batches/<batch_id>/manifest")
+def batch_manifest(batch_id):
+    if not BATCH_ID_PATTERN.fullmatch(batch_id):
+        return jsonify({"error": "Dávka nebyla nalezena."}), 404
+    path = os.path.join(BATCH_DIR, f"{batch_id}.jsonl")
+    if not os.path.exists(path):
+        return jsonify({"error": "Manifest dávky nebyl nalezen."}), 404
+    with open(path, "rb") as manifest:
+        return Response(manifest.read(), mimetype="application/x-ndjson",
+                        headers={"Cache-Control": REVALIDATE_CACHE_CONTROL})
+
+def add_job_server_timing(job):
+    # Fáze úlohy běžely mimo tento požadavek, do Server-Timing je přidáme zvlášť
+    for stage, seconds in job.to_dict()["timings"].items():
+        add_server_timing(stage, seconds)
+    stats = (job.result or {}).get("stats", {})
+    for index, seconds in enumerate(stats.get("section_seconds", []), start=1):
+        add_server_timing(f"section{index}", seconds)
+    if "first_audio_seconds" in stats:
+        add_server_timing("first-audio", stats["first_audio_seconds"])
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Úloha nebyla nalezena."}), 404
+    add_job_server_timing(job)
+    return jsonify(job.to_dict())
+
+SSE_KEEPALIVE_SECONDS = 15  # po jaké době ticha se posílá komentář, aby proxy spojení nezavřela
+
+@app.route("/jobs/<job_id>/events")
+def job_events(job_id):
+    """
+    Průběh úlohy jako Server-Sent Events: stage (změna fáze), section (hotová
+    sekce při streamovaném generování), done (výsledek) a failed (chyba).
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Úloha nebyla nalezena."}), 404
+    # Po výpadku spojení EventSource pošle číslo poslední přijaté události
+    last_event_id = request.headers.get("Last-Event-ID", type=int)
+    start = last_event_id + 1 if last_event_id is not None else 0
+
+    def generate():
+        for event in job.events.iter_events(start, timeout=SSE_KEEPALIVE_SECONDS):
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            index, name, data = event
+            yield f"id: {index}\nevent: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # nginx nesmí události bufferovat
+    return response
+
+STREAM_WAIT_SECONDS = 120  # jak dlouho stream čeká, než úloha dojde k renderu
+
+@app.route("/jobs/<job_id>/stream")
+def job_stream(job_id):
+    """
+    Zvuk skladby jako WAV stream – data tečou, jak je syntezátor renderuje,
+    takže přehrávání může začít dřív, než je celý soubor hotový.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Úloha nebyla nalezena."}), 404
+    candidate = request.args.get("candidate", 1, type=int)
+
+    job.streams_ready.wait(STREAM_WAIT_SECONDS)
+    if job.status == "failed":
+        return jsonify({"error": job.error}), job.error_status or 500
+
+    stream = job.streams.get(candidate)
+    if stream is None:
+        # Render už skončil (nebo šlo o zásah v cache) – pošleme hotový soubor
+        job.finished.wait(STREAM_WAIT_SECONDS)
+        if job.status == "done":
+            variants = job.result.get("candidates") or [job.result]
+            if 1 <= candidate <= len(variants):
+                return redirect(variants[candidate - 1]["preview_file"])
+            return jsonify({"error": "Stream pro tuto variantu není k dispozici."}), 404
+        if job.status == "failed":
+            return jsonify({"error": job.error}), job.error_status or 500
+        return jsonify(job.to_dict()), 202
+
+    def generate():
+        yield wav_header(stream.frames, stream.sample_rate)
+        for block in stream.iter_blocks():
+            yield block.astype("<i2").tobytes()
+
+    response = Response(stream_with_context(generate()), mimetype="audio/wav")
+    response.headers["Cache-Control"] = "no-store"
+    if stream.frames is not None:
+        response.headers["Content-Length"] = str(44 + stream.frames * 4)
+    return response
+
+@app.route("/render_cache")
+def render_cache_stats():
+    return jsonify(render_cache.stats())
+
+@app.route("/jobs/<job_id>/result")
+def job_result(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Úloha nebyla nalezena."}), 404
+    if job.status == "failed":
+        return jsonify({"error": job.error}), job.error_status or 500
+    if job.status != "done":
+        return jsonify(job.to_dict()), 202
+    add_job_server_timing(job)
+    return jsonify(job.result)
+
+@app.route("/jobs/<job_id>/files/<filename>")
+def job_file(job_id, filename):
+    """
+    Výstup úlohy, která nic neukládala na disk – posílá se rovnou z paměti.
+    """
+    job = job_manager.get(job_id)
+    artifact = job.artifacts.get(filename) if job is not None else None
+    if artifact is None:
+        return jsonify({"error": "Soubor nebyl nalezen."}), 404
+    data, mimetype = artifact
+    info = StoredObject(len(data), hashlib.sha256(data).hexdigest()[:32], mimetype)
+    # Obsah na adrese úlohy se nemění, ale žije jen do jejího vyřazení z paměti
+    return send_artifact(info, lambda start, end: [data[start:end]], filename, "private, max-age=3600")
+
+@app.route("/download_music/<path:key>")
+def download_music(key):
+    return serve_stored(key)
 
 if __name__ == "__main__":
     app.run(debug=True, port=5000)
\ No newline at end of file
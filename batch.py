@@ -0,0 +1,78 @@
+"""
+Dávkové generování katalogu skladeb z příkazové řádky.
+
+Čte JSONL s položkami ve stejném tvaru jako tělo /generate_music (prompt,
+model, length, seed, title, ... a volitelné "id") a generuje je přímo
+v tomto procesu přes BatchRun z app.py – bez HTTP, se zahřátými modely
+i syntezátorem. Hotové položky se průběžně připisují do manifestu;
+po přerušení stačí spustit stejný příkaz znovu a dávka pokračuje:
+
+    python batch.py prompts.jsonl --manifest catalog.jsonl --concurrency 4
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import threading
+
+# ML knihovny se načtou až s prvním modelem dávky
+os.environ.setdefault("STARTUP_MODE", "lazy")
+import app
+
+def report_progress(batch, interval, stop):
+    while not stop.wait(interval):
+        status = batch.to_dict()
+        counts = status["counts"]
+        print(f"[batch] hotovo {counts['done']}, chyby {counts['failed']}, zbývá {status['pending']} "
+              f"– {status['tracks_per_minute']} skladeb/min", file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dávkové generování skladeb z JSONL.")
+    parser.add_argument("input", help="JSONL s položkami, jedna skladba na řádek")
+    parser.add_argument("--manifest", help="manifest výstupů (JSONL); výchozí <input>.manifest.jsonl")
+    parser.add_argument("--concurrency", type=int, default=app.BATCH_CONCURRENCY or None,
+                        help="kolik skladeb je rozpracovaných najednou (výchozí: kolik pojmou fáze úloh)")
+    parser.add_argument("--progress", type=float, default=10.0, help="interval výpisu průběhu v sekundách")
+    args = parser.parse_args(argv)
+
+    with open(args.input, encoding="utf-8") as f:
+        try:
+            items = app.parse_batch_items(f.read())
+        except ValueError as e:
+            parser.error(f"{args.input}: {e}")
+    if not items:
+        parser.error(f"{args.input}: žádné položky")
+    manifest = args.manifest or os.path.splitext(args.input)[0] + ".manifest.jsonl"
+
+    # Výpisy z app.py (průběh generování) nesmí znečistit souhrn na stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            app.renderer.warm_up()
+        except Exception as e:
+            print(f"Syntezátor se nepodařilo zahřát: {e}")
+
+        # Vlastní fronta úloh se stejnými fázemi jako server (PIPELINE_WORKERS)
+        jobs = app.JobManager(app.run_generation, queue_limit=0, retention=app.JOB_RETENTION,
+                              stages=app.PIPELINE_STAGE_WORKERS)
+        concurrency = args.concurrency or jobs.slots
+        batch = app.BatchRun(os.path.splitext(os.path.basename(manifest))[0], items, manifest,
+                             jobs.submit, concurrency)
+        print(f"[batch] {batch.total} položek, {batch.counts['skipped']} už hotových v {manifest}, "
+              f"modely: {', '.join(f'{m} ({n})' for m, n in batch.models.items()) or '-'}")
+
+        stop = threading.Event()
+        threading.Thread(target=report_progress, args=(batch, args.progress, stop), daemon=True).start()
+        try:
+            batch.run()
+        except KeyboardInterrupt:
+            print(f"[batch] přerušeno – hotové položky jsou v {manifest}, stejný příkaz dávku dokončí")
+            return 130
+        finally:
+            stop.set()
+
+    print(json.dumps(batch.to_dict(), ensure_ascii=False, indent=2))
+    return 1 if batch.counts["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,234 @@
+"""
+Benchmark generovacího řetězce po jednotlivých fázích.
+
+Běží offline nad lokálními .mag bundly a SoundFontem (SOUNDFONT_PATH nebo
+--soundfont, stačí malý testovací). Měří stejné funkce, které volá
+run_generation v app.py, pro matici délek × modelů × žánrů a výsledek
+ukládá jako JSON, aby šly porovnat běhy z různých commitů:
+
+    python bench.py --lengths 10,30 --models basic_rnn --output bench.json
+    python bench.py --output new.json --compare bench.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+# ML knihovny se načtou až v main(), aby šel jejich import změřit zvlášť
+os.environ.setdefault("STARTUP_MODE", "lazy")
+import app
+
+STAGES = ["parse", "generate", "arrange", "midi", "render", "encode"]
+DEFAULT_LENGTHS = [10, 30, 60, 300]
+DEFAULT_GENRES = [genre for genre, config in app.GENRE_MAP.items() if "tempo_range" in config]
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+def summarize(samples):
+    return {
+        "min": round(min(samples), 6),
+        "median": round(statistics.median(samples), 6),
+        "mean": round(statistics.fmean(samples), 6),
+        "runs": len(samples),
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def create_renderer(soundfont):
+    """
+    Syntezátor pro fázi render; vrací (renderer, doba načtení SoundFontu, důvod přeskočení).
+    """
+    if app.fluidsynth is None:
+        return None, None, "pyfluidsynth není dostupný"
+    if not os.path.exists(soundfont):
+        return None, None, f"SoundFont {soundfont} neexistuje"
+    renderer = app.FluidSynthRenderer(soundfont, pool_size=1)
+    _, seconds = timed(renderer.warm_up)
+    return renderer, seconds, None
+
+def run_case(generator, renderer, model, genre, length, repeat, audio_format):
+    """
+    Jedna buňka matice: `repeat` běhů celého řetězce, časy po fázích.
+    """
+    prompt = f"{genre} song {length} seconds"
+    samples = {stage: [] for stage in STAGES}
+    section_seconds = []
+    notes = sections = 0
+
+    for run in range(repeat):
+        # Stejná náhoda v každém běhu, ať se porovnávají stejné skladby
+        random.seed(run)
+        np.random.seed(run)
+
+        app.compile_prompt.cache_clear()
+        params, seconds = timed(app.parse_prompt, prompt, {"model": model, "length": length})
+        samples["parse"].append(seconds)
+        params["model"] = model
+        params["length"] = length
+        params["seed"] = run
+
+        plan = app.plan_song(length, params["prompt_lower"])
+        stats = {}
+        sequence, seconds = timed(app.generate_planned_song, generator, app.primer_sequence(params["tempo"]),
+                                  plan, params["temperature"], stats)
+        samples["generate"].append(seconds)
+        section_seconds.extend(stats.get("section_seconds", []))
+        del sequence.tempos[:]
+        app.apply_tempo_curve(sequence, [section for section, _, _ in plan], base_tempo=params["tempo"])
+
+        song, seconds = timed(app.arrange_song, sequence, length, app.build_arrangement(params))
+        samples["arrange"].append(seconds)
+
+        _, seconds = timed(app.song_to_midi_bytes, song)
+        samples["midi"].append(seconds)
+
+        if renderer is not None:
+            pcm, seconds = timed(renderer.render, song.notes)
+            samples["render"].append(seconds)
+            _, seconds = timed(app.encode_audio, pcm, audio_format)
+            samples["encode"].append(seconds)
+
+        notes = len(song.notes)
+        sections = len(plan)
+
+    result = {
+        "model": model,
+        "genre": genre,
+        "length": length,
+        "notes": notes,
+        "sections": sections,
+        "stages": {stage: summarize(values) for stage, values in samples.items() if values},
+    }
+    if section_seconds:
+        result["section_generate"] = summarize(section_seconds)
+    if samples["render"]:
+        # kolikrát rychleji než reálný čas se skladba vyrenderuje
+        result["render_realtime_factor"] = round(length / statistics.median(samples["render"]), 2)
+    return result
+
+def compare(previous, current, threshold):
+    """
+    Porovná mediány fází se starším během; vrací seznam zpomalení nad `threshold`.
+    """
+    old_cases = {(r["model"], r["genre"], r["length"]): r for r in previous["results"]}
+    regressions = []
+    for case in current["results"]:
+        old = old_cases.get((case["model"], case["genre"], case["length"]))
+        if old is None:
+            continue
+        for stage, summary in case["stages"].items():
+            old_summary = old["stages"].get(stage)
+            if not old_summary or not old_summary["median"]:
+                continue
+            ratio = summary["median"] / old_summary["median"]
+            line = (f"{case['model']:<14} {case['genre']:<11} {case['length']:>4}s {stage:<9} "
+                    f"{old_summary['median']:.4f}s → {summary['median']:.4f}s  ×{ratio:.2f}")
+            print(line, file=sys.stderr)
+            if ratio > threshold:
+                regressions.append(line)
+    return regressions
+
+def parse_list(value, cast=str):
+    return [cast(item.strip()) for item in value.split(",") if item.strip()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark generovacího řetězce po fázích.")
+    parser.add_argument("--lengths", default=",".join(map(str, DEFAULT_LENGTHS)),
+                        help="délky skladeb v sekundách, oddělené čárkou")
+    parser.add_argument("--models", default=",".join(app.BUNDLE_PATHS), help="modely z BUNDLE_PATHS")
+    parser.add_argument("--genres", default=",".join(DEFAULT_GENRES), help="žánry z GENRE_MAP")
+    parser.add_argument("--repeat", type=int, default=3, help="počet běhů každé kombinace")
+    parser.add_argument("--soundfont", default=app.soundfont_path)
+    parser.add_argument("--format", default=app.PREVIEW_FORMAT, choices=list(app.AUDIO_ENCODERS),
+                        help="formát, do kterého se měří kódování")
+    parser.add_argument("--no-render", action="store_true", help="přeskočit render a kódování zvuku")
+    parser.add_argument("--output", help="soubor pro JSON (jinak standardní výstup)")
+    parser.add_argument("--compare", help="JSON ze staršího běhu k porovnání")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="poměr mediánů, od kterého se fáze hlásí jako zpomalení")
+    args = parser.parse_args(argv)
+
+    lengths = parse_list(args.lengths, int)
+    models = parse_list(args.models)
+    genres = parse_list(args.genres)
+    unknown = [m for m in models if m not in app.BUNDLE_PATHS] + [g for g in genres if g not in app.GENRE_MAP]
+    if unknown:
+        parser.error(f"neznámé modely nebo žánry: {', '.join(unknown)}")
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "soundfont": args.soundfont,
+            "audio_format": args.format,
+            "sample_rate": app.SAMPLE_RATE,
+        },
+        "models": {},
+        "results": [],
+    }
+
+    # Výpisy z app.py (průběh generování) nesmí znečistit JSON na stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        _, seconds = timed(lambda: [module.load() for module in app.ML_MODULES])
+        report["meta"]["ml_import_seconds"] = round(seconds, 6)
+
+        renderer = None
+        if args.no_render:
+            report["meta"]["render"] = "vypnuto (--no-render)"
+        else:
+            renderer, seconds, skipped = create_renderer(args.soundfont)
+            report["meta"]["render"] = skipped or "pyfluidsynth"
+            if seconds is not None:
+                report["meta"]["render_init_seconds"] = round(seconds, 6)
+
+        for model in models:
+            # Načtení bundlu a initialize() se měří zvlášť na čerstvém registru
+            registry = app.ModelRegistry(app.BUNDLE_PATHS, max_models=1)
+            generator, seconds = timed(registry.get, model)
+            report["models"][model] = {"bundle_load_seconds": round(seconds, 6)}
+
+            for genre in genres:
+                for length in lengths:
+                    print(f"[bench] {model} / {genre} / {length}s", file=sys.stderr)
+                    report["results"].append(
+                        run_case(generator, renderer, model, genre, length, args.repeat, args.format))
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        if regressions:
+            print(f"Zpomalení nad ×{args.threshold}:", file=sys.stderr)
+            for line in regressions:
+                print("  " + line, file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,9 @@
+import os
+os.environ.setdefault("STARTUP_MODE", "lazy")
+import app
+
+def test_render_cache_counters_are_counters():
+    body = app.app.test_client().get("/metrics").get_data(as_text=True)
+    assert "# TYPE musicgen_render_cache_hits_total counter" in body
+    assert "# TYPE musicgen_render_cache_misses_total counter" in body
+    assert "\nmusicgen_render_cache_hits_total " in body
@@ -0,0 +1,101 @@
+import io
+import os
+os.environ.setdefault("STARTUP_MODE", "lazy")
+import numpy as np
+import pytest
+import app
+
+mido = pytest.importorskip("mido")
+
+# Tempa, která apply_tempo_curve nastaví pro verse, chorus, bridge a outro při 120 qpm
+TEMPO_CURVE = [(0.0, 120), (10.0, 132), (20.0, 108), (30.0, 96)]
+# Zaokrouhlení na ticky (220 na čtvrťovou) při nejpomalejším tempu
+TOLERANCE = 60.0 / 96 / app.MIDI_TICKS_PER_QUARTER
+
+def parse_midi(data):
+    """Noty (výška, začátek, konec, kanál) a programy kanálů tak, jak je čte mido."""
+    midi = mido.MidiFile(file=io.BytesIO(data))
+    now = 0.0
+    sounding = {}
+    notes = []
+    programs = {}
+    tempos = []
+    for message in midi:
+        now += message.time
+        if message.type == "set_tempo":
+            tempos.append((round(now, 6), round(mido.tempo2bpm(message.tempo), 3)))
+        elif message.type == "program_change":
+            programs[message.channel] = message.program
+        elif message.type == "note_on" and message.velocity > 0:
+            sounding.setdefault((message.channel, message.note), []).append(now)
+        elif message.type in ("note_off", "note_on"):
+            start = sounding[(message.channel, message.note)].pop(0)
+            notes.append((message.note, start, now, message.channel))
+    assert not any(sounding.values())
+    return sorted(notes), programs, tempos
+
+def song_notes():
+    melody = app.note_array([60, 62, 64, 60], [0.0, 9.5, 19.75, 29.0], [1.0, 10.5, 21.0, 31.0], 80,
+                            program=0, instrument=0)
+    bass = app.note_array([36, 43], [5.0, 25.0], [15.0, 35.0], 90, program=33, instrument=1)
+    drums = app.note_array([36, 38, 42], [0.0, 10.0, 20.0], [0.2, 10.2, 20.1], 100,
+                           program=0, instrument=9, is_drum=True)
+    return np.concatenate([melody, bass, drums])
+
+def test_midi_bytes_round_trip_with_tempo_changes_and_drums():
+    notes = song_notes()
+    parsed, programs, tempos = parse_midi(app.midi_bytes(notes, TEMPO_CURVE))
+
+    assert [qpm for _, qpm in tempos] == [120, 132, 108, 96]
+    assert [time for time, _ in tempos] == pytest.approx([0.0, 10.0, 20.0, 30.0], abs=TOLERANCE)
+    expected = sorted((int(n["pitch"]), n["start"], n["end"]) for n in notes)
+    assert [pitch for pitch, _, _, _ in parsed] == [pitch for pitch, _, _ in expected]
+    assert [start for _, start, _, _ in parsed] == pytest.approx([start for _, start, _ in expected], abs=TOLERANCE)
+    assert [end for _, _, end, _ in parsed] == pytest.approx([end for _, _, end in expected], abs=TOLERANCE)
+
+    channels = app.note_channels(notes)
+    assert channels[(9, 0, True)] == app.DRUM_CHANNEL
+    assert {channel for _, _, _, channel in parsed} == set(channels.values())
+    assert programs[channels[(0, 0, False)]] == 0
+    assert programs[channels[(1, 33, False)]] == 33
+
+def test_repeated_note_at_same_tick_is_not_cut():
+    # druhá nota začíná přesně v ticku, kdy první končí – note-off musí jít první
+    notes = app.note_array([60, 60], [0.0, 0.5], [0.5, 1.0], 80)
+    midi = mido.MidiFile(file=io.BytesIO(app.midi_bytes(notes)))
+    kinds = [message.type for message in midi if message.type in ("note_on", "note_off")]
+    assert kinds == ["note_on", "note_off", "note_on", "note_off"]
+
+def test_incremental_writer_matches_midi_bytes(tmp_path):
+    notes = song_notes()
+    scheduler = app.EventScheduler()
+    path = tmp_path / "long.mid"
+    writer = app.IncrementalMidiWriter(str(path), qpm=120)
+    for window_start, window_end in ((0.0, 10.0), (10.0, 20.0), (20.0, float("inf"))):
+        window = notes[(notes["start"] >= window_start) & (notes["start"] < window_end)]
+        new_channels, events = scheduler.add(window, window_end)
+        for channel, program, _ in new_channels:
+            writer.program_change(window_start, channel, program)
+        writer.write(events)
+    writer.write(scheduler.flush())
+    writer.close()
+
+    streamed, programs, _ = parse_midi(path.read_bytes())
+    whole, whole_programs, _ = parse_midi(app.midi_bytes(notes))
+    assert [note[0] for note in streamed] == [note[0] for note in whole]
+    assert [note[1:3] for note in streamed] == pytest.approx([note[1:3] for note in whole], abs=TOLERANCE)
+    assert programs == whole_programs
+
+def test_sequence_with_tempo_curve_round_trip():
+    pytest.importorskip("note_seq")
+    sequence = app.music_pb2.NoteSequence()
+    for note in song_notes():
+        sequence.notes.add(pitch=int(note["pitch"]), start_time=float(note["start"]), end_time=float(note["end"]),
+                           velocity=int(note["velocity"]), program=int(note["program"]),
+                           instrument=int(note["instrument"]), is_drum=bool(note["is_drum"]))
+    app.apply_tempo_curve(sequence, ["verse", "chorus", "bridge", "outro"], base_tempo=120)
+
+    parsed, _, tempos = parse_midi(app.sequence_to_midi_bytes(sequence))
+    assert [qpm for _, qpm in tempos] == [120, 132, 108, 96]
+    assert sorted(start for _, start, _, _ in parsed) == pytest.approx(
+        sorted(note.start_time for note in sequence.notes), abs=TOLERANCE)
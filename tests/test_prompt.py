@@ -0,0 +1,79 @@
+import os
+os.environ.setdefault("STARTUP_MODE", "lazy")
+from dataclasses import astuple
+import pytest
+import app
+
+# Očekávané hodnoty vrací i původní parser (postupné testy `keyword in prompt`),
+# včetně jeho zvláštností – viz komentáře u jednotlivých řádků.
+# Pořadí: length, tempo, temperature, melody, bass, chords, pad, add_drums,
+# chord_progression_type, major_key, add_arpeggio, model, chord_style, genre
+PROMPT_CASES = [
+    ('pop song',
+     (30, 120, 1.0, 0, 33, 27, 88, True, 'pop', True, False, 'basic_rnn', 'standard', 'pop')),
+    ('jazz piano with strings 40 seconds',
+     (40, 100, 1.0, 26, 32, 0, 48, True, 'jazz', True, False, 'basic_rnn', 'standard', 'jazz')),
+    ('piano melody in rock style',
+     (30, 150, 0.85, 0, 34, 30, None, True, 'rock', True, False, 'basic_rnn', 'standard', 'rock')),
+    ('violin lead with guitar chords and synth bass',
+     (30, 120, 1.0, 24, 38, 24, None, True, 'standard', True, False, 'basic_rnn', 'standard', None)),
+    # "choir" nastaví pad na první nástroj mapy (piano = 0), ne na sbor
+    ('calm ambient piece with choir',
+     (30, 120, 0.8, 0, 33, 29, 0, True, 'standard', True, False, 'basic_rnn', 'standard', None)),
+    ('fast techno 90 bpm no drums',
+     (30, 90, 1.0, 0, 33, 29, None, False, 'standard', True, False, 'basic_rnn', 'standard', None)),
+    ('slow blues temperature 1.5',
+     (30, 80, 1.5, 0, 33, 29, None, True, 'standard', True, False, 'basic_rnn', 'standard', None)),
+    ('experimental jazz with maj7 chords',
+     (30, 100, 1.2, 26, 32, 0, 48, True, 'jazz', True, False, 'basic_rnn', 'seventh', 'jazz')),
+    # totéž pro "strings" – pad 0, nikoli smyčce
+    ('epic orchestral with pad strings, arpeggio',
+     (30, 120, 1.0, 0, 33, 29, 0, True, 'standard', True, True, 'basic_rnn', 'standard', None)),
+    ('lofi beat without pad using lookback rnn',
+     (30, 120, 1.0, 0, 33, 29, None, True, 'standard', True, False, 'lookback_rnn', 'standard', None)),
+    ('metal 20 seconds instrument 30 with diminished chords',
+     (20, 120, 1.0, 30, 33, 29, None, True, 'standard', True, False, 'basic_rnn', 'diminished', None)),
+    ('sus4 folk song with acoustic bass',
+     (30, 120, 1.0, 0, 32, 29, None, True, 'standard', True, False, 'basic_rnn', 'sus', None)),
+    ('flute',
+     (30, 120, 1.0, 73, 33, 29, None, True, 'standard', True, False, 'basic_rnn', 'standard', None)),
+    ('classical piano pad',
+     (30, 80, 1.0, 40, 43, 48, None, False, 'classical', True, False, 'basic_rnn', 'standard', 'classical')),
+    ('chromatic funk with electric piano chords and bass guitar',
+     (30, 120, 1.0, 0, 24, 0, None, True, 'standard', True, False, 'basic_rnn', 'transition', None)),
+    # "choir" i bez padu v žánru
+    ('reggae with choir and no drums, attention rnn',
+     (30, 120, 1.0, 0, 33, 29, 0, False, 'standard', True, False, 'attention_rnn', 'standard', None)),
+]
+
+@pytest.mark.parametrize("prompt, expected", PROMPT_CASES)
+def test_compile_prompt_matches_original_parser(prompt, expected):
+    params = app.compile_prompt(prompt)
+    assert astuple(params)[:-1] == expected
+    assert params.prompt_lower == prompt
+
+def test_strings_or_choir_pick_first_instrument_as_pad():
+    # Záměrně zachovaná zvláštnost: "strings"/"choir" bez žánrového padu vybere
+    # první nástroj INSTRUMENT_MIDI_MAP (piano), ne smyčce ani sbor
+    first_instrument = next(iter(app.INSTRUMENT_MIDI_MAP.values()))
+    assert app.compile_prompt("calm ambient piece with choir").pad_instrument == first_instrument
+    assert app.compile_prompt("epic orchestral with pad strings").pad_instrument == first_instrument
+    assert app.compile_prompt("ambient without pad, strings").pad_instrument is None
+
+def test_parse_prompt_uses_current_params_and_cache():
+    app.compile_prompt.cache_clear()
+    params = app.parse_prompt("Flute Melody", {"length": 45, "tempo": 100, "model": "lookback_rnn"})
+    assert params["length"] == 45
+    assert params["tempo"] == 100
+    assert params["model"] == "lookback_rnn"
+    assert params["melody_instrument"] == app.INSTRUMENT_MIDI_MAP["flute"]
+    assert params["prompt_lower"] == "flute melody"
+    params["tempo"] = 1  # volající dostává vlastní kopii
+    assert app.parse_prompt("Flute Melody", {"length": 45, "tempo": 100, "model": "lookback_rnn"})["tempo"] == 100
+    assert app.compile_prompt.cache_info().hits == 1
+
+def test_keyword_automaton_finds_overlapping_keywords():
+    automaton = app.KeywordAutomaton(["bass", "electric bass", "piano", "electric piano", "ass"])
+    assert automaton.find("electric piano and electric bass") == {
+        "electric piano": 0, "piano": 9, "electric bass": 19, "bass": 28, "ass": 29,
+    }
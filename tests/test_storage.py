@@ -0,0 +1,28 @@
+import os
+
+os.environ.setdefault("STARTUP_MODE", "lazy")
+import pytest
+
+import app
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    storage = app.LocalStorage(str(tmp_path))
+    monkeypatch.setattr(app, "artifact_storage", storage)
+    return storage
+
+
+def test_download_stored_file(storage):
+    key = storage.put("song.mid", b"MThd")
+    response = app.app.test_client().get(f"/download_music/{key}")
+    assert response.status_code == 200
+    assert response.data == b"MThd"
+
+
+def test_directory_key_is_not_found(storage):
+    key = storage.put("song.mid", b"MThd")
+    directory = key.split("/", 1)[0]
+    assert storage.stat(directory) is None
+    response = app.app.test_client().get(f"/download_music/{directory}")
+    assert response.status_code == 404